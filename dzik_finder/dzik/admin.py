@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.db.models import Count, Case, When, IntegerField, Q
-from .models import Product, Shop, ProductShopRelation, OSMShop, UserReport
+from .models import Product, Shop, ProductShopRelation, OSMShop, UserReport, GeocodedPlace, ShopTombstone
 
 
 class ShopRelationInline(admin.TabularInline):
@@ -611,4 +611,19 @@ class UserReportAdmin(admin.ModelAdmin):
         updated = queryset.update(status='rejected')
         self.message_user(request, f'Odrzucono {updated} zgłoszeń')
 
-    mark_as_rejected.short_description = "❌ Odrzuć zgłoszenia"
\ No newline at end of file
+    mark_as_rejected.short_description = "❌ Odrzuć zgłoszenia"
+
+
+@admin.register(GeocodedPlace)
+class GeocodedPlaceAdmin(admin.ModelAdmin):
+    list_display = ['name', 'display_name', 'latitude', 'longitude', 'source', 'created_at']
+    list_filter = ['source']
+    search_fields = ['name', 'query', 'display_name']
+    readonly_fields = ['created_at']
+
+
+@admin.register(ShopTombstone)
+class ShopTombstoneAdmin(admin.ModelAdmin):
+    list_display = ['shop_id', 'deleted_at']
+    search_fields = ['shop_id']
+    readonly_fields = ['shop_id', 'deleted_at']
@@ -0,0 +1,124 @@
+# dzik/async_views.py
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from .cache_keys import SHOPS_NAMESPACE_KEY, shops_key
+from .geocoding import ageocode
+from .product_search import cached_product_index, get_product_index
+from .views import (
+    GEOCODING_ERRORS, SEARCH_PRODUCTS_LIMIT, _preloaded, export_response, fetch_point_candidates,
+    geocode_error_response, geocode_result_response, get_catalog, get_cell_candidates, get_preloaded_shops,
+    negotiated, nearest_shops_data, parse_export_request, parse_nearest_shops_request, parse_smart_shops_request,
+    shops_are_stale, smart_shops_binary, smart_shops_data, wants_binary
+)
+from .wire import WIRE_CONTENT_TYPE
+
+# Asynchroniczne odpowiedniki najczęściej odpytywanych endpointów dla wdrożenia ASGI.
+# Odpowiedzi są identyczne z wersjami z views.py - wspólne są parsowanie parametrów
+# i budowanie wyniku, a tutaj różni się tylko sposób czekania na cache, bazę i sieć.
+# Gorąca ścieżka (trafienie w cache) nie zajmuje wątku, a wolne operacje (preload,
+# zapytania do bazy przy chybieniu) idą do puli wątków przez sync_to_async.
+# Wyjątkiem jest geocoding - ageocode rozmawia z Nominatim przez httpx.
+
+
+async def aget_preloaded_shops():
+    """Jak get_preloaded_shops, ale aktualny snapshot z pamięci procesu zwraca bez
+    przechodzenia do wątku - wystarczą dwa asynchroniczne odczyty z cache"""
+    current = _preloaded['shops']
+    if current is not None:
+        namespace = await cache.aget(SHOPS_NAMESPACE_KEY)
+        if namespace is not None:
+            version = await cache.aget(shops_key('ALL_SHOPS_VERSION', namespace))
+            if current[0].version == version and not shops_are_stale(current[0]):
+                return current
+    return await sync_to_async(get_preloaded_shops)()
+
+
+@csrf_exempt
+async def smart_shops(request):
+    """Asynchroniczna wersja smart_shops"""
+    try:
+        params = parse_smart_shops_request(request)
+        all_shops, index = await aget_preloaded_shops()
+        if wants_binary(request):
+            body = smart_shops_binary(all_shops, index, **params)
+            if body is not None:
+                return negotiated(HttpResponse(body, content_type=WIRE_CONTENT_TYPE))
+        return negotiated(JsonResponse(smart_shops_data(all_shops, index, **params)))
+
+    except (ValueError, TypeError) as e:
+        return JsonResponse({'error': f'Błędne parametry: {str(e)}'}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': f'Błąd serwera: {str(e)}'}, status=500)
+
+
+@csrf_exempt
+async def nearest_shops(request):
+    """Asynchroniczna wersja nearest_shops"""
+    try:
+        params = parse_nearest_shops_request(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    try:
+        candidates = None if params['no_cache'] else await cache.aget(params['cache_key'])
+        if candidates is not None:
+            cached = True
+        else:
+            # Chybienie liczy get_or_compute w wątku - razem z blokadą, która zbiera
+            # równoległe zapytania o tę samą komórkę w jedno zapytanie do bazy
+            candidates, cached = await sync_to_async(get_cell_candidates)(params)
+
+        data = nearest_shops_data(params, candidates, cached)
+        if data is None:
+            candidates = await sync_to_async(fetch_point_candidates)(params)
+            data = nearest_shops_data(params, candidates, False, require_complete=False)
+        if params['catalog']:
+            store, _ = await aget_preloaded_shops()
+            data['catalog_version'] = get_catalog(store)[0]
+        return JsonResponse(data)
+    except Exception as e:
+        return JsonResponse({'error': f'Błąd: {str(e)}'}, status=500)
+
+
+@csrf_exempt
+async def geocode_city(request):
+    """Asynchroniczna wersja geocode_city - zapytanie do Nominatim (httpx) i czekanie
+    na limit zapytań (asyncio.sleep) nie zajmują wątku ani nie blokują pętli zdarzeń"""
+    city = request.GET.get('city', '').strip()
+    if not city:
+        return JsonResponse({'error': 'Podaj nazwę miasta'}, status=400)
+
+    try:
+        return geocode_result_response(await ageocode(city))
+    except GEOCODING_ERRORS as e:
+        return geocode_error_response(e)
+
+
+@csrf_exempt
+async def search_products(request):
+    """Asynchroniczna wersja search_products"""
+    query = request.GET.get('q', '').strip()
+    if len(query) < 2:
+        return JsonResponse({'products': []})
+
+    index = cached_product_index() or await sync_to_async(get_product_index)()
+    return JsonResponse({'products': index.search(query, SEARCH_PRODUCTS_LIMIT)})
+
+
+@csrf_exempt
+async def export_shops(request):
+    """Asynchroniczna wersja export_shops - paczki wysyłane bez buforowania całości"""
+    try:
+        export_format, include_products = parse_export_request(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    try:
+        store, _ = await aget_preloaded_shops()
+        return export_response(request, store, export_format, include_products, asynchronous=True)
+    except Exception as e:
+        return JsonResponse({'error': f'Błąd: {str(e)}'}, status=500)
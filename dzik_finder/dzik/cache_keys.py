@@ -0,0 +1,41 @@
+# dzik/cache_keys.py
+
+import time
+
+from django.core.cache import cache
+
+# Numer bieżącej przestrzeni kluczy sklepów. Wszystkie klucze zależne od danych
+# sklepów zawierają ten numer, więc unieważnienie to jeden INCR zamiast KEYS/SCAN -
+# stare wpisy nie są już czytane i same wygasają po swoim TTL.
+SHOPS_NAMESPACE_KEY = 'shops_namespace'
+# Wersja formatu obiektów zapisywanych pod kluczami sklepów (np. pól ShopStore) -
+# podbijana przy zmianie struktury, żeby nowy kod nie czytał starych pickli z Redisa
+SHOPS_CACHE_FORMAT = 3
+
+
+def shops_namespace():
+    """Zwraca numer bieżącej przestrzeni kluczy sklepów, zakładając ją w razie potrzeby"""
+    namespace = cache.get(SHOPS_NAMESPACE_KEY)
+    if namespace is None:
+        # Start od znacznika czasu, a nie od 1 - gdyby klucz wypadł z cache,
+        # nowa przestrzeń nie trafi na wpisy którejś z poprzednich
+        cache.add(SHOPS_NAMESPACE_KEY, time.time_ns(), None)
+        namespace = cache.get(SHOPS_NAMESPACE_KEY, time.time_ns())
+    return namespace
+
+
+def shops_key(name, namespace=None):
+    """Klucz w bieżącej (albo podanej) przestrzeni kluczy sklepów"""
+    if namespace is None:
+        namespace = shops_namespace()
+    return f'shops_{namespace}_v{SHOPS_CACHE_FORMAT}_{name}'
+
+
+def bump_shops_namespace():
+    """Unieważnia wszystkie klucze sklepów w O(1) i zwraca nowy numer przestrzeni"""
+    try:
+        return cache.incr(SHOPS_NAMESPACE_KEY)
+    except ValueError:
+        namespace = time.time_ns()
+        cache.set(SHOPS_NAMESPACE_KEY, namespace, None)
+        return namespace
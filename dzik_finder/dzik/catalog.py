@@ -0,0 +1,37 @@
+# dzik/catalog.py
+
+import hashlib
+import json
+
+from .responses import EncodedBody
+
+# Katalog szablonów sieci: klucz szablonu -> produkty i logo. Listy produktów są
+# wspólne dla tysięcy sklepów, więc odpowiedzi z catalog=1 podają przy sklepie
+# tylko template_id i catalog_version, a sam katalog klient pobiera raz z
+# /api/catalog/?v=<catalog_version>. Wersja to skrót treści - pod wersjonowanym
+# adresem odpowiedź się nie zmienia i może leżeć w cache przeglądarki i CDN.
+CATALOG_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def catalog_templates(store):
+    return {
+        template['id']: {'products': template['products'], 'logo_url': template['logo_url']}
+        for template in store.templates
+    }
+
+
+def catalog_version(templates):
+    payload = json.dumps(templates, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def build_catalog(store):
+    """Zwraca (wersja katalogu, zakodowana odpowiedź /api/catalog/) dla snapshotu sklepów"""
+    templates = catalog_templates(store)
+    version = catalog_version(templates)
+    encoded = EncodedBody.from_data({
+        'version': version,
+        'templates': templates,
+        'total_templates': len(templates),
+    }, version=store.version)
+    return version, encoded
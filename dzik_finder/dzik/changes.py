@@ -0,0 +1,94 @@
+# dzik/changes.py
+
+import datetime
+
+from django.utils import timezone
+
+from .models import OSMShop, ShopTombstone
+
+# Synchronizacja przyrostowa: klient, który ma już cały zbiór sklepów (all_shops
+# z catalog=1 podaje sync_version), pyta /api/shops/changes/?since=<wersja> i dostaje
+# tylko wstawione i zmienione sklepy (OSMShop.last_updated > since) oraz usunięte
+# (ShopTombstone) i dezaktywowane. Wersja to czas w milisekundach.
+#
+# last_updated ustawia save() jeszcze w transakcji, a import regionu potrafi trzymać
+# ją minutami - dlatego po commicie sygnały przesuwają last_updated zmienionych
+# sklepów na czas commitu i dopiero wtedy zapisują nagrobki usuniętych. Zapytanie
+# cofa się dodatkowo o SYNC_OVERLAP_MS (rozjazd zegarów, równoległe commity),
+# więc ten sam sklep może przyjść dwa razy - zmiany są idempotentne.
+# Zmiany przez QuerySet.update() omijają sygnały i nie trafiają do dziennika.
+SYNC_OVERLAP_MS = 60 * 1000
+SYNC_TOMBSTONE_RETENTION = 30 * 24 * 60 * 60
+# Powyżej tylu zmian taniej jest pobrać cały zbiór od nowa
+SYNC_MAX_CHANGES = 20_000
+TOUCH_BATCH_SIZE = 2000
+
+
+class SyncReset(Exception):
+    """Wersji klienta nie da się dogonić zmianami - musi pobrać cały zbiór"""
+
+
+def sync_version(moment):
+    return int(moment.timestamp() * 1000)
+
+
+def version_time(version):
+    return datetime.datetime.fromtimestamp(version / 1000, tz=datetime.timezone.utc)
+
+
+def record_committed_changes(saved_pks=(), deleted_pks=()):
+    """Wywoływane po commicie - zapisuje zmiany w dzienniku z czasem commitu"""
+    now = timezone.now()
+    saved_pks = sorted(set(saved_pks) - set(deleted_pks))
+    for start in range(0, len(saved_pks), TOUCH_BATCH_SIZE):
+        OSMShop.objects.filter(pk__in=saved_pks[start:start + TOUCH_BATCH_SIZE]).update(last_updated=now)
+    ShopTombstone.objects.bulk_create(
+        [ShopTombstone(shop_id=pk, deleted_at=now) for pk in sorted(set(deleted_pks))],
+        batch_size=TOUCH_BATCH_SIZE
+    )
+
+
+def prune_tombstones():
+    cutoff = timezone.now() - datetime.timedelta(seconds=SYNC_TOMBSTONE_RETENTION)
+    deleted, _ = ShopTombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
+
+
+def changes_since(since):
+    """Zmiany sklepów od wersji ``since`` albo SyncReset, gdy jest ich za dużo
+    lub nagrobki z tego okresu zostały już usunięte"""
+    now = timezone.now()
+    # Zegar klienta albo innego serwera może się spieszyć - wersję z przyszłości
+    # traktujemy jak bieżącą, okno SYNC_OVERLAP_MS i tak cofa zapytanie
+    since = min(since, sync_version(now))
+    if since < sync_version(now) - SYNC_TOMBSTONE_RETENTION * 1000:
+        raise SyncReset('Wersja starsza niż dziennik zmian - pobierz wszystkie sklepy')
+
+    start = version_time(max(since - SYNC_OVERLAP_MS, 0))
+    rows = list(OSMShop.objects.filter(last_updated__gt=start).order_by('last_updated', 'pk').values_list(
+        'pk', 'name', 'chain', 'address', 'latitude', 'longitude', 'shop_template_id', 'is_active'
+    )[:SYNC_MAX_CHANGES + 1])
+    if len(rows) > SYNC_MAX_CHANGES:
+        raise SyncReset('Zbyt wiele zmian - pobierz wszystkie sklepy')
+
+    upserts = [{
+        'id': pk,
+        'name': name,
+        'chain': chain,
+        'address': address,
+        'lat': float(lat),
+        'lon': float(lon),
+        'template_id': template_id
+    } for pk, name, chain, address, lat, lon, template_id, is_active in rows if is_active]
+    deletes = {pk for pk, *_, is_active in rows if not is_active}
+    deletes.update(ShopTombstone.objects.filter(deleted_at__gt=start).values_list('shop_id', flat=True))
+
+    return {
+        'since': since,
+        'version': sync_version(now),
+        'upserts': upserts,
+        'deletes': sorted(deletes),
+        'total_upserts': len(upserts),
+        'total_deletes': len(deletes),
+        'source': 'database'
+    }
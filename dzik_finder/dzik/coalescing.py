@@ -0,0 +1,193 @@
+# dzik/coalescing.py
+
+import asyncio
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+# Jak długo proces, który nie dostał blokady, czeka na wynik cudzego zapytania
+WAIT_TIMEOUT = 5.0
+WAIT_STEP = 0.05
+# Blokada w cache wygasa sama, gdyby proces liczący wynik padł
+LOCK_TIMEOUT = 30
+
+
+class _InFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+_in_flight = {}
+_in_flight_guard = threading.Lock()
+# Odpowiednik _in_flight dla korutyn - osobny dla każdej pętli zdarzeń, bo
+# asyncio.Lock należy do pętli, w której pierwszy raz na nim czekano
+_async_in_flight = weakref.WeakKeyDictionary()
+
+
+def _wait_for_value(key, deadline):
+    while time.monotonic() < deadline:
+        time.sleep(WAIT_STEP)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    return None
+
+
+async def _await_value(key, deadline):
+    while time.monotonic() < deadline:
+        await asyncio.sleep(WAIT_STEP)
+        value = await cache.aget(key)
+        if value is not None:
+            return value
+    return None
+
+
+def try_lock(key, timeout=LOCK_TIMEOUT):
+    """Zakłada blokadę ``key`` przez cache.add z unikalnym tokenem. Zwraca
+    (token, moment założenia) do release_lock albo None, gdy blokada jest zajęta."""
+    token = uuid.uuid4().hex
+    if cache.add(key, token, timeout):
+        return token, time.monotonic()
+    return None
+
+
+def release_lock(key, lock, timeout=LOCK_TIMEOUT):
+    """Zdejmuje blokadę z try_lock tylko wtedy, gdy nadal należy do nas. Po ``timeout``
+    mogła wygasnąć i trafić do innego procesu - tej nie ruszamy, a wcześniej
+    porównujemy token zapisany w cache."""
+    token, acquired_at = lock
+    if time.monotonic() - acquired_at < timeout and cache.get(key) == token:
+        cache.delete(key)
+
+
+async def atry_lock(key, timeout=LOCK_TIMEOUT):
+    """Asynchroniczna wersja try_lock - ta sama blokada i ten sam format tokenu"""
+    token = uuid.uuid4().hex
+    if await cache.aadd(key, token, timeout):
+        return token, time.monotonic()
+    return None
+
+
+async def arelease_lock(key, lock, timeout=LOCK_TIMEOUT):
+    """Asynchroniczna wersja release_lock"""
+    token, acquired_at = lock
+    if time.monotonic() - acquired_at < timeout and await cache.aget(key) == token:
+        await cache.adelete(key)
+
+
+def get_or_compute(key, compute, timeout, refresh=False):
+    """Zwraca (wartość, czy_z_cache) dla klucza, licząc ją co najwyżej raz naraz.
+
+    Wątki tego samego procesu czekają na wspólnej blokadzie, a inne procesy
+    na blokadzie ``<klucz>_lock`` zakładanej przez cache.add - kto jej nie
+    dostał, odpytuje cache do WAIT_TIMEOUT i dopiero potem liczy sam.
+    ``refresh=True`` pomija odczyt z cache, ale wynik nadal jest zapisywany.
+    ``timeout`` może też być funkcją wyniku, gdy czas życia zależy od wartości.
+    """
+    if not refresh:
+        value = cache.get(key)
+        if value is not None:
+            return value, True
+
+    with _in_flight_guard:
+        entry = _in_flight.setdefault(key, _InFlight())
+        entry.users += 1
+
+    try:
+        with entry.lock:
+            # Wątek, który czekał na blokadzie, zwykle zastaje już gotowy wynik
+            if not refresh:
+                value = cache.get(key)
+                if value is not None:
+                    return value, True
+
+            lock_key = f'{key}_lock'
+            lock = try_lock(lock_key)
+            if lock is None:
+                value = _wait_for_value(key, time.monotonic() + WAIT_TIMEOUT)
+                if value is not None:
+                    return value, True
+
+            try:
+                value = compute()
+                cache.set(key, value, timeout(value) if callable(timeout) else timeout)
+            finally:
+                if lock is not None:
+                    release_lock(lock_key, lock)
+            return value, False
+    finally:
+        with _in_flight_guard:
+            entry.users -= 1
+            if entry.users == 0:
+                del _in_flight[key]
+
+
+class _AsyncInFlight:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+async def aget_or_compute(key, compute, timeout, refresh=False):
+    """Asynchroniczna wersja get_or_compute dla korutyny ``compute``.
+
+    Korutyny tej samej pętli zdarzeń czekają na wspólnym asyncio.Lock, a wątki
+    i inne procesy - na tej samej blokadzie ``<klucz>_lock`` w cache, którą
+    odpytujemy przez asyncio.sleep, więc czekanie nie zajmuje wątku.
+    """
+    if not refresh:
+        value = await cache.aget(key)
+        if value is not None:
+            return value, True
+
+    # Pętla zdarzeń jest jednowątkowa - słownik jej blokad nie potrzebuje strażnika
+    entries = _async_in_flight.setdefault(asyncio.get_running_loop(), {})
+    entry = entries.setdefault(key, _AsyncInFlight())
+    entry.users += 1
+
+    try:
+        async with entry.lock:
+            if not refresh:
+                value = await cache.aget(key)
+                if value is not None:
+                    return value, True
+
+            lock_key = f'{key}_lock'
+            lock = await atry_lock(lock_key)
+            if lock is None:
+                value = await _await_value(key, time.monotonic() + WAIT_TIMEOUT)
+                if value is not None:
+                    return value, True
+
+            try:
+                value = await compute()
+                await cache.aset(key, value, timeout(value) if callable(timeout) else timeout)
+            finally:
+                if lock is not None:
+                    await arelease_lock(lock_key, lock)
+            return value, False
+    finally:
+        entry.users -= 1
+        if entry.users == 0:
+            del entries[key]
+
+
+@contextmanager
+def cache_lock(key, timeout=LOCK_TIMEOUT, wait=WAIT_TIMEOUT):
+    """Blokada między procesami zakładana przez cache.add. Zwraca True, gdy udało
+    się ją założyć w ciągu ``wait`` sekund - inaczej wywołujący sam decyduje, co dalej."""
+    deadline = time.monotonic() + wait
+    lock = try_lock(key, timeout)
+    while lock is None and time.monotonic() < deadline:
+        time.sleep(WAIT_STEP)
+        lock = try_lock(key, timeout)
+    try:
+        yield lock is not None
+    finally:
+        if lock is not None:
+            release_lock(key, lock, timeout)
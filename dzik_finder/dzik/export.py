@@ -0,0 +1,104 @@
+# dzik/export.py
+
+import json
+
+import numpy as np
+
+from .models import OSMShop
+
+# Eksport całego zbioru sklepów jako strumień: GeoJSON FeatureCollection albo
+# NDJSON (jeden Feature w linii). Dane idą paczkami po EXPORT_CHUNK_SIZE sklepów,
+# więc pamięć zależy od wielkości paczki, a nie od liczby sklepów, a klient może
+# zacząć parsować od pierwszych bajtów.
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = {
+    'geojson': 'application/geo+json',
+    'ndjson': 'application/x-ndjson',
+}
+
+FEATURE_TEMPLATE = (
+    '{{"type": "Feature", "id": {id}, "geometry": {{"type": "Point", "coordinates": [{lon}, {lat}]}}, '
+    '"properties": {{"name": {name}, "chain": {chain}, "address": {address}{extra}}}}}'
+)
+
+
+def template_fragment(template, include_products=True):
+    """Zakodowana raz na szablon końcówka properties - produkty i logo są wspólne dla
+    wszystkich sklepów sieci, więc nie ma sensu kodować ich dla każdego sklepu osobno"""
+    properties = {'logo_url': template['logo_url'] if template else None}
+    if include_products:
+        properties['products'] = template['products'] if template else []
+    return ', ' + json.dumps(properties)[1:-1]
+
+
+def feature(shop_id, lon, lat, name, chain, address, extra):
+    return FEATURE_TEMPLATE.format(
+        id=shop_id, lon=json.dumps(lon), lat=json.dumps(lat),
+        name=json.dumps(name), chain=json.dumps(chain), address=json.dumps(address), extra=extra
+    )
+
+
+def store_features(store, include_products=True, chunk_size=EXPORT_CHUNK_SIZE):
+    """Paczki zakodowanych Feature'ów ze snapshotu sklepów. Snapshot jest niezmienny
+    (poprawki tworzą nową wersję), więc eksport widzi spójny stan do samego końca."""
+    fragments = [template_fragment(template, include_products) for template in store.templates]
+    fragments.append(template_fragment(None, include_products))  # template_id == -1
+
+    for start in range(0, len(store), chunk_size):
+        positions = np.arange(start, min(start + chunk_size, len(store)))
+        names = store.strings.get_many(store.name_ids[positions])
+        addresses = store.strings.get_many(store.address_ids[positions])
+        yield [
+            feature(shop_id, lon, lat, name, store.chains[chain_id], address, fragments[template_id])
+            for shop_id, lon, lat, name, chain_id, address, template_id in zip(
+                store.shop_ids[positions].tolist(), store.lons[positions].tolist(),
+                store.lats[positions].tolist(), names, store.chain_ids[positions].tolist(),
+                addresses, store.template_ids[positions].tolist()
+            )
+        ]
+
+
+def database_features(include_products=True, chunk_size=EXPORT_CHUNK_SIZE):
+    """Paczki Feature'ów czytane z bazy kursorem po stronie serwera (w PostgreSQL
+    iterator() nie pobiera całego wyniku naraz) - dla narzędzi offline, bez snapshotu"""
+    from .views import get_template_payloads
+
+    shops = OSMShop.objects.filter(is_active=True)
+    templates = get_template_payloads(
+        shops.filter(shop_template__isnull=False).values_list('shop_template_id', flat=True).distinct()
+    )
+    fragments = {pk: template_fragment(template, include_products) for pk, template in templates.items()}
+    no_template = template_fragment(None, include_products)
+
+    rows = shops.order_by('pk').values_list(
+        'pk', 'longitude', 'latitude', 'name', 'chain', 'address', 'shop_template_id'
+    ).iterator(chunk_size=chunk_size)
+    features = []
+    for pk, lon, lat, name, chain, address, template_id in rows:
+        features.append(feature(pk, float(lon), float(lat), name, chain, address,
+                                fragments.get(template_id, no_template)))
+        if len(features) == chunk_size:
+            yield features
+            features = []
+    if features:
+        yield features
+
+
+def encode_stream(chunks, export_format, metadata=None):
+    """Zamienia paczki Feature'ów na bajty w wybranym formacie"""
+    if export_format == 'ndjson':
+        for features in chunks:
+            if features:
+                yield ('\n'.join(features) + '\n').encode('utf-8')
+        return
+
+    header = {'type': 'FeatureCollection'}
+    if metadata:
+        header['metadata'] = metadata
+    yield (json.dumps(header)[:-1] + ', "features": [').encode('utf-8')
+    first = True
+    for features in chunks:
+        if features:
+            yield (('' if first else ', ') + ', '.join(features)).encode('utf-8')
+            first = False
+    yield b']}'
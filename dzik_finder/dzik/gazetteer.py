@@ -0,0 +1,131 @@
+# dzik/gazetteer.py
+
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+
+import numpy as np
+from django.core.cache import cache
+
+from .models import GeocodedPlace
+
+# Miejscowości z importu OSM (import_places) trzymane w pamięci procesu jako
+# posortowana tablica złożonych nazw: zapytanie dokładne i po prefiksie to dwa
+# wyszukiwania binarne, więc podpowiedzi nie wymagają ani bazy, ani sieci.
+GAZETTEER_SOURCE = 'osm'
+GAZETTEER_VERSION_KEY = 'gazetteer_version'
+# Co ile sekund proces sprawdza w cache, czy nie było nowego importu
+VERSION_CHECK_INTERVAL = 60
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+# Miejscowości bez tagu population dostają wagę zależną od rodzaju
+PLACE_TYPE_WEIGHTS = {
+    'city': 50000,
+    'town': 5000,
+    'village': 500,
+    'suburb': 200,
+    'hamlet': 50,
+}
+
+# Litery, których NFKD nie rozkłada na literę bazową i znak diakrytyczny
+FOLD_TABLE = str.maketrans({'ł': 'l', 'đ': 'd', 'ø': 'o', 'ß': 'ss', '-': ' ', '.': ' ', ',': ' '})
+
+
+def fold(text):
+    """Postać nazwy do porównań: małe litery, bez znaków diakrytycznych i interpunkcji
+    (Łódź -> lodz, Bielsko-Biała -> bielsko biala)"""
+    decomposed = unicodedata.normalize('NFKD', text.casefold().translate(FOLD_TABLE))
+    return ' '.join(''.join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+class Gazetteer:
+    """Niezmienny indeks miejscowości posortowany po złożonej nazwie"""
+
+    def __init__(self, places, version=None):
+        places = sorted(places, key=lambda place: place['key'])
+        self.keys = [place['key'] for place in places]
+        self.places = [
+            {
+                'name': place['name'],
+                'lat': place['lat'],
+                'lon': place['lon'],
+                'type': place['type'],
+                'population': place['population'],
+            }
+            for place in places
+        ]
+        self.scores = np.array(
+            [max(place['population'], PLACE_TYPE_WEIGHTS.get(place['type'], 0)) for place in places],
+            dtype=np.int64
+        )
+        self.version = version
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, name):
+        """Miejscowość o dokładnie tej nazwie (po złożeniu) albo None"""
+        key = fold(name)
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.places[i]
+        return None
+
+    def complete(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        """Najważniejsze miejscowości, których nazwa zaczyna się od prefiksu"""
+        key = fold(prefix)
+        if not key:
+            return []
+        start = bisect_left(self.keys, key)
+        end = bisect_left(self.keys, key + '\uffff', start)
+        # Stabilne sortowanie zachowuje kolejność alfabetyczną przy równych wagach
+        order = np.argsort(-self.scores[start:end], kind='stable')[:limit] + start
+        return [self.places[i] for i in order.tolist()]
+
+
+_gazetteer = None
+_checked_at = 0.0
+_load_lock = threading.Lock()
+
+
+def gazetteer_version():
+    version = cache.get(GAZETTEER_VERSION_KEY)
+    if version is None:
+        cache.add(GAZETTEER_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(GAZETTEER_VERSION_KEY, 0)
+    return version
+
+
+def bump_gazetteer_version():
+    """Po imporcie - procesy wczytają gazetteer od nowa przy najbliższym sprawdzeniu"""
+    cache.set(GAZETTEER_VERSION_KEY, time.time_ns(), None)
+
+
+def load_gazetteer(version=None):
+    rows = GeocodedPlace.objects.filter(source=GAZETTEER_SOURCE).values_list(
+        'query', 'name', 'latitude', 'longitude', 'place_type', 'population'
+    )
+    return Gazetteer([
+        {'key': key, 'name': name, 'lat': lat, 'lon': lon, 'type': place_type, 'population': population}
+        for key, name, lat, lon, place_type, population in rows.iterator(chunk_size=5000)
+    ], version)
+
+
+def get_gazetteer():
+    """Gazetteer procesu - wczytywany przy pierwszym użyciu i po każdym imporcie"""
+    global _gazetteer, _checked_at
+    now = time.monotonic()
+    if _gazetteer is not None and now - _checked_at < VERSION_CHECK_INTERVAL:
+        return _gazetteer
+
+    with _load_lock:
+        if _gazetteer is None or time.monotonic() - _checked_at >= VERSION_CHECK_INTERVAL:
+            version = gazetteer_version()
+            if _gazetteer is None or _gazetteer.version != version:
+                started = time.time()
+                _gazetteer = load_gazetteer(version)
+                print(f"Wczytano gazetteer: {len(_gazetteer)} miejscowości w {time.time() - started:.2f} s")
+            _checked_at = time.monotonic()
+    return _gazetteer
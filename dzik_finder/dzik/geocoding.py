@@ -0,0 +1,347 @@
+# dzik/geocoding.py
+
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+from .coalescing import aget_or_compute, get_or_compute
+from .gazetteer import fold, get_gazetteer
+from .models import GeocodedPlace
+
+# Nazwa miasta przechodzi kolejno przez: pamięć procesu -> gazetteer OSM (też
+# w pamięci) -> cache (także wyniki "nie znaleziono") -> tabelę GeocodedPlace ->
+# Nominatim. Do Nominatim idzie więc tylko pierwsze zapytanie o nazwę spoza
+# gazetteera, i to jedno naraz na całą instalację. Wersja async (ageocode) idzie
+# tą samą drogą, ale do Nominatim wysyła httpx.AsyncClient, a na limit zapytań
+# czeka przez asyncio.sleep.
+NOMINATIM_SEARCH_URL = "https://nominatim.openstreetmap.org/search"
+NOMINATIM_HEADERS = {'User-Agent': 'DzikFinder/1.0'}
+NOMINATIM_TIMEOUT = 10
+GEOCODE_CACHE_TIMEOUT = 86400 * 7
+# Nieznalezione nazwy pamiętamy krócej - mogą to być literówki, ale też miejsca,
+# które pojawią się w OSM
+GEOCODE_MISS_TIMEOUT = 86400
+NOT_FOUND = {'not_found': True}
+# Polityka Nominatim: najwyżej 1 zapytanie na sekundę z całej aplikacji
+DEFAULT_RATE = 1.0
+# Jak długo zapytanie czeka na swoją kolej, zanim odpowiemy "spróbuj później"
+RATE_LIMIT_WAIT = 5.0
+SESSION_POOL_SIZE = 4
+PLACES_MEMORY_LIMIT = 5000
+
+
+class GeocodingThrottled(Exception):
+    """Nie doczekaliśmy się na wolne miejsce w limicie zapytań do Nominatim"""
+
+
+class TokenBucket:
+    """Limiter zapytań w procesie: ``rate`` tokenów na sekundę, najwyżej ``capacity`` naraz"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """Zabiera token i zwraca 0 albo zwraca czas oczekiwania na następny"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, deadline):
+        """Czeka na token do ``deadline`` (time.monotonic) - zwraca False, gdy się nie udało"""
+        while True:
+            wait = self._reserve()
+            if wait == 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def aacquire(self, deadline):
+        """Jak acquire, ale czeka przez asyncio.sleep - bez blokowania pętli zdarzeń"""
+        while True:
+            wait = self._reserve()
+            if wait == 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+
+_bucket = None
+_session = None
+_setup_lock = threading.Lock()
+# Klient httpx jest związany z pętlą zdarzeń, w której otworzył połączenia
+_async_clients = weakref.WeakKeyDictionary()
+
+_places = OrderedDict()
+_places_lock = threading.Lock()
+
+
+def geocode_rate():
+    return float(getattr(settings, 'DZIK_GEOCODE_RATE', DEFAULT_RATE))
+
+
+def get_bucket():
+    global _bucket
+    with _setup_lock:
+        if _bucket is None:
+            _bucket = TokenBucket(geocode_rate())
+        return _bucket
+
+
+def get_session():
+    """Wspólna sesja HTTP procesu - połączenie z Nominatim (TLS, keep-alive) jest
+    zestawiane raz i używane ponownie przez kolejne zapytania"""
+    global _session
+    with _setup_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SESSION_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update(NOMINATIM_HEADERS)
+            _session = session
+        return _session
+
+
+def get_async_client():
+    """Klient httpx bieżącej pętli zdarzeń - jak get_session, połączenie z Nominatim
+    zestawiane jest raz i używane ponownie"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            headers=NOMINATIM_HEADERS,
+            timeout=NOMINATIM_TIMEOUT,
+            limits=httpx.Limits(max_connections=SESSION_POOL_SIZE),
+        )
+    return client
+
+
+def wait_for_rate_limit(timeout=RATE_LIMIT_WAIT):
+    """Rezerwuje miejsce na jedno zapytanie do Nominatim albo rzuca GeocodingThrottled.
+
+    Token bucket pilnuje limitu w procesie, a limitu wspólnego dla wszystkich workerów
+    korzystających z tego cache - szczeliny czasowe długości 1/rate zakładane przez
+    cache.add. Zapytanie wychodzi dopiero na końcu zajętej szczeliny: dwa zapytania ze
+    szczelin po sobie dzieli wtedy co najmniej 1/rate, także na ich granicy."""
+    deadline = time.monotonic() + timeout
+    rate = geocode_rate()
+    if not get_bucket().acquire(deadline):
+        raise GeocodingThrottled()
+
+    now = time.time()
+    slot = int(now * rate)
+    while True:
+        wait = (slot + 1) / rate - now
+        if time.monotonic() + wait > deadline:
+            raise GeocodingThrottled()
+        # Szczelina zajęta przez inny worker - ustawiamy się w kolejce do następnej
+        if cache.add(f'geocode_slot_{slot}', 1, int(wait) + 2):
+            time.sleep(wait)
+            return
+        slot += 1
+
+
+async def await_rate_limit(timeout=RATE_LIMIT_WAIT):
+    """Asynchroniczna wersja wait_for_rate_limit - ten sam token bucket i te same
+    szczeliny w cache, więc limit jest wspólny dla widoków sync i async"""
+    deadline = time.monotonic() + timeout
+    rate = geocode_rate()
+    if not await get_bucket().aacquire(deadline):
+        raise GeocodingThrottled()
+
+    now = time.time()
+    slot = int(now * rate)
+    while True:
+        wait = (slot + 1) / rate - now
+        if time.monotonic() + wait > deadline:
+            raise GeocodingThrottled()
+        if await cache.aadd(f'geocode_slot_{slot}', 1, int(wait) + 2):
+            await asyncio.sleep(wait)
+            return
+        slot += 1
+
+
+def normalize_query(city):
+    """Klucz GeocodedPlace.query i cache - ten sam fold co w gazetteerze, więc
+    'Łódź' z Nominatim i 'lodz' z importu to jeden wiersz"""
+    return fold(city)
+
+
+def geocode_cache_key(query):
+    return f"geocode_{query.replace(' ', '_')}"
+
+
+def nominatim_city_params(city):
+    return {
+        'q': f"{city}, Poland",
+        'format': 'json',
+        'limit': 1,
+        'countrycodes': 'pl',
+        'featuretype': 'city',
+        'addressdetails': 1,
+    }
+
+
+def geocode_result(city, data):
+    """Wynik geocodingu z odpowiedzi Nominatim albo None, gdy nic nie znaleziono.
+    Nieprawidłowy format odpowiedzi rzuca IndexError/KeyError/ValueError."""
+    if not data:
+        return None
+
+    first_result = data[0]
+    return {
+        'city': city,
+        'lat': float(first_result['lat']),
+        'lon': float(first_result['lon']),
+        'display_name': first_result.get('display_name', city)
+    }
+
+
+def fetch_from_nominatim(city):
+    """Jedno zapytanie do Nominatim w ramach limitu. Błędy sieci i HTTP rzucają
+    requests.RequestException, przekroczenie limitu - GeocodingThrottled."""
+    wait_for_rate_limit()
+    response = get_session().get(
+        getattr(settings, 'DZIK_NOMINATIM_URL', NOMINATIM_SEARCH_URL),
+        params=nominatim_city_params(city),
+        timeout=NOMINATIM_TIMEOUT
+    )
+    response.raise_for_status()
+    return geocode_result(city, response.json())
+
+
+async def afetch_from_nominatim(city):
+    """Asynchroniczna wersja fetch_from_nominatim. Błędy sieci i HTTP rzucają
+    httpx.HTTPError, przekroczenie limitu - GeocodingThrottled."""
+    await await_rate_limit()
+    response = await get_async_client().get(
+        getattr(settings, 'DZIK_NOMINATIM_URL', NOMINATIM_SEARCH_URL),
+        params=nominatim_city_params(city)
+    )
+    response.raise_for_status()
+    return geocode_result(city, response.json())
+
+
+def _remembered(query):
+    with _places_lock:
+        place = _places.get(query)
+        if place is not None:
+            _places.move_to_end(query)
+        return place
+
+
+def _remember(query, place):
+    with _places_lock:
+        _places[query] = place
+        _places.move_to_end(query)
+        while len(_places) > PLACES_MEMORY_LIMIT:
+            _places.popitem(last=False)
+
+
+def _lookup(city, query):
+    place = GeocodedPlace.objects.filter(query=query).first()
+    if place is not None:
+        return place.as_result()
+
+    result = fetch_from_nominatim(city)
+    if result is None:
+        return NOT_FOUND
+
+    place, _ = GeocodedPlace.objects.get_or_create(query=query, defaults=_place_fields(result))
+    return place.as_result()
+
+
+async def _alookup(city, query):
+    place = await GeocodedPlace.objects.filter(query=query).afirst()
+    if place is not None:
+        return place.as_result()
+
+    result = await afetch_from_nominatim(city)
+    if result is None:
+        return NOT_FOUND
+
+    place, _ = await GeocodedPlace.objects.aget_or_create(query=query, defaults=_place_fields(result))
+    return place.as_result()
+
+
+def _place_fields(result):
+    return {
+        'name': result['city'],
+        'display_name': result['display_name'],
+        'latitude': result['lat'],
+        'longitude': result['lon'],
+    }
+
+
+def _gazetteer_place(gazetteer, city):
+    known = gazetteer.find(city)
+    if known is None:
+        return None
+    return {
+        'city': known['name'],
+        'lat': known['lat'],
+        'lon': known['lon'],
+        'display_name': f"{known['name']}, Polska"
+    }
+
+
+def _place_timeout(value):
+    return GEOCODE_MISS_TIMEOUT if value.get('not_found') else GEOCODE_CACHE_TIMEOUT
+
+
+def geocode(city):
+    """Zwraca {'city', 'lat', 'lon', 'display_name'} dla nazwy miasta albo None,
+    gdy Nominatim jej nie zna. Równoległe zapytania o tę samą nazwę (także z innych
+    procesów) czekają na jedno zapytanie do Nominatim zamiast wysyłać własne."""
+    query = normalize_query(city)
+    place = _remembered(query)
+    if place is not None:
+        return place
+
+    place = _gazetteer_place(get_gazetteer(), city)
+    if place is None:
+        place, _ = get_or_compute(geocode_cache_key(query), lambda: _lookup(city, query), _place_timeout)
+        if place.get('not_found'):
+            return None
+
+    _remember(query, place)
+    return place
+
+
+async def ageocode(city):
+    """Asynchroniczna wersja geocode - wynik i kolejne poziomy cache są te same.
+    Zapytanie do Nominatim i czekanie na limit zapytań nie zajmują wątku; do
+    wątku trafia tylko pierwsze w procesie wczytanie gazetteera."""
+    query = normalize_query(city)
+    place = _remembered(query)
+    if place is not None:
+        return place
+
+    place = _gazetteer_place(await sync_to_async(get_gazetteer)(), city)
+    if place is None:
+        place, _ = await aget_or_compute(geocode_cache_key(query), lambda: _alookup(city, query), _place_timeout)
+        if place.get('not_found'):
+            return None
+
+    _remember(query, place)
+    return place
@@ -0,0 +1,209 @@
+# dzik/management/commands/benchmark_shops.py
+
+import gzip
+import json
+import pickle
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from dzik.shop_store import ShopStore
+from dzik.spatial import ShopGridIndex, calculate_distance
+from dzik.wire import decode_shops, encode_shops
+
+# Prostokąt obejmujący Polskę - ten sam co region 'poland' w import_osm_shops
+POLAND_BOUNDS = (49.0, 14.1, 55.0, 24.2)
+CHAINS = ['zabka', 'biedronka', 'lidl', 'dino', 'stokrotka', 'kaufland', 'other']
+FLAVORS = ['Mango', 'Kiwi', 'Cola', 'Arbuz', 'Cytryna', 'Malina', 'Ananas', 'Wiśnia']
+
+
+def generate_templates(count=20, seed=42):
+    """Generuje szablony sieci z listami produktów jak w get_template_payloads"""
+    rng = random.Random(seed)
+    return {pk: {
+        'products': [{
+            'id': product_id,
+            'name': 'Dzik Energy',
+            'flavor': rng.choice(FLAVORS),
+            'photo_url': f'/media/products/{product_id}.png',
+            'category': 'energy_drink'
+        } for product_id in rng.sample(range(1, 60), 8)],
+        'logo_url': f'/media/shop_logos/{pk}.png'
+    } for pk in range(1, count + 1)}
+
+
+def generate_rows(count, templates, seed=42):
+    """Generuje syntetyczne sklepy w granicach Polski jako krotki dla ShopStore.build"""
+    rng = random.Random(seed)
+    south, west, north, east = POLAND_BOUNDS
+    template_pks = list(templates) + [None]
+    return [(
+        rng.choice(['Żabka', 'Biedronka', 'Lidl', 'Dino', f'Sklep {i}']),
+        rng.choice(CHAINS),
+        f'ul. Testowa {i}, Miasto {i % 500}',
+        round(rng.uniform(south, north), 6),
+        round(rng.uniform(west, east), 6),
+        rng.choice(template_pks),
+        i + 1,
+    ) for i in range(count)]
+
+
+def legacy_shops(rows, templates):
+    """Dotychczasowa struktura cache - lista słowników sklepów"""
+    shops = []
+    for name, chain, address, lat, lon, template_pk, _ in rows:
+        template = templates.get(template_pk)
+        shops.append({
+            'name': name,
+            'chain': chain,
+            'address': address,
+            'lat': lat,
+            'lon': lon,
+            'products': template['products'] if template else [],
+            'logo_url': template['logo_url'] if template else None
+        })
+    return shops
+
+
+def linear_scan(shops, lat, lon, radius):
+    """Dotychczasowy algorytm smart_shops - Haversine dla każdego sklepu"""
+    filtered = []
+    for shop in shops:
+        distance = calculate_distance(lat, lon, shop['lat'], shop['lon'])
+        if distance <= radius:
+            shop_copy = shop.copy()
+            shop_copy['distance'] = round(distance)
+            filtered.append(shop_copy)
+    filtered.sort(key=lambda x: x['distance'])
+    return filtered
+
+
+def index_scan(store, index, lat, lon, radius):
+    positions, distances = index.query_radius(lat, lon, radius)
+    filtered = store.shops(positions)
+    for i, shop in enumerate(filtered):
+        shop['distance'] = round(distances[i])
+    return filtered
+
+
+def timed(function, repeat=3):
+    """Zwraca (wynik, najlepszy czas w ms) z kilku powtórzeń"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def measure_allocation(build):
+    """Zwraca (obiekt, zaalokowane bajty) dla funkcji budującej strukturę"""
+    tracemalloc.start()
+    try:
+        obj = build()
+        allocated, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return obj, allocated
+
+
+class Command(BaseCommand):
+    help = 'Porównuje wydajność wyszukiwania sklepów na syntetycznych danych'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--suite', choices=['spatial', 'memory', 'wire'], nargs='+',
+                            default=['spatial', 'memory', 'wire'])
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 50_000, 200_000])
+        parser.add_argument('--queries', type=int, default=50)
+        parser.add_argument('--radius', type=int, nargs='+', default=[5_000, 30_000, 100_000])
+
+    def handle(self, *args, **options):
+        templates = generate_templates()
+        for size in options['sizes']:
+            rows = generate_rows(size, templates)
+            self.stdout.write(f'\n{size} sklepów')
+            if 'spatial' in options['suite']:
+                self.benchmark_spatial(rows, templates, options)
+            if 'memory' in options['suite']:
+                self.benchmark_memory(size, templates)
+            if 'wire' in options['suite']:
+                self.benchmark_wire(rows, templates)
+
+    def benchmark_spatial(self, rows, templates, options):
+        south, west, north, east = POLAND_BOUNDS
+        rng = random.Random(7)
+        shops = legacy_shops(rows, templates)
+        store = ShopStore.build(rows, templates)
+
+        start = time.perf_counter()
+        index = ShopGridIndex(store.lats, store.lons)
+        build_ms = (time.perf_counter() - start) * 1000
+        self.stdout.write(f'  budowa indeksu: {build_ms:.1f} ms')
+
+        for radius in options['radius']:
+            points = [(rng.uniform(south, north), rng.uniform(west, east))
+                      for _ in range(options['queries'])]
+
+            start = time.perf_counter()
+            expected = [linear_scan(shops, lat, lon, radius) for lat, lon in points]
+            linear_ms = (time.perf_counter() - start) * 1000 / len(points)
+
+            start = time.perf_counter()
+            actual = [index_scan(store, index, lat, lon, radius) for lat, lon in points]
+            index_ms = (time.perf_counter() - start) * 1000 / len(points)
+
+            status = self.style.SUCCESS('OK') if actual == expected else self.style.ERROR('RÓŻNICA')
+            self.stdout.write(
+                f'  promień {radius:>7} m: liniowo {linear_ms:8.2f} ms, '
+                f'indeks {index_ms:8.2f} ms, '
+                f'przyspieszenie x{linear_ms / max(index_ms, 1e-9):.1f} [{status}]'
+            )
+
+    def benchmark_memory(self, size, templates):
+        # Krotki generowane są wewnątrz pomiaru, bo w preloadzie napisy też powstają
+        # z zapytania i zostają w pamięci tylko wtedy, gdy trzyma je struktura cache
+        structures = [
+            ('lista słowników', lambda: legacy_shops(generate_rows(size, templates), templates)),
+            ('ShopStore', lambda: ShopStore.build(generate_rows(size, templates), templates)),
+        ]
+        for label, build in structures:
+            obj, allocated = measure_allocation(build)
+
+            start = time.perf_counter()
+            blob = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            dump_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            pickle.loads(blob)
+            load_ms = (time.perf_counter() - start) * 1000
+
+            self.stdout.write(
+                f'  {label:<16}: pamięć {allocated / 2 ** 20:7.1f} MiB, '
+                f'pickle {len(blob) / 2 ** 20:6.1f} MiB, '
+                f'dumps {dump_ms:7.1f} ms, loads {load_ms:7.1f} ms'
+            )
+
+    def benchmark_wire(self, rows, templates):
+        """Rozmiar i czas kodowania listy wszystkich sklepów: JSON jak w all_shops vs format=bin"""
+        store = ShopStore.build(rows, templates)
+        meta = {'count': len(store), 'source': 'benchmark'}
+
+        json_body, json_ms = timed(lambda: json.dumps(dict(meta, shops=store.shops())).encode('utf-8'))
+        wire_body, wire_ms = timed(lambda: encode_shops(store, meta=meta))
+        _, json_load_ms = timed(lambda: json.loads(json_body))
+        decoded, wire_load_ms = timed(lambda: decode_shops(wire_body))
+
+        status = self.style.SUCCESS('OK') if decoded == json.loads(json_body) else self.style.ERROR('RÓŻNICA')
+        for label, body, encode_ms, decode_ms in [
+            ('JSON', json_body, json_ms, json_load_ms),
+            ('bin', wire_body, wire_ms, wire_load_ms),
+        ]:
+            self.stdout.write(
+                f'  {label:<4}: {len(body) / 1024:9.1f} KiB, '
+                f'gzip {len(gzip.compress(body, 6)) / 1024:8.1f} KiB, '
+                f'kodowanie {encode_ms:7.1f} ms, dekodowanie {decode_ms:7.1f} ms'
+            )
+        self.stdout.write(f'  bin / JSON: x{len(wire_body) / len(json_body):.3f} rozmiaru [{status}]')
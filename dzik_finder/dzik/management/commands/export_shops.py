@@ -0,0 +1,36 @@
+# dzik/management/commands/export_shops.py
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from dzik.export import EXPORT_FORMATS, database_features, encode_stream
+
+
+class Command(BaseCommand):
+    help = 'Stream all active shops as GeoJSON or NDJSON straight from the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', type=str, default='geojson', choices=sorted(EXPORT_FORMATS),
+                            help='Output format (default geojson)')
+        parser.add_argument('--output', type=str, help='Output file (default stdout)')
+        parser.add_argument('--no-products', action='store_true', help='Omit product lists')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        chunks = database_features(include_products=not options['no_products'])
+        metadata = {'last_update': int(started), 'source': 'database'}
+
+        if options['output']:
+            written = 0
+            with open(options['output'], 'wb') as f:
+                for data in encode_stream(chunks, options['format'], metadata):
+                    f.write(data)
+                    written += len(data)
+            self.stderr.write(self.style.SUCCESS(
+                f"Zapisano {written / 1024 / 1024:.1f} MB do {options['output']} w {time.time() - started:.1f} s"
+            ))
+        else:
+            for data in encode_stream(chunks, options['format'], metadata):
+                sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,138 @@
+# dzik/management/commands/import_places.py
+import json
+
+import requests
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from dzik.gazetteer import GAZETTEER_SOURCE, PLACE_TYPE_WEIGHTS, bump_gazetteer_version, fold
+from dzik.models import GeocodedPlace
+
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+DEFAULT_PLACE_TYPES = 'city,town,village'
+BATCH_SIZE = 2000
+
+
+class Command(BaseCommand):
+    help = 'Import places gazetteer from an OSM extract (GeoJSON) or Overpass API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', type=str, help='Path to GeoJSON file with place=* points')
+        parser.add_argument('--overpass', action='store_true', help='Download Polish places from Overpass API')
+        parser.add_argument('--place-types', type=str, default=DEFAULT_PLACE_TYPES,
+                            help=f'Comma-separated place types (default {DEFAULT_PLACE_TYPES})')
+        parser.add_argument('--clear', action='store_true', help='Clear previously imported places')
+
+    def handle(self, *args, **options):
+        place_types = [t.strip() for t in options['place_types'].split(',') if t.strip()]
+
+        if options['file']:
+            try:
+                with open(options['file'], 'r', encoding='utf-8') as f:
+                    places = self.places_from_geojson(json.load(f))
+            except FileNotFoundError:
+                self.stdout.write(self.style.ERROR(f"Nie znaleziono pliku: {options['file']}"))
+                return
+        elif options['overpass']:
+            places = self.places_from_overpass(place_types)
+        else:
+            self.stdout.write(self.style.ERROR('Podaj --file albo --overpass'))
+            return
+
+        places = [place for place in places if place['type'] in place_types]
+        best = self.best_per_name(places)
+        self.save_places(best, options['clear'])
+        bump_gazetteer_version()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Zaimportowano {len(best)} miejscowości (z {len(places)} punktów, '
+            f'{len(places) - len(best)} zduplikowanych nazw pominięto)'
+        ))
+
+    def places_from_geojson(self, data):
+        places = []
+        for feature in data.get('features', []):
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') != 'Point' or len(geometry.get('coordinates', [])) != 2:
+                continue
+            lon, lat = geometry['coordinates']
+            place = self.place_from_tags(feature.get('properties') or {}, lat, lon)
+            if place:
+                places.append(place)
+        return places
+
+    def places_from_overpass(self, place_types):
+        overpass_query = f"""
+        [out:json][timeout:300];
+        area["ISO3166-1"="PL"][admin_level=2]->.pl;
+        node["place"~"^({'|'.join(place_types)})$"]["name"](area.pl);
+        out;
+        """
+        self.stdout.write('Pobieranie miejscowości z Overpass API...')
+        response = requests.post(OVERPASS_URL, data={'data': overpass_query}, timeout=360)
+        response.raise_for_status()
+
+        places = []
+        for element in response.json().get('elements', []):
+            place = self.place_from_tags(element.get('tags') or {}, element.get('lat'), element.get('lon'))
+            if place:
+                places.append(place)
+        return places
+
+    def place_from_tags(self, tags, lat, lon):
+        name = tags.get('name', '').strip()
+        if not name or lat is None or lon is None:
+            return None
+        return {
+            'name': name,
+            'type': tags.get('place', ''),
+            'population': self.parse_population(tags.get('population')),
+            'lat': float(lat),
+            'lon': float(lon),
+        }
+
+    @staticmethod
+    def parse_population(value):
+        try:
+            return max(0, int(str(value).replace(' ', '').replace(',', '')))
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def best_per_name(places):
+        """Jedna miejscowość na złożoną nazwę - największa, jak w wynikach Nominatim
+        (wiele wsi nazywa się tak samo)"""
+        best = {}
+        for place in places:
+            key = fold(place['name'])
+            weight = (PLACE_TYPE_WEIGHTS.get(place['type'], 0), place['population'])
+            if key and (key not in best or weight > best[key][0]):
+                best[key] = (weight, place)
+        return {key: place for key, (weight, place) in best.items()}
+
+    def save_places(self, places, clear):
+        objects = [
+            GeocodedPlace(
+                query=key,
+                name=place['name'],
+                display_name=f"{place['name']}, Polska",
+                latitude=place['lat'],
+                longitude=place['lon'],
+                source=GAZETTEER_SOURCE,
+                place_type=place['type'],
+                population=place['population'],
+            )
+            for key, place in places.items()
+        ]
+
+        with transaction.atomic():
+            if clear:
+                deleted, _ = GeocodedPlace.objects.filter(source=GAZETTEER_SOURCE).delete()
+                self.stdout.write(f'Usunięto {deleted} wcześniej zaimportowanych miejscowości')
+            GeocodedPlace.objects.bulk_create(
+                objects,
+                batch_size=BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=['query'],
+                update_fields=['name', 'display_name', 'latitude', 'longitude', 'source', 'place_type', 'population'],
+            )
@@ -1,14 +1,29 @@
 # dzik/management/commands/preload_cache.py
 
+import time
+
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from dzik.views import preload_all_shops_to_cache
 
 class Command(BaseCommand):
-    help = 'Preloaduje wszystkie sklepy do cache'
+    help = 'Preloaduje wszystkie sklepy do cache i zapisuje plik snapshotu'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--snapshot', default=settings.DZIK_SHOPS_SNAPSHOT,
+                            help='Ścieżka pliku snapshotu (domyślnie DZIK_SHOPS_SNAPSHOT)')
 
     def handle(self, *args, **options):
         self.stdout.write('Rozpoczynam preloadowanie sklepów...')
-        count = preload_all_shops_to_cache()
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            count = preload_all_shops_to_cache(options['snapshot'])
+        elapsed = time.perf_counter() - start
         self.stdout.write(
             self.style.SUCCESS(f'Pomyślnie preloadowano {count} sklepów do cache')
         )
+        self.stdout.write(f'Czas: {elapsed:.2f} s, zapytania SQL: {len(queries)}')
+        if options['snapshot']:
+            self.stdout.write(f'Snapshot: {options["snapshot"]}')
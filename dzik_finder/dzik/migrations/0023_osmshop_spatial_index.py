@@ -0,0 +1,78 @@
+from django.db import migrations
+
+# PostgreSQL: indeks GiST na wyrażeniu point(lon, lat) - wbudowany typ geometryczny,
+# bez PostGIS. Obsługuje zapytania o prostokąt (<@ box) i sortowanie KNN (<->),
+# a jako indeks na wyrażeniu nie wymaga synchronizacji przy imporcie.
+POSTGRES_FORWARDS = """
+CREATE INDEX IF NOT EXISTS dzik_osmshop_location_gist
+    ON dzik_osmshop USING gist (point(longitude::float8, latitude::float8));
+"""
+POSTGRES_BACKWARDS = "DROP INDEX IF EXISTS dzik_osmshop_location_gist;"
+
+# SQLite (lokalny dev): tabela R*Tree trzymana w zgodzie z dzik_osmshop przez triggery,
+# więc działa też dla skryptów importujących wprost przez SQL.
+SQLITE_FORWARDS = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS dzik_osmshop_rtree
+           USING rtree(id, min_lat, max_lat, min_lon, max_lon)""",
+    """INSERT INTO dzik_osmshop_rtree
+           SELECT id, latitude, latitude, longitude, longitude FROM dzik_osmshop""",
+    """CREATE TRIGGER IF NOT EXISTS dzik_osmshop_rtree_insert AFTER INSERT ON dzik_osmshop
+       BEGIN
+           INSERT INTO dzik_osmshop_rtree
+               VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS dzik_osmshop_rtree_update
+           AFTER UPDATE OF latitude, longitude ON dzik_osmshop
+       BEGIN
+           UPDATE dzik_osmshop_rtree
+               SET min_lat = new.latitude, max_lat = new.latitude,
+                   min_lon = new.longitude, max_lon = new.longitude
+               WHERE id = new.id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS dzik_osmshop_rtree_delete AFTER DELETE ON dzik_osmshop
+       BEGIN
+           DELETE FROM dzik_osmshop_rtree WHERE id = old.id;
+       END""",
+]
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS dzik_osmshop_rtree_insert",
+    "DROP TRIGGER IF EXISTS dzik_osmshop_rtree_update",
+    "DROP TRIGGER IF EXISTS dzik_osmshop_rtree_delete",
+    "DROP TABLE IF EXISTS dzik_osmshop_rtree",
+]
+
+
+def create_spatial_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(POSTGRES_FORWARDS)
+    elif vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            try:
+                cursor.execute("CREATE VIRTUAL TABLE temp.dzik_rtree_probe USING rtree(id, a, b)")
+                cursor.execute("DROP TABLE temp.dzik_rtree_probe")
+            except Exception:
+                print("SQLite bez modułu R*Tree - nearest_shops użyje zwykłego filtra lat/lon")
+                return
+        for statement in SQLITE_FORWARDS:
+            schema_editor.execute(statement)
+
+
+def drop_spatial_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(POSTGRES_BACKWARDS)
+    elif vendor == 'sqlite':
+        for statement in SQLITE_BACKWARDS:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dzik', '0022_userreport'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_spatial_index, drop_spatial_index),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dzik', '0023_osmshop_spatial_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodedPlace',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.CharField(max_length=200, unique=True, verbose_name='Znormalizowane zapytanie')),
+                ('name', models.CharField(max_length=200, verbose_name='Nazwa')),
+                ('display_name', models.CharField(blank=True, max_length=255, verbose_name='Pełna nazwa')),
+                ('latitude', models.FloatField(verbose_name='Szerokość')),
+                ('longitude', models.FloatField(verbose_name='Długość')),
+                ('source', models.CharField(default='nominatim', max_length=20, verbose_name='Źródło')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Data dodania')),
+            ],
+            options={
+                'verbose_name': 'Miejsce (geocoding)',
+                'verbose_name_plural': 'Miejsca (geocoding)',
+                'ordering': ['name'],
+            },
+        ),
+    ]
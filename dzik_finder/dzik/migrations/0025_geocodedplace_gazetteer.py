@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dzik', '0024_geocodedplace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='geocodedplace',
+            name='place_type',
+            field=models.CharField(blank=True, max_length=20, verbose_name='Rodzaj miejscowości'),
+        ),
+        migrations.AddField(
+            model_name='geocodedplace',
+            name='population',
+            field=models.PositiveIntegerField(default=0, verbose_name='Liczba mieszkańców'),
+        ),
+        migrations.AddIndex(
+            model_name='geocodedplace',
+            index=models.Index(fields=['source'], name='dzik_geocod_source_3316c4_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dzik', '0025_geocodedplace_gazetteer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shop_id', models.IntegerField(verbose_name='ID sklepu')),
+                ('deleted_at', models.DateTimeField(db_index=True, verbose_name='Data usunięcia')),
+            ],
+            options={
+                'verbose_name': 'Usunięty sklep',
+                'verbose_name_plural': 'Usunięte sklepy',
+                'ordering': ['-deleted_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='osmshop',
+            index=models.Index(fields=['last_updated'], name='dzik_osmsho_last_up_acb00a_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+import unicodedata
+
+from django.db import migrations
+
+# Zamrożona kopia dzik.gazetteer.fold z chwili tej migracji - późniejsze zmiany
+# w gazetteerze nie mogą zmieniać tego, co migracja zapisała w bazie
+FOLD_TABLE = str.maketrans({'ł': 'l', 'đ': 'd', 'ø': 'o', 'ß': 'ss', '-': ' ', '.': ' ', ',': ' '})
+
+
+def fold(text):
+    decomposed = unicodedata.normalize('NFKD', text.casefold().translate(FOLD_TABLE))
+    return ' '.join(''.join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def fold_queries(apps, schema_editor):
+    """Wiersze z Nominatim miały klucz casefold() - przechodzą na fold() jak gazetteer.
+    Gdy złożony klucz jest już zajęty, zostaje istniejący wiersz."""
+    GeocodedPlace = apps.get_model('dzik', 'GeocodedPlace')
+    taken = set(GeocodedPlace.objects.values_list('query', flat=True))
+    for place in GeocodedPlace.objects.exclude(source='osm').order_by('pk'):
+        key = fold(place.query)
+        if key == place.query:
+            continue
+        if key in taken:
+            place.delete()
+            continue
+        taken.discard(place.query)
+        taken.add(key)
+        place.query = key
+        place.save(update_fields=['query'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dzik', '0026_shoptombstone'),
+    ]
+
+    operations = [
+        migrations.RunPython(fold_queries, migrations.RunPython.noop),
+    ]
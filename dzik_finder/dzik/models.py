@@ -1,5 +1,8 @@
 # dzik/models.py
-from django.db import models
+import math
+
+from django.db import connections, models
+from django.db.models.expressions import RawSQL
 
 
 class Product(models.Model):
@@ -145,6 +148,56 @@ class ProductShopRelation(models.Model):
         return f"{self.product} → {self.shop}"
 
 
+class OSMShopQuerySet(models.QuerySet):
+    """Zapytania przestrzenne korzystające z indeksu z migracji 0023:
+    GiST na point(lon, lat) w PostgreSQL albo tabeli R*Tree w SQLite.
+    Bez indeksu (inna baza, SQLite bez R*Tree) wracają do filtra lat/lon."""
+
+    def _spatial_backend(self):
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            return 'postgresql'
+        if connection.vendor == 'sqlite' and 'dzik_osmshop_rtree' in connection.introspection.table_names():
+            return 'sqlite'
+        return None
+
+    def within_box(self, min_lat, max_lat, min_lon, max_lon):
+        backend = self._spatial_backend()
+        if backend == 'postgresql':
+            return self.extra(
+                where=["point(dzik_osmshop.longitude::float8, dzik_osmshop.latitude::float8)"
+                       " <@ box(point(%s, %s), point(%s, %s))"],
+                params=[min_lon, min_lat, max_lon, max_lat]
+            )
+        if backend == 'sqlite':
+            return self.extra(
+                where=["""dzik_osmshop.id IN (SELECT id FROM dzik_osmshop_rtree
+                          WHERE max_lat >= %s AND min_lat <= %s AND max_lon >= %s AND min_lon <= %s)"""],
+                params=[min_lat, max_lat, min_lon, max_lon]
+            )
+        return self.filter(
+            latitude__range=(min_lat, max_lat),
+            longitude__range=(min_lon, max_lon)
+        )
+
+    def nearest_to(self, lat, lon):
+        """Sortuje od najbliższych punktu - w PostgreSQL przez KNN (<->) na indeksie GiST"""
+        if self._spatial_backend() == 'postgresql':
+            distance = RawSQL(
+                "point(dzik_osmshop.longitude::float8, dzik_osmshop.latitude::float8) <-> point(%s, %s)",
+                (lon, lat)
+            )
+        else:
+            # Kwadrat odległości w stopniach z poprawką na zbieżność południków
+            scale = math.cos(math.radians(lat)) ** 2
+            distance = RawSQL(
+                "(dzik_osmshop.latitude - %s) * (dzik_osmshop.latitude - %s)"
+                " + (dzik_osmshop.longitude - %s) * (dzik_osmshop.longitude - %s) * %s",
+                (lat, lat, lon, lon, scale)
+            )
+        return self.order_by(distance)
+
+
 class OSMShop(models.Model):
     osm_id = models.CharField(max_length=50, unique=True)
     name = models.CharField(max_length=200)
@@ -156,14 +209,32 @@ class OSMShop(models.Model):
     last_updated = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
 
+    objects = OSMShopQuerySet.as_manager()
+
     class Meta:
         indexes = [
             models.Index(fields=['latitude', 'longitude']),
             models.Index(fields=['chain']),
             models.Index(fields=['is_active']),
+            models.Index(fields=['last_updated']),
         ]
 
 
+class ShopTombstone(models.Model):
+    """Ślad usuniętego OSMShop - synchronizacja przyrostowa (/api/shops/changes/)
+    musi przekazać klientom także sklepy, których wiersza już nie ma"""
+    shop_id = models.IntegerField(verbose_name="ID sklepu")
+    deleted_at = models.DateTimeField(db_index=True, verbose_name="Data usunięcia")
+
+    class Meta:
+        verbose_name = "Usunięty sklep"
+        verbose_name_plural = "Usunięte sklepy"
+        ordering = ['-deleted_at']
+
+    def __str__(self):
+        return f"{self.shop_id} ({self.deleted_at:%Y-%m-%d %H:%M})"
+
+
 class UserReport(models.Model):
     REPORT_TYPE_CHOICES = [
         # UC1 - Problemy ze sklepem na mapie
@@ -218,3 +289,37 @@ class UserReport(models.Model):
     @property
     def has_location(self):
         return self.shop_lat is not None and self.shop_lon is not None
+
+
+class GeocodedPlace(models.Model):
+    """Lokalny gazetteer - miejsca raz znalezione przez geocoding, żeby kolejne
+    zapytania o tę samą nazwę nie wychodziły już do Nominatim"""
+    query = models.CharField(max_length=200, unique=True, verbose_name="Znormalizowane zapytanie")
+    name = models.CharField(max_length=200, verbose_name="Nazwa")
+    display_name = models.CharField(max_length=255, blank=True, verbose_name="Pełna nazwa")
+    latitude = models.FloatField(verbose_name="Szerokość")
+    longitude = models.FloatField(verbose_name="Długość")
+    source = models.CharField(max_length=20, default='nominatim', verbose_name="Źródło")
+    # Z importu gazetteera OSM (import_places) - do rankingu podpowiedzi
+    place_type = models.CharField(max_length=20, blank=True, verbose_name="Rodzaj miejscowości")
+    population = models.PositiveIntegerField(default=0, verbose_name="Liczba mieszkańców")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Data dodania")
+
+    class Meta:
+        verbose_name = "Miejsce (geocoding)"
+        verbose_name_plural = "Miejsca (geocoding)"
+        ordering = ['name']
+        indexes = [
+            models.Index(fields=['source']),
+        ]
+
+    def __str__(self):
+        return self.display_name or self.name
+
+    def as_result(self):
+        return {
+            'city': self.name,
+            'lat': self.latitude,
+            'lon': self.longitude,
+            'display_name': self.display_name or self.name
+        }
@@ -0,0 +1,170 @@
+# dzik/product_search.py
+
+import threading
+import time
+
+from django.core.cache import cache
+
+from .gazetteer import fold
+from .models import Product
+
+# Katalog produktów jest mały i zmienia się rzadko, więc wyszukiwarka trzyma go
+# w pamięci procesu: złożone (bez diakrytyków) nazwy, smaki i kategorie, indeks
+# n-gramów do wyboru kandydatów i gotowe słowniki wyników. Zapytanie nie dotyka
+# bazy ani nie buduje odpowiedzi od nowa.
+PRODUCT_SEARCH_VERSION_KEY = 'product_search_version'
+# Co ile sekund proces sprawdza w cache, czy katalog nie zmienił się w innym procesie
+VERSION_CHECK_INTERVAL = 5
+NGRAM = 3
+
+# Waga pola razy waga dopasowania - nazwa ważniejsza od smaku, a ten od kategorii;
+# całe słowo ważniejsze od początku słowa, a ten od dowolnego fragmentu
+FIELD_WEIGHTS = (('name', 3), ('flavor', 2), ('category', 1))
+WORD_MATCH = 3
+PREFIX_MATCH = 2
+SUBSTRING_MATCH = 1
+
+
+def product_search_item(p):
+    full_name = f"DZIK® {p.name}"
+    if p.flavor:
+        full_name += f" {p.flavor}"
+
+    return {
+        'id': p.id,
+        'name': p.name,
+        'flavor': p.flavor,
+        'category': p.category,
+        'full_name': full_name.strip(),
+        'photo_url': p.get_photo_url(),
+    }
+
+
+def _ngrams(text, n):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _match_weight(token, text, words):
+    if token in words:
+        return WORD_MATCH
+    if any(word.startswith(token) for word in words):
+        return PREFIX_MATCH
+    if token in text:
+        return SUBSTRING_MATCH
+    return 0
+
+
+class ProductSearchIndex:
+    """Niezmienny indeks aktywnych produktów w kolejności katalogu (kategoria, nazwa, smak)"""
+
+    def __init__(self, products, version=None):
+        self.items = [product_search_item(p) for p in products]
+        self.fields = []
+        self.postings = {}
+        for position, p in enumerate(products):
+            fields = {
+                'name': fold(p.name),
+                'flavor': fold(p.flavor or ''),
+                'category': fold(f"{p.category.replace('_', ' ')} {p.get_category_display()}"),
+            }
+            self.fields.append({name: (text, set(text.split())) for name, text in fields.items()})
+            for text in fields.values():
+                for word in text.split():
+                    for n in range(1, NGRAM + 1):
+                        for gram in _ngrams(word, n):
+                            self.postings.setdefault(gram, set()).add(position)
+        self.version = version
+
+    def __len__(self):
+        return len(self.items)
+
+    def _candidates(self, token):
+        """Pozycje produktów, w których słowach mogą występować wszystkie n-gramy tokenu"""
+        n = min(len(token), NGRAM)
+        candidates = None
+        for gram in _ngrams(token, n):
+            postings = self.postings.get(gram)
+            if not postings:
+                return set()
+            candidates = set(postings) if candidates is None else candidates & postings
+        return candidates or set()
+
+    def search(self, query, limit):
+        """Produkty pasujące do wszystkich słów zapytania, od najlepiej dopasowanych"""
+        tokens = fold(query).split()
+        if not tokens:
+            return []
+
+        candidates = None
+        for token in tokens:
+            token_candidates = self._candidates(token)
+            candidates = token_candidates if candidates is None else candidates & token_candidates
+            if not candidates:
+                return []
+
+        ranked = []
+        for position in candidates:
+            fields = self.fields[position]
+            score = 0
+            for token in tokens:
+                best = max(
+                    weight * _match_weight(token, *fields[name]) for name, weight in FIELD_WEIGHTS
+                )
+                if best == 0:
+                    # Wszystkie n-gramy tokenu są w słowach produktu, ale nie w tej kolejności
+                    break
+                score += best
+            else:
+                ranked.append((-score, position))
+
+        ranked.sort()
+        return [self.items[position] for _, position in ranked[:limit]]
+
+
+_index = None
+_checked_at = 0.0
+_build_lock = threading.Lock()
+
+
+def product_search_version():
+    version = cache.get(PRODUCT_SEARCH_VERSION_KEY)
+    if version is None:
+        cache.add(PRODUCT_SEARCH_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(PRODUCT_SEARCH_VERSION_KEY, 0)
+    return version
+
+
+def invalidate_product_search():
+    """Po zmianie produktu - ten proces przebuduje indeks od razu, pozostałe
+    przy najbliższym sprawdzeniu wersji"""
+    global _checked_at
+    cache.set(PRODUCT_SEARCH_VERSION_KEY, time.time_ns(), None)
+    _checked_at = 0.0
+
+
+def build_product_index(version=None):
+    return ProductSearchIndex(list(Product.objects.filter(is_active=True)), version)
+
+
+def cached_product_index():
+    """Indeks procesu, jeśli nie trzeba sprawdzać jego wersji - bez I/O, więc
+    można go wołać z pętli async"""
+    if _index is not None and time.monotonic() - _checked_at < VERSION_CHECK_INTERVAL:
+        return _index
+    return None
+
+
+def get_product_index():
+    """Indeks procesu - budowany przy pierwszym użyciu i po każdej zmianie katalogu"""
+    global _index, _checked_at
+    index = cached_product_index()
+    if index is not None:
+        return index
+
+    with _build_lock:
+        if cached_product_index() is None:
+            version = product_search_version()
+            if _index is None or _index.version != version:
+                _index = build_product_index(version)
+            _checked_at = time.monotonic()
+    return _index
@@ -0,0 +1,92 @@
+# dzik/responses.py
+
+import gzip
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+try:
+    import brotli
+except ImportError:  # brotli jest opcjonalny - bez niego serwujemy gzip
+    brotli = None
+
+
+class EncodedBody:
+    """Raz zakodowana odpowiedź JSON razem z wariantami skompresowanymi i ETagiem"""
+
+    def __init__(self, body, last_modified=None, version=None, content_type='application/json'):
+        self.body = body
+        self.version = version
+        self.gzip = gzip.compress(body, compresslevel=6)
+        self.br = brotli.compress(body) if brotli else None
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.last_modified = last_modified
+        self.content_type = content_type
+
+    @classmethod
+    def from_data(cls, data, last_modified=None, version=None):
+        """Koduje dane tak samo jak JsonResponse"""
+        return cls(json.dumps(data, cls=DjangoJSONEncoder).encode('utf-8'), last_modified, version)
+
+    def pick(self, accept_encoding):
+        """Zwraca (kodowanie, bajty) najlepiej pasujące do nagłówka Accept-Encoding -
+        kodowanie z największą wagą q, a przy równych wagach br przed gzip.
+        Waga 0 oznacza, że klient kodowania nie przyjmuje (RFC 9110)."""
+        weights = accept_encoding_weights(accept_encoding)
+        default = weights.get('*', 0.0)
+        variants = [('gzip', self.gzip)]
+        if self.br is not None:
+            variants.insert(0, ('br', self.br))
+
+        best = None, self.body
+        best_weight = 0.0
+        for encoding, content in variants:
+            weight = weights.get(encoding, default)
+            if weight > best_weight:
+                best, best_weight = (encoding, content), weight
+        return best
+
+
+def accept_encoding_weights(accept_encoding):
+    """Słownik {kodowanie: q} z nagłówka Accept-Encoding - wpisy z błędną wagą są pomijane"""
+    weights = {}
+    for part in accept_encoding.split(','):
+        coding, *params = [item.strip() for item in part.split(';')]
+        if not coding:
+            continue
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    weight = None
+        if weight is not None:
+            weights[coding.lower()] = weight
+    return weights
+
+
+def encoded_response(request, encoded, cache_control='public, max-age=0, must-revalidate'):
+    """Serwuje gotowe bajty z obsługą If-None-Match / If-Modified-Since (304)"""
+    not_modified = get_conditional_response(
+        request, etag=encoded.etag, last_modified=encoded.last_modified
+    )
+    if not_modified is None:
+        encoding, content = encoded.pick(request.headers.get('Accept-Encoding', ''))
+        response = HttpResponse(content, content_type=encoded.content_type)
+        if encoding:
+            response['Content-Encoding'] = encoding
+    else:
+        response = not_modified
+
+    response['ETag'] = encoded.etag
+    if encoded.last_modified:
+        response['Last-Modified'] = http_date(encoded.last_modified)
+    response['Cache-Control'] = cache_control
+    response['Vary'] = 'Accept-Encoding'
+    return response
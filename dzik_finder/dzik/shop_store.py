@@ -0,0 +1,389 @@
+# dzik/shop_store.py
+
+import numpy as np
+
+# ShopStore.patched dopisuje napisy zmienionych sklepów na końcu tabeli, a stare
+# zostają - gdy nieużywane przekroczą ten próg i ćwierć tabeli, tabela jest przepisywana
+STRINGS_COMPACT_MIN = 1024
+
+
+class StringTable:
+    """Internowana tabela napisów - wszystkie unikalne wartości w jednym bloku UTF-8
+    z tablicą przesunięć, zamiast osobnego obiektu str na każdy sklep"""
+
+    def __init__(self, data=b'', offsets=None):
+        # data to bytes albo memoryview na zmapowany plik snapshotu
+        self.data = data
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.uint32)
+
+    def __getstate__(self):
+        # memoryview na mmap nie da się zapiklować - do cache trafia kopia bajtów
+        return {'data': bytes(self.data), 'offsets': self.offsets}
+
+    @classmethod
+    def build(cls, values):
+        """Zwraca (tabela, tablica identyfikatorów) dla listy napisów"""
+        ids = {}
+        encoded = []
+        refs = np.empty(len(values), dtype=np.uint32)
+        for i, value in enumerate(values):
+            value = value or ''
+            string_id = ids.get(value)
+            if string_id is None:
+                string_id = ids[value] = len(encoded)
+                encoded.append(value.encode('utf-8'))
+            refs[i] = string_id
+
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+        np.cumsum([len(item) for item in encoded], out=offsets[1:])
+        return cls(b''.join(encoded), offsets), refs
+
+    def extended(self, values):
+        """Zwraca (nowa tabela, identyfikatory) z dopisanymi napisami - istniejące
+        identyfikatory pozostają ważne, więc stare odwołania nie wymagają zmian"""
+        added, refs = StringTable.build(values)
+        offsets = np.concatenate([self.offsets, added.offsets[1:] + self.offsets[-1]])
+        return StringTable(bytes(self.data) + added.data, offsets), refs + np.uint32(len(self))
+
+    def compacted(self, used):
+        """Zwraca (nowa tabela, mapa starych identyfikatorów na nowe) tylko z napisami
+        zaznaczonymi w masce ``used`` - kolejność napisów się nie zmienia"""
+        string_ids = np.flatnonzero(used)
+        starts = self.offsets[string_ids].tolist()
+        ends = self.offsets[string_ids + 1].tolist()
+        offsets = np.zeros(len(string_ids) + 1, dtype=np.uint32)
+        np.cumsum([end - start for start, end in zip(starts, ends)], out=offsets[1:])
+        data = self.data
+        remap = (np.cumsum(used) - 1).astype(np.uint32)
+        return StringTable(b''.join(data[start:end] for start, end in zip(starts, ends)), offsets), remap
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, string_id):
+        start, end = self.offsets[string_id], self.offsets[string_id + 1]
+        return str(self.data[start:end], 'utf-8')
+
+    def get_many(self, string_ids):
+        data = self.data
+        starts = self.offsets[string_ids].tolist()
+        ends = self.offsets[string_ids + 1].tolist()
+        return [str(data[start:end], 'utf-8') for start, end in zip(starts, ends)]
+
+
+class ProductBitmaps:
+    """Bitmapy produktów szablonów sieci - bit i oznacza produkt ``product_ids[i]``.
+
+    Wiersz ``templates[t]`` to słowa uint64 z produktami szablonu t, a ostatni,
+    pusty wiersz odpowiada sklepom bez szablonu (template_id == -1). Filtr
+    produktów to test bitowy na kilkunastu wierszach, rzutowany potem na sklepy.
+    """
+
+    def __init__(self, templates):
+        products = {}
+        for template in templates:
+            for product in template['products']:
+                products.setdefault(product['id'], product)
+
+        self.product_ids = sorted(products)
+        self.flavors = [(products[pk]['flavor'] or '').lower() for pk in self.product_ids]
+        self.categories = [products[pk]['category'] for pk in self.product_ids]
+        bits = {pk: bit for bit, pk in enumerate(self.product_ids)}
+
+        words = max(1, (len(self.product_ids) + 63) // 64)
+        self.templates = np.zeros((len(templates) + 1, words), dtype=np.uint64)
+        for row, template in enumerate(templates):
+            for product in template['products']:
+                bit = bits[product['id']]
+                self.templates[row, bit // 64] |= np.uint64(1 << (bit % 64))
+
+    def term_bitmap(self, flavor=None, category=None):
+        """Bitmapa produktów pasujących do jednego warunku - smak zawiera frazę
+        (jak dawne flavor__icontains) albo kategoria jest równa podanej"""
+        bitmap = np.zeros(self.templates.shape[1], dtype=np.uint64)
+        for bit in range(len(self.product_ids)):
+            if (flavor is not None and flavor in self.flavors[bit]) or category == self.categories[bit]:
+                bitmap[bit // 64] |= np.uint64(1 << (bit % 64))
+        return bitmap
+
+    def matching_templates(self, flavors=(), categories=(), match_all=False):
+        """Maska wierszy szablonów (z wierszem -1 na końcu) spełniających filtr.
+        Każda fraza smaku i każda kategoria to osobny warunek; match_all=True wymaga
+        wszystkich (AND), w przeciwnym razie wystarczy dowolny (OR)."""
+        terms = ([self.term_bitmap(flavor=flavor) for flavor in flavors] +
+                 [self.term_bitmap(category=category) for category in categories])
+        if not terms:
+            return np.ones(len(self.templates), dtype=bool)
+
+        hits = np.stack([(self.templates & term).any(axis=1) for term in terms])
+        return hits.all(axis=0) if match_all else hits.any(axis=0)
+
+
+class ShopStore:
+    """Kolumnowy zbiór preloadowanych sklepów.
+
+    Zamiast listy słowników trzyma równoległe tablice: współrzędne float64,
+    identyfikatory sieci, odwołania do internowanych nazw i adresów oraz
+    indeks szablonu w tabeli ``templates``. Lista produktów i logo są
+    zapisane raz na szablon, a słownik w formacie API powstaje dopiero
+    dla sklepów, które trafiają do odpowiedzi.
+
+    ``version`` to znacznik nadawany przy preloadzie - ten sam trafia do
+    klucza ALL_SHOPS_VERSION, po którym procesy rozpoznają nowy zbiór.
+    ``last_update`` to czas ostatniej zmiany w sekundach (ALL_SHOPS_LAST_UPDATE),
+    a ``refreshed_at`` - ostatniego pełnego preloadu z bazy.
+    """
+
+    def __init__(self, lats, lons, chain_ids, name_ids, address_ids, template_ids,
+                 chains, strings, templates, shop_ids):
+        self.shop_ids = shop_ids
+        self.lats = lats
+        self.lons = lons
+        self.chain_ids = chain_ids
+        self.name_ids = name_ids
+        self.address_ids = address_ids
+        self.template_ids = template_ids
+        self.chains = chains
+        self.strings = strings
+        self.templates = templates
+        self.product_bitmaps = ProductBitmaps(templates)
+        self.version = None
+        self.last_update = None
+        self.refreshed_at = None
+
+    @classmethod
+    def build(cls, rows, templates):
+        """Buduje magazyn z krotek (name, chain, address, lat, lon, template_pk, pk)
+        i słownika payloadów szablonów {template_pk: {'products': ..., 'logo_url': ...}}"""
+        rows = list(rows)
+        template_pks = list(templates)
+        template_positions = {pk: position for position, pk in enumerate(template_pks)}
+
+        chains = []
+        chain_positions = {}
+        chain_ids = np.empty(len(rows), dtype=np.uint8)
+        template_ids = np.empty(len(rows), dtype=np.int32)
+        for i, row in enumerate(rows):
+            chain = row[1]
+            if chain not in chain_positions:
+                chain_positions[chain] = len(chains)
+                chains.append(chain)
+            chain_ids[i] = chain_positions[chain]
+            template_ids[i] = template_positions.get(row[5], -1)
+
+        strings, refs = StringTable.build(
+            [row[0] for row in rows] + [row[2] for row in rows]
+        )
+
+        return cls(
+            lats=np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows)),
+            lons=np.fromiter((row[4] for row in rows), dtype=np.float64, count=len(rows)),
+            chain_ids=chain_ids,
+            name_ids=refs[:len(rows)].copy(),
+            address_ids=refs[len(rows):].copy(),
+            template_ids=template_ids,
+            chains=chains,
+            strings=strings,
+            templates=[dict(templates[pk], id=pk) for pk in template_pks],
+            shop_ids=np.fromiter((row[6] for row in rows), dtype=np.int64, count=len(rows)),
+        )
+
+    def patched(self, rows=(), removed=(), templates=None, removed_templates=()):
+        """Zwraca (nowy magazyn, zmiany pozycji) z naniesionymi zmianami pojedynczych
+        sklepów i szablonów. Kolumny są kopiowane, a nie zmieniane w miejscu, bo
+        bieżący magazyn czytają równolegle inne wątki.
+
+        ``rows`` - krotki jak w build() dla nowych lub zmienionych sklepów,
+        ``removed`` - pk sklepów do usunięcia, ``templates`` - nowe lub zmienione
+        payloady szablonów {template_pk: payload}, ``removed_templates`` - pk
+        usuniętych szablonów, których sklepy zostają bez szablonu. Jak w build()
+        zostają tylko szablony, na które wskazuje jakiś sklep.
+
+        Zmiany to lista (pozycja, stare (lat, lon) albo None, nowe albo None)
+        w kolejności wykonania - tyle wystarcza ShopGridIndex.patched.
+        """
+        rows = list(rows)
+        changes = []
+
+        store_templates = list(self.templates)
+        template_positions = {template['id']: i for i, template in enumerate(store_templates)}
+        for pk, payload in (templates or {}).items():
+            if pk in template_positions:
+                store_templates[template_positions[pk]] = dict(payload, id=pk)
+            else:
+                template_positions[pk] = len(store_templates)
+                store_templates.append(dict(payload, id=pk))
+
+        template_ids = self.template_ids.copy()
+        for pk in removed_templates:
+            if pk in template_positions:
+                # Sam szablon wypada z tabeli przy przepisywaniu szablonów na końcu
+                template_ids[template_ids == template_positions.pop(pk)] = -1
+
+        chains = list(self.chains)
+        chain_positions = {chain: i for i, chain in enumerate(chains)}
+        for row in rows:
+            if row[1] not in chain_positions:
+                chain_positions[row[1]] = len(chains)
+                chains.append(row[1])
+
+        # Zmienione sklepy zostają na swoich pozycjach, nowe dopisujemy na końcu
+        row_pks = np.array([row[6] for row in rows], dtype=np.int64)
+        existing = np.flatnonzero(np.isin(self.shop_ids, row_pks))
+        positions_by_pk = dict(zip(self.shop_ids[existing].tolist(), existing.tolist()))
+        new_count = sum(1 for row in rows if row[6] not in positions_by_pk)
+        size = len(self) + new_count
+
+        def grown(column):
+            result = np.empty(size, dtype=column.dtype)
+            result[:len(column)] = column
+            return result
+
+        shop_ids = grown(self.shop_ids)
+        lats, lons = grown(self.lats), grown(self.lons)
+        chain_ids, template_ids = grown(self.chain_ids), grown(template_ids)
+        name_ids, address_ids = grown(self.name_ids), grown(self.address_ids)
+        strings, refs = self.strings.extended([row[0] for row in rows] + [row[2] for row in rows])
+
+        end = len(self)
+        for i, row in enumerate(rows):
+            position = positions_by_pk.get(row[6])
+            if position is None:
+                position = positions_by_pk[row[6]] = end
+                end += 1
+                changes.append((position, None, (row[3], row[4])))
+            else:
+                changes.append((position, (lats[position], lons[position]), (row[3], row[4])))
+            shop_ids[position] = row[6]
+            lats[position], lons[position] = row[3], row[4]
+            chain_ids[position] = chain_positions[row[1]]
+            template_ids[position] = template_positions.get(row[5], -1)
+            name_ids[position], address_ids[position] = refs[i], refs[len(rows) + i]
+
+        # Usunięcie przenosi ostatni sklep na zwolnioną pozycję - zmieniają się
+        # tylko dwie pozycje, a nie wszystkie kolejne
+        columns = (shop_ids, lats, lons, chain_ids, template_ids, name_ids, address_ids)
+        for pk in removed:
+            found = np.flatnonzero(shop_ids[:end] == pk)
+            if not len(found):
+                continue
+            position, last = int(found[0]), end - 1
+            changes.append((position, (lats[position], lons[position]), None))
+            if position != last:
+                changes.append((last, (lats[last], lons[last]), None))
+                changes.append((position, None, (lats[last], lons[last])))
+                for column in columns:
+                    column[position] = column[last]
+            end = last
+
+        name_ids, address_ids = name_ids[:end], address_ids[:end]
+        used = np.zeros(len(strings), dtype=bool)
+        used[name_ids] = True
+        used[address_ids] = True
+        unused = len(strings) - int(used.sum())
+        if unused > STRINGS_COMPACT_MIN and unused * 4 > len(strings):
+            strings, remap = strings.compacted(used)
+            name_ids, address_ids = remap[name_ids], remap[address_ids]
+
+        # Szablony bez sklepów (usunięte albo porzucone) wypadają, jak w świeżym
+        # build(), który dostaje tylko szablony aktywnych sklepów
+        template_ids = template_ids[:end]
+        used_templates = np.zeros(len(store_templates), dtype=bool)
+        used_templates[template_ids[template_ids >= 0]] = True
+        if not used_templates.all():
+            remap = (np.cumsum(used_templates) - 1).astype(np.int32)
+            template_ids = np.where(template_ids >= 0, remap[np.maximum(template_ids, 0)], -1).astype(np.int32)
+            store_templates = [template for template, keep in zip(store_templates, used_templates.tolist())
+                               if keep]
+
+        store = ShopStore(
+            lats=lats[:end], lons=lons[:end], chain_ids=chain_ids[:end],
+            name_ids=name_ids, address_ids=address_ids,
+            template_ids=template_ids, chains=chains, strings=strings,
+            templates=store_templates, shop_ids=shop_ids[:end],
+        )
+        return store, changes
+
+    def __len__(self):
+        return len(self.lats)
+
+    def template_pks_with_products(self, product_pks):
+        """Klucze szablonów, na których liście jest któryś z podanych produktów"""
+        product_pks = set(product_pks)
+        return [template['id'] for template in self.templates
+                if any(product['id'] in product_pks for product in template['products'])]
+
+    def template_for(self, position):
+        template_id = self.template_ids[position]
+        return self.templates[template_id] if template_id >= 0 else None
+
+    def chain_mask(self, chains):
+        """Maska sklepów należących do którejkolwiek z podanych sieci"""
+        chain_ids = [chain_id for chain_id, chain in enumerate(self.chains) if chain in chains]
+        return np.isin(self.chain_ids, chain_ids)
+
+    def template_pks_matching(self, flavors=(), categories=(), match_all=False):
+        """Klucze szablonów, których produkty spełniają filtr (patrz ProductBitmaps)"""
+        matching = self.product_bitmaps.matching_templates(flavors, categories, match_all)
+        return [template['id'] for template, ok in zip(self.templates, matching.tolist()) if ok]
+
+    def product_mask(self, flavors=(), categories=(), match_all=False):
+        """Maska sklepów, których szablon spełnia filtr produktów"""
+        matching = self.product_bitmaps.matching_templates(flavors, categories, match_all)
+        # Sklepy bez szablonu (template_id == -1) trafiają na ostatni, pusty wiersz
+        return matching[self.template_ids]
+
+    def shop(self, position):
+        """Zwraca słownik sklepu w formacie zwracanym przez API"""
+        template = self.template_for(position)
+        return {
+            'name': self.strings[self.name_ids[position]],
+            'chain': self.chains[self.chain_ids[position]],
+            'address': self.strings[self.address_ids[position]],
+            'lat': float(self.lats[position]),
+            'lon': float(self.lons[position]),
+            'products': template['products'] if template else [],
+            'logo_url': template['logo_url'] if template else None
+        }
+
+    def shops(self, positions=None, catalog=False):
+        """Zwraca słowniki sklepów dla tablicy pozycji (domyślnie wszystkich) -
+        kolumny pobierane są hurtowo, a nie element po elemencie. Z catalog=True
+        zamiast produktów i logo sklep ma template_id - klucz w /api/catalog/ -
+        oraz id, po którym klient nanosi zmiany z /api/shops/changes/."""
+        if positions is None:
+            positions = np.arange(len(self))
+        positions = np.asarray(positions, dtype=np.int64)
+
+        names = self.strings.get_many(self.name_ids[positions])
+        addresses = self.strings.get_many(self.address_ids[positions])
+        chains = [self.chains[chain_id] for chain_id in self.chain_ids[positions].tolist()]
+        templates = [self.templates[template_id] if template_id >= 0 else None
+                     for template_id in self.template_ids[positions].tolist()]
+
+        if catalog:
+            return [{
+                'id': shop_id,
+                'name': name,
+                'chain': chain,
+                'address': address,
+                'lat': lat,
+                'lon': lon,
+                'template_id': template['id'] if template else None
+            } for shop_id, name, chain, address, lat, lon, template in zip(
+                self.shop_ids[positions].tolist(), names, chains, addresses,
+                self.lats[positions].tolist(), self.lons[positions].tolist(), templates
+            )]
+
+        return [{
+            'name': name,
+            'chain': chain,
+            'address': address,
+            'lat': lat,
+            'lon': lon,
+            'products': template['products'] if template else [],
+            'logo_url': template['logo_url'] if template else None
+        } for name, chain, address, lat, lon, template in zip(
+            names, chains, addresses,
+            self.lats[positions].tolist(), self.lons[positions].tolist(), templates
+        )]
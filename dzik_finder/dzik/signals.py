@@ -0,0 +1,100 @@
+# dzik/signals.py
+
+import threading
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .changes import record_committed_changes
+from .models import OSMShop, Product, ProductShopRelation, Shop
+from .product_search import invalidate_product_search
+
+# Zmiany zbierane w obrębie transakcji (osobno dla każdego wątku) i nanoszone
+# na snapshot sklepów jednym wywołaniem po commicie
+_pending = threading.local()
+
+
+class _PendingChanges:
+    def __init__(self):
+        self.shop_pks = set()
+        self.deleted_shop_pks = set()
+        self.template_pks = set()
+        self.product_pks = set()
+        self.removed_template_pks = set()
+
+    def __call__(self):
+        if getattr(_pending, 'changes', None) is self:
+            _pending.changes = None
+        if self.shop_pks:
+            try:
+                record_committed_changes(self.shop_pks, self.deleted_shop_pks)
+            except Exception as e:
+                print(f"Błąd zapisu dziennika zmian sklepów: {e}")
+        try:
+            from .views import apply_shop_changes
+            apply_shop_changes(self.shop_pks, self.template_pks,
+                               self.product_pks, self.removed_template_pks)
+        except Exception as e:
+            print(f"Błąd aktualizacji cache sklepów: {e}")
+
+
+def _collect(kind, pks):
+    changes = getattr(_pending, 'changes', None)
+    connection = transaction.get_connection()
+    # Po rollbacku Django porzuca callbacki on_commit - wtedy zaczynamy od nowa
+    if changes is not None and not any(callback[1] is changes for callback in connection.run_on_commit):
+        changes = None
+
+    scheduled = changes is not None
+    if not scheduled:
+        changes = _pending.changes = _PendingChanges()
+    getattr(changes, kind).update(pks)
+    if not scheduled:
+        # Poza transakcją on_commit wywołuje callback od razu
+        transaction.on_commit(changes)
+
+
+@receiver(post_save, sender=OSMShop)
+def osm_shop_changed(sender, instance, **kwargs):
+    _collect('shop_pks', [instance.pk])
+
+
+@receiver(post_delete, sender=OSMShop)
+def osm_shop_deleted(sender, instance, **kwargs):
+    _collect('shop_pks', [instance.pk])
+    _collect('deleted_shop_pks', [instance.pk])
+
+
+@receiver(post_save, sender=Shop)
+def shop_template_saved(sender, instance, **kwargs):
+    _collect('template_pks', [instance.pk])
+
+
+@receiver(post_delete, sender=Shop)
+def shop_template_deleted(sender, instance, **kwargs):
+    _collect('removed_template_pks', [instance.pk])
+
+
+@receiver([post_save, post_delete], sender=ProductShopRelation)
+def product_relation_changed(sender, instance, **kwargs):
+    _collect('template_pks', [instance.shop_id])
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed(sender, instance, **kwargs):
+    _collect('product_pks', [instance.pk])
+    transaction.on_commit(invalidate_product_search)
+
+
+@receiver(m2m_changed, sender=Shop.featured_products.through)
+def featured_products_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # add()/remove() na relacji z modelem pośrednim nie wysyła post_save
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        _collect('template_pks', [instance.pk])
+    elif pk_set:
+        _collect('template_pks', pk_set)
+    else:
+        _collect('product_pks', [instance.pk])
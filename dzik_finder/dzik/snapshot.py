@@ -0,0 +1,122 @@
+# dzik/snapshot.py
+
+import json
+import mmap
+import os
+
+import numpy as np
+
+from .shop_store import ShopStore, StringTable
+from .spatial import ShopGridIndex
+
+# Plik snapshotu: MAGIC, długość nagłówka (uint64), nagłówek JSON, a dalej tablice
+# o stałej szerokości wyrównane do ALIGNMENT bajtów. Nagłówek opisuje dtype,
+# przesunięcie i długość każdej tablicy oraz małe dane (sieci, szablony).
+MAGIC = b'DZIKSNAP'
+SNAPSHOT_FORMAT = 1
+ALIGNMENT = 64
+
+STORE_ARRAYS = ('shop_ids', 'lats', 'lons', 'chain_ids', 'name_ids', 'address_ids', 'template_ids')
+INDEX_ARRAYS = ('cell_rows', 'cell_cols', 'cell_starts', 'cell_positions')
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_snapshot(store, index, path):
+    """Zapisuje magazyn sklepów i jego indeks do pliku. Plik powstaje obok docelowego
+    i podmieniany jest przez rename, więc procesy z zmapowaną starą wersją czytają
+    ją dalej, a nowe otwierają od razu kompletną nową."""
+    cell_rows, cell_cols, cell_starts, cell_positions = index.packed()
+    arrays = {name: np.ascontiguousarray(getattr(store, name)) for name in STORE_ARRAYS}
+    arrays.update({
+        'string_offsets': np.ascontiguousarray(store.strings.offsets),
+        'string_data': np.frombuffer(bytes(store.strings.data), dtype=np.uint8),
+        'cell_rows': cell_rows,
+        'cell_cols': cell_cols,
+        'cell_starts': cell_starts,
+        'cell_positions': cell_positions,
+    })
+
+    header = {
+        'format': SNAPSHOT_FORMAT,
+        'version': store.version,
+        'last_update': store.last_update,
+        'refreshed_at': store.refreshed_at,
+        'cell_size': index.cell_size,
+        'chains': store.chains,
+        'templates': store.templates,
+        'arrays': {},
+    }
+    # Przesunięcia tablic liczone są od początku danych, czyli od pierwszej
+    # wyrównanej pozycji za nagłówkiem
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = [array.dtype.str, offset, len(array)]
+        offset = _aligned(offset + array.nbytes)
+
+    encoded = json.dumps(header).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f'{path}.tmp-{os.getpid()}'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(encoded)).tobytes())
+            f.write(encoded)
+            for name, array in arrays.items():
+                f.seek(data_start + header['arrays'][name][1])
+                f.write(array.tobytes())
+            f.truncate(data_start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return data_start + offset
+
+
+def load_snapshot(path):
+    """Mapuje plik snapshotu i zwraca (store, index) albo None, gdy pliku nie ma
+    lub ma inny format. Tablice są widokami na mmap - strony pliku dzielą
+    wszystkie procesy na hoście przez page cache, a wczytanie nic nie parsuje."""
+    try:
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        return None
+    header_length = int(np.frombuffer(buffer, dtype=np.uint64, count=1, offset=len(MAGIC))[0])
+    start = len(MAGIC) + 8
+    header = json.loads(bytes(buffer[start:start + header_length]))
+    if header.get('format') != SNAPSHOT_FORMAT:
+        return None
+    data_start = _aligned(start + header_length)
+
+    def array(name):
+        dtype, offset, count = header['arrays'][name]
+        return np.frombuffer(buffer, dtype=np.dtype(dtype), count=count, offset=data_start + offset)
+
+    data_offset, data_length = header['arrays']['string_data'][1:]
+    data_offset += data_start
+    strings = StringTable(memoryview(buffer)[data_offset:data_offset + data_length], array('string_offsets'))
+
+    store = ShopStore(
+        chains=header['chains'],
+        strings=strings,
+        templates=header['templates'],
+        **{name: array(name) for name in STORE_ARRAYS}
+    )
+    store.version = header['version']
+    store.last_update = header['last_update']
+    store.refreshed_at = header['refreshed_at']
+
+    index = ShopGridIndex.unpacked(
+        store.lats, store.lons, header['cell_size'], *(array(name) for name in INDEX_ARRAYS)
+    )
+    return store, index
@@ -0,0 +1,429 @@
+# dzik/spatial.py
+
+import math
+
+import numpy as np
+
+EARTH_RADIUS = 6371000
+# Długość jednego stopnia szerokości zaniżona do 111 km - zakres w stopniach
+# liczony z tej wartości jest zawsze odrobinę szerszy niż faktyczny promień
+METERS_PER_DEGREE = 111000
+DEFAULT_CELL_SIZE = 0.1
+# Tyle pierścieni komórek przegląda najwyżej nearest, zanim przejdzie na jeden
+# wektorowy przebieg po wszystkich sklepach - punkt daleko od danych albo rzadka
+# maska nie kosztują O(pierścienie × komórki)
+NEAREST_MAX_RINGS = 16
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """Oblicza odległość w metrach między dwoma punktami używając wzoru Haversine"""
+    R = EARTH_RADIUS
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lat = math.radians(lat2 - lat1)
+    delta_lon = math.radians(lon2 - lon1)
+    a = (math.sin(delta_lat / 2) * math.sin(delta_lat / 2) +
+         math.cos(lat1_rad) * math.cos(lat2_rad) *
+         math.sin(delta_lon / 2) * math.sin(delta_lon / 2))
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    distance = R * c
+    return distance
+
+
+def bounding_box(lat, lon, radius):
+    """Zwraca (min_lat, max_lat, min_lon, max_lon) obejmujące okrąg o promieniu radius
+    albo None, gdy okrąg obejmuje biegun lub przecina południk 180°"""
+    lat_range = radius / METERS_PER_DEGREE
+    min_lat, max_lat = lat - lat_range, lat + lat_range
+    if min_lat <= -90 or max_lat >= 90:
+        return None
+
+    widest_lat = max(abs(min_lat), abs(max_lat))
+    lon_range = lat_range / math.cos(math.radians(widest_lat))
+    min_lon, max_lon = lon - lon_range, lon + lon_range
+    if min_lon < -180 or max_lon > 180:
+        return None
+
+    return min_lat, max_lat, min_lon, max_lon
+
+
+def tile_bounds(z, x, y):
+    """Zwraca (min_lat, max_lat, min_lon, max_lon) kafelka slippy map z/x/y (Web Mercator)"""
+    n = 2 ** z
+
+    def tile_lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return tile_lat(y + 1), tile_lat(y), x / n * 360 - 180, (x + 1) / n * 360 - 180
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_encode(lat, lon, precision):
+    """Koduje punkt jako geohash o podanej liczbie znaków"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    value = 0
+    bits = 0
+    even = True
+    while len(chars) < precision:
+        # Bity na przemian z długości (parzyste) i szerokości (nieparzyste)
+        coord, span = (lon, lon_range) if even else (lat, lat_range)
+        middle = (span[0] + span[1]) / 2
+        value <<= 1
+        if coord >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            value = 0
+            bits = 0
+    return ''.join(chars)
+
+
+def geohash_bounds(geohash):
+    """Zwraca (min_lat, max_lat, min_lon, max_lon) komórki geohash"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            span = lon_range if even else lat_range
+            middle = (span[0] + span[1]) / 2
+            if value >> shift & 1:
+                span[0] = middle
+            else:
+                span[1] = middle
+            even = not even
+    return lat_range[0], lat_range[1], lon_range[0], lon_range[1]
+
+
+def geohash_precision_for(radius, max_fraction=0.25):
+    """Najmniej precyzyjny geohash, którego komórka (dłuższy bok, na równiku)
+    nie przekracza max_fraction promienia - od 1 do 9 znaków"""
+    for precision in range(1, 10):
+        lon_bits = (5 * precision + 1) // 2
+        lat_bits = 5 * precision // 2
+        longest = max(360 / 2 ** lon_bits, 180 / 2 ** lat_bits) * METERS_PER_DEGREE
+        if longest <= radius * max_fraction:
+            return precision
+    return 9
+
+
+def haversine_many(lat, lon, lats, lons):
+    """Wektorowa wersja calculate_distance - odległości od punktu do tablic lats/lons"""
+    lat_rad = math.radians(lat)
+    lats_rad = np.radians(lats)
+    delta_lat = lats_rad - lat_rad
+    delta_lon = np.radians(lons - lon)
+    a = (np.sin(delta_lat / 2) ** 2 +
+         math.cos(lat_rad) * np.cos(lats_rad) * np.sin(delta_lon / 2) ** 2)
+    return EARTH_RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def order_by_distance(positions, distances, limit=None):
+    """Zwraca indeksy do tablic positions/distances posortowane po zaokrąglonej
+    odległości, a przy remisie po pozycji - tak jak stabilne sortowanie listy.
+    Przy podanym limicie wybiera top-k przez argpartition zamiast pełnego sortu."""
+    keys = np.rint(distances).astype(np.int64) * (int(positions.max(initial=0)) + 1) + positions
+    if limit is not None and limit < len(keys):
+        chosen = np.argpartition(keys, limit - 1)[:limit]
+        return chosen[np.argsort(keys[chosen])]
+    return np.argsort(keys)
+
+
+class ShopGridIndex:
+    """Indeks przestrzenny sklepów oparty o równą siatkę komórek lat/lon.
+
+    Współrzędne trzymane są w kolumnach float64, a każda komórka przechowuje
+    tablicę pozycji sklepów w tych kolumnach. Zapytanie o promień liczy
+    odległości jednym wektorowym przebiegiem, tylko dla sklepów z komórek
+    przecinających prostokąt otaczający okrąg.
+    """
+
+    def __init__(self, lats, lons, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.lats = lats
+        self.lons = lons
+        self.cells = {}
+
+        rows = np.floor(self.lats / cell_size).astype(np.int64)
+        cols = np.floor(self.lons / cell_size).astype(np.int64)
+        order = np.lexsort((cols, rows))
+        if len(order):
+            cell_rows, cell_cols = rows[order], cols[order]
+            starts = np.flatnonzero((np.diff(cell_rows) != 0) | (np.diff(cell_cols) != 0)) + 1
+            for positions in np.split(order, starts):
+                first = positions[0]
+                self.cells[(int(rows[first]), int(cols[first]))] = np.sort(positions)
+        self.bounds = self.occupied_bounds(self.cells)
+
+    @staticmethod
+    def occupied_bounds(cells):
+        """(min_row, max_row, min_col, max_col) zajętych komórek albo None dla pustego indeksu"""
+        if not cells:
+            return None
+        rows = [row for row, _ in cells]
+        cols = [col for _, col in cells]
+        return min(rows), max(rows), min(cols), max(cols)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def packed(self):
+        """Zwraca komórki jako płaskie tablice (rows, cols, starts, positions) -
+        do zapisu w pliku snapshotu"""
+        keys = sorted(self.cells)
+        chunks = [self.cells[key] for key in keys]
+        starts = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(chunk) for chunk in chunks], out=starts[1:])
+        positions = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+        rows = np.array([row for row, _ in keys], dtype=np.int64)
+        cols = np.array([col for _, col in keys], dtype=np.int64)
+        return rows, cols, starts, positions.astype(np.int64)
+
+    @classmethod
+    def unpacked(cls, lats, lons, cell_size, rows, cols, starts, positions):
+        """Odtwarza indeks z tablic z packed() bez ponownego sortowania -
+        komórki są widokami na ``positions``"""
+        index = cls.__new__(cls)
+        index.cell_size = cell_size
+        index.lats = lats
+        index.lons = lons
+        index.cells = {
+            (row, col): positions[start:end]
+            for row, col, start, end in zip(rows.tolist(), cols.tolist(), starts[:-1].tolist(), starts[1:].tolist())
+        }
+        index.bounds = cls.occupied_bounds(index.cells)
+        return index
+
+    def patched(self, lats, lons, changes):
+        """Zwraca kopię indeksu dla nowych kolumn lats/lons po zmianach pozycji
+        (pozycja, stare (lat, lon) albo None, nowe albo None) z ShopStore.patched -
+        przebudowywane są tylko komórki, których zmiany dotyczą"""
+        index = ShopGridIndex.__new__(ShopGridIndex)
+        index.cell_size = self.cell_size
+        index.lats = lats
+        index.lons = lons
+        index.cells = dict(self.cells)
+        # Granice zajętych komórek tylko rosną - po usunięciach mogą być szersze
+        # niż trzeba, co dla nearest oznacza najwyżej kilka pustych pierścieni
+        bounds = self.bounds
+
+        for position, old, new in changes:
+            if old is not None:
+                key = index.cell_for(*old)
+                positions = index.cells.get(key)
+                if positions is not None:
+                    positions = positions[positions != position]
+                    if len(positions):
+                        index.cells[key] = positions
+                    else:
+                        del index.cells[key]
+            if new is not None:
+                key = index.cell_for(*new)
+                positions = index.cells.get(key, np.empty(0, dtype=np.int64))
+                index.cells[key] = np.insert(positions, np.searchsorted(positions, position), position)
+                row, col = key
+                bounds = (row, row, col, col) if bounds is None else (
+                    min(bounds[0], row), max(bounds[1], row), min(bounds[2], col), max(bounds[3], col)
+                )
+        index.bounds = bounds if index.cells else None
+        return index
+
+    def cell_for(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def candidates(self, lat, lon, radius):
+        """Zwraca pozycje sklepów, które mogą leżeć w promieniu radius od punktu"""
+        box = bounding_box(lat, lon, radius)
+        if box is None:
+            return np.arange(len(self.lats))
+        return self.cells_in_box(*box)
+
+    def cells_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """Zwraca pozycje sklepów ze wszystkich komórek przecinających prostokąt"""
+        min_row, min_col = self.cell_for(min_lat, min_lon)
+        max_row, max_col = self.cell_for(max_lat, max_lon)
+
+        # Dla ogromnych prostokątów taniej przejrzeć istniejące komórki niż cały zakres
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cells):
+            chunks = [positions
+                      for (row, col), positions in self.cells.items()
+                      if min_row <= row <= max_row and min_col <= col <= max_col]
+        else:
+            chunks = []
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    positions = self.cells.get((row, col))
+                    if positions is not None:
+                        chunks.append(positions)
+
+        if not chunks:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(chunks)
+
+    def query_box(self, min_lat, max_lat, min_lon, max_lon):
+        """Zwraca posortowane pozycje sklepów z prostokąta [min, max) -
+        sklep na granicy dwóch prostokątów trafia tylko do jednego z nich"""
+        positions = self.cells_in_box(min_lat, max_lat, min_lon, max_lon)
+        lats, lons = self.lats[positions], self.lons[positions]
+        inside = (lats >= min_lat) & (lats < max_lat) & (lons >= min_lon) & (lons < max_lon)
+        return np.sort(positions[inside])
+
+    def distances_from(self, lat, lon, positions=None):
+        if positions is None:
+            return haversine_many(lat, lon, self.lats, self.lons)
+        return haversine_many(lat, lon, self.lats[positions], self.lons[positions])
+
+    def query_radius(self, lat, lon, radius, limit=None):
+        """Zwraca (pozycje, odległości) sklepów w promieniu radius, posortowane
+        tak samo jak liniowy skan: po zaokrąglonej odległości, a przy remisie
+        po pozycji sklepu. Limit obcina wynik do najbliższych sklepów."""
+        positions = self.candidates(lat, lon, radius)
+        distances = self.distances_from(lat, lon, positions)
+        inside = distances <= radius
+        positions, distances = positions[inside], distances[inside]
+
+        order = order_by_distance(positions, distances, limit)
+        return positions[order], distances[order]
+
+    def ring_cells(self, row, col, ring):
+        """Zwraca tablice pozycji z komórek leżących dokładnie ``ring`` komórek od (row, col)"""
+        if ring == 0:
+            positions = self.cells.get((row, col))
+            return [positions] if positions is not None else []
+
+        # Przy dużym pierścieniu taniej przejrzeć istniejące komórki
+        if 8 * ring > len(self.cells):
+            return [positions
+                    for (cell_row, cell_col), positions in self.cells.items()
+                    if max(abs(cell_row - row), abs(cell_col - col)) == ring]
+
+        chunks = []
+        for cell_col in range(col - ring, col + ring + 1):
+            for cell_row in (row - ring, row + ring):
+                positions = self.cells.get((cell_row, cell_col))
+                if positions is not None:
+                    chunks.append(positions)
+        for cell_row in range(row - ring + 1, row + ring):
+            for cell_col in (col - ring, col + ring):
+                positions = self.cells.get((cell_row, cell_col))
+                if positions is not None:
+                    chunks.append(positions)
+        return chunks
+
+    def unvisited_distance(self, lat, lon, row, col, ring):
+        """Dolne ograniczenie odległości do dowolnego sklepu spoza kwadratu komórek
+        o promieniu ``ring`` wokół (row, col) - odległość do najbliższej krawędzi"""
+        south = (row - ring) * self.cell_size
+        north = (row + ring + 1) * self.cell_size
+        west = (col - ring) * self.cell_size
+        east = (col + ring + 1) * self.cell_size
+
+        # Do równoleżnika najbliżej jest wzdłuż południka, do południka - po ortodromie
+        lat_gap = math.radians(min(lat - south, north - lat))
+        if east - west >= 360:
+            # Kwadrat obejmuje wszystkie długości - poza nim są tylko sklepy za równoleżnikami
+            return EARTH_RADIUS * lat_gap
+        # Sklepy za południkami kwadratu mogą leżeć też po drugiej stronie globu
+        lon_gap = min(lon - west, east - lon, 360 - (lon - west), 360 - (east - lon))
+        if lon_gap >= 90:
+            # Najbliższym punktem półpołudnika jest wtedy biegun
+            lon_bound = math.radians(90 - abs(lat))
+        else:
+            lon_bound = math.asin(math.sin(math.radians(lon_gap)) * math.cos(math.radians(lat)))
+        return EARTH_RADIUS * min(lat_gap, lon_bound)
+
+    def nearest(self, lat, lon, k, mask=None):
+        """Zwraca (pozycje, odległości) k najbliższych sklepów spełniających maskę.
+
+        Przeszukuje pierścienie komórek wokół punktu, od pierwszego sięgającego
+        zajętych komórek, i kończy, gdy k-ty wynik jest bliżej niż jakakolwiek
+        nieodwiedzona komórka - koszt zależy od k i lokalnej gęstości, a nie od
+        liczby sklepów w promieniu. Po NEAREST_MAX_RINGS pierścieniach albo gdy
+        pierścienie objęły więcej komórek niż ma indeks, liczy odległości do wszystkich naraz."""
+        empty = np.empty(0, dtype=np.int64)
+        if not self.cells or k <= 0:
+            return empty, np.empty(0)
+
+        row, col = self.cell_for(lat, lon)
+        min_row, max_row, min_col, max_col = self.bounds
+        first_ring = max(0, min_row - row, row - max_row, min_col - col, col - max_col)
+        last_ring = max(abs(row - min_row), abs(row - max_row), abs(col - min_col), abs(col - max_col))
+
+        found_positions, found_distances = [], []
+        found = 0
+        visited_cells = 0
+        for ring in range(first_ring, last_ring + 1):
+            visited_cells += max(1, 8 * ring)
+            if ring - first_ring >= NEAREST_MAX_RINGS or visited_cells > len(self.cells):
+                # Dalsze pierścienie nie są już tańsze od przejrzenia wszystkiego
+                return self.nearest_scan(lat, lon, k, mask)
+            for positions in self.ring_cells(row, col, ring):
+                if mask is not None:
+                    positions = positions[mask[positions]]
+                if len(positions):
+                    found_positions.append(positions)
+                    found_distances.append(self.distances_from(lat, lon, positions))
+                    found += len(positions)
+
+            if found >= k:
+                kth_distance = np.partition(np.concatenate(found_distances), k - 1)[k - 1]
+                if kth_distance <= self.unvisited_distance(lat, lon, row, col, ring):
+                    break
+
+        if not found:
+            return empty, np.empty(0)
+        positions = np.concatenate(found_positions)
+        distances = np.concatenate(found_distances)
+        order = order_by_distance(positions, distances, k)
+        return positions[order], distances[order]
+
+    def nearest_scan(self, lat, lon, k, mask=None):
+        """Wynik nearest liczony jednym wektorowym przebiegiem po wszystkich sklepach"""
+        positions = np.arange(len(self.lats)) if mask is None else np.flatnonzero(mask)
+        distances = self.distances_from(lat, lon, positions)
+        order = order_by_distance(positions, distances, k)
+        return positions[order], distances[order]
+
+
+class GridClusters:
+    """Klastry sklepów dla jednego poziomu zoom.
+
+    Sklepy grupowane są w komórki o boku ``1 / cells_per_tile`` kafelka danego
+    zoomu. Każdy klaster ma środek ciężkości, liczbę sklepów i rozbicie na sieci.
+    """
+
+    def __init__(self, lats, lons, chain_ids, chain_count, zoom, cells_per_tile=4):
+        self.zoom = zoom
+        size = 360 / 2 ** zoom / cells_per_tile
+        cells = np.stack([np.floor(lats / size), np.floor(lons / size)], axis=1)
+        if len(cells):
+            _, members = np.unique(cells, axis=0, return_inverse=True)
+            members = members.ravel()
+        else:
+            members = np.empty(0, dtype=np.int64)
+
+        cluster_count = int(members.max()) + 1 if len(members) else 0
+        self.counts = np.bincount(members, minlength=cluster_count)
+        self.lats = np.bincount(members, weights=lats, minlength=cluster_count) / np.maximum(self.counts, 1)
+        self.lons = np.bincount(members, weights=lons, minlength=cluster_count) / np.maximum(self.counts, 1)
+        self.chain_counts = np.bincount(
+            members * chain_count + chain_ids, minlength=cluster_count * chain_count
+        ).reshape(cluster_count, chain_count)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def query_radius(self, lat, lon, radius):
+        """Zwraca indeksy klastrów, których środek leży w promieniu radius, od największych"""
+        inside = np.flatnonzero(haversine_many(lat, lon, self.lats, self.lons) <= radius)
+        return inside[np.argsort(-self.counts[inside], kind='stable')]
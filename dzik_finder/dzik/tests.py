@@ -1,3 +1,1738 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import importlib
+import json
+import math
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import gazetteer, geocoding, product_search, signals, views, warmup
+from .catalog import catalog_templates, catalog_version
+from .cache_keys import SHOPS_NAMESPACE_KEY, bump_shops_namespace, shops_key, shops_namespace
+from .changes import changes_since, prune_tombstones, sync_version
+from .coalescing import cache_lock, get_or_compute, release_lock, try_lock
+from .export import database_features, store_features
+from .geocoding import GeocodingThrottled, TokenBucket, ageocode, geocode
+from .models import GeocodedPlace, OSMShop, Product, ProductShopRelation, Shop, ShopTombstone
+from .responses import EncodedBody
+from .shop_store import ShopStore
+from .snapshot import SNAPSHOT_FORMAT, load_snapshot, write_snapshot
+from .spatial import (
+    GridClusters, ShopGridIndex, calculate_distance, geohash_bounds, geohash_encode, haversine_many,
+    order_by_distance, tile_bounds
+)
+from .views import (
+    all_shops_meta, get_preloaded_shops, load_shops_from_database, parse_nearest_shops_request,
+    preload_all_shops_to_cache
+)
+from .wire import (
+    WIRE_CONTENT_TYPE, decode_deltas, decode_shops, decode_varints, encode_deltas, encode_shops, encode_varints
+)
+
+try:
+    import fakeredis
+except ImportError:  # fakeredis jest w requirements-dev.txt
+    fakeredis = None
+
+
+def create_shops(count, seed=1, bounds=(52.0, 20.8, 52.4, 21.2), templates=()):
+    """Sklepy OSM w prostokącie bounds - kolejno przypisane do podanych szablonów"""
+    rng = random.Random(seed)
+    south, west, north, east = bounds
+    return OSMShop.objects.bulk_create([
+        OSMShop(osm_id=f'node/{seed}/{i}', name=f'Sklep {i}', chain='zabka', address=f'ul. Testowa {i}',
+                latitude=round(rng.uniform(south, north), 6), longitude=round(rng.uniform(west, east), 6),
+                shop_template=templates[i % len(templates)] if templates else None)
+        for i in range(count)
+    ])
+
+
+def create_templates(count=2):
+    """Szablony sieci z produktami - szablon i ma i + 1 pierwszych produktów (Mango, Cola, Zero)"""
+    products = [
+        Product.objects.create(name='Dzik Mango', flavor='Mango', category='energy_drink'),
+        Product.objects.create(name='Dzik Cola', flavor='Cola', category='energy_drink'),
+        Product.objects.create(name='Dzik Zero', flavor='Lemon', category='zero_caffeine_drink'),
+    ]
+    templates = []
+    for i in range(count):
+        template = Shop.objects.create(name=f'Szablon {i}', chain='zabka', is_template=True)
+        ProductShopRelation.objects.bulk_create([
+            ProductShopRelation(product=product, shop=template) for product in products[:i % 3 + 1]
+        ])
+        templates.append(template)
+    return templates
+
+
+TEMPLATES = {
+    1: {'products': [{'id': 10, 'name': 'Dzik Mango', 'flavor': 'Mango', 'photo_url': None, 'category': 'energy'},
+                     {'id': 11, 'name': 'Dzik Cola', 'flavor': 'Cola', 'photo_url': None, 'category': 'cola'}],
+        'logo_url': '/media/zabka.png'},
+    2: {'products': [{'id': 11, 'name': 'Dzik Cola', 'flavor': 'Cola', 'photo_url': None, 'category': 'cola'}],
+        'logo_url': None},
+}
+
+
+def shop_rows(count, seed=1, first_pk=1):
+    """Krotki (name, chain, address, lat, lon, template_pk, pk) jak w ShopStore.build"""
+    rng = random.Random(seed)
+    return [(f'Sklep {pk}', rng.choice(['zabka', 'biedronka', 'lidl']), f'ul. Testowa {pk % 50}',
+             round(rng.uniform(52.0, 52.4), 6), round(rng.uniform(20.8, 21.2), 6),
+             rng.choice([1, 2, None]), pk)
+            for pk in range(first_pk, first_pk + count)]
+
+
+def shops_by_id(store):
+    return sorted(store.shops(catalog=True), key=lambda shop: shop['id'])
+
+
+def reset_preloaded_shops():
+    """Stan jak w świeżym procesie: pusty cache, L1 bez sklepów i bez odświeżania w tle"""
+    cache.clear()
+    for key, value in views._preloaded.items():
+        views._preloaded[key] = type(value)() if isinstance(value, dict) else None
+    views._refresh.update(thread=None, last_attempt=0.0)
+
+
+class SpatialQuerySetTests(TestCase):
+    """within_box/nearest_to na indeksie z migracji 0023 - GiST w PostgreSQL, R*Tree w SQLite.
+    Na PostgreSQL uruchamiać z profilem ustawień wskazującym na bazę PostgreSQL."""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(500)
+
+    def test_within_box_matches_plain_filter(self):
+        box = (52.1, 52.2, 20.9, 21.05)
+        indexed = set(OSMShop.objects.within_box(*box).values_list('pk', flat=True))
+        plain = set(OSMShop.objects.filter(latitude__range=box[:2], longitude__range=box[2:])
+                    .values_list('pk', flat=True))
+        self.assertTrue(plain)
+        self.assertEqual(indexed, plain)
+
+    def test_nearest_to_orders_by_distance(self):
+        lat, lon = 52.2, 21.0
+        nearest = [shop.pk for shop in OSMShop.objects.nearest_to(lat, lon)[:20]]
+        # PostgreSQL sortuje po odległości euklidesowej w stopniach (<->), inne bazy
+        # z poprawką na zbieżność południków
+        scale = 1 if connection.vendor == 'postgresql' else math.cos(math.radians(lat)) ** 2
+        expected = sorted(
+            OSMShop.objects.values_list('pk', 'latitude', 'longitude'),
+            key=lambda row: ((float(row[1]) - lat) ** 2 + (float(row[2]) - lon) ** 2 * scale, row[0])
+        )
+        self.assertEqual(nearest, [pk for pk, _, _ in expected[:20]])
+
+    def test_postgresql_uses_gist_index(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('Indeks GiST jest tylko w PostgreSQL')
+        with connection.cursor() as cursor:
+            # Przy kilkuset wierszach planer wolałby seq scan - sprawdzamy, że indeks pasuje do zapytań
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        self.assertIn('dzik_osmshop_location_gist', OSMShop.objects.within_box(52.1, 52.2, 20.9, 21.0).explain())
+        self.assertIn('dzik_osmshop_location_gist', OSMShop.objects.nearest_to(52.2, 21.0)[:10].explain())
+
+
+class ShopGridIndexNearestTests(SimpleTestCase):
+    """nearest po pierścieniach musi dawać to samo co pełny skan, także daleko od sklepów"""
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.index = ShopGridIndex(rng.uniform(49.0, 55.0, 5000), rng.uniform(14.1, 24.2, 5000))
+        self.mask = rng.random(5000) < 0.05
+
+    def assert_same_as_scan(self, lat, lon, k, mask=None):
+        positions, distances = self.index.nearest(lat, lon, k, mask)
+        expected_positions, expected_distances = self.index.nearest_scan(lat, lon, k, mask)
+        self.assertEqual(positions.tolist(), expected_positions.tolist())
+        np.testing.assert_allclose(distances, expected_distances)
+
+    def test_matches_scan_inside_and_far_from_occupied_cells(self):
+        for lat, lon in [(52.2, 21.0), (49.0, 14.1), (-60.0, -170.0), (0.0, 0.0), (89.0, 180.0)]:
+            for k in (1, 10, 50):
+                with self.subTest(lat=lat, lon=lon, k=k):
+                    self.assert_same_as_scan(lat, lon, k)
+                    self.assert_same_as_scan(lat, lon, k, self.mask)
+
+    def test_patched_index_extends_bounds(self):
+        lats = np.append(self.index.lats, -33.9)
+        lons = np.append(self.index.lons, 151.2)
+        patched = self.index.patched(lats, lons, [(5000, None, (-33.9, 151.2))])
+        positions, _ = patched.nearest(-33.8, 151.0, 1)
+        self.assertEqual(positions.tolist(), [5000])
+
+
+class NominatimStub(BaseHTTPRequestHandler):
+    """Udaje /search Nominatim: zna tylko Łódź i liczy zapytania o każdą nazwę"""
+    hits = []
+    delay = 0
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)['q'][0]
+        self.hits.append(query)
+        time.sleep(self.delay)
+        results = []
+        if query.startswith('Łódź'):
+            results = [{'lat': '51.7592', 'lon': '19.4560', 'display_name': 'Łódź, Polska'}]
+        body = json.dumps(results).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NominatimStubMixin:
+    """Lokalny NominatimStub pod DZIK_NOMINATIM_URL i czysty stan geocodingu przed każdym testem"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), NominatimStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{cls.server.server_port}/search'
+        cls.url_override = override_settings(DZIK_NOMINATIM_URL=url)
+        cls.url_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.url_override.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        NominatimStub.hits.clear()
+        NominatimStub.delay = 0
+        cache.clear()
+        geocoding._places.clear()
+        geocoding._bucket = None
+
+    def forget(self):
+        """Czyści wszystko poza bazą - jak nowy proces po wygaśnięciu cache"""
+        cache.clear()
+        geocoding._places.clear()
+
+
+@override_settings(DZIK_GEOCODE_RATE=1000)
+class GeocodingTests(NominatimStubMixin, TransactionTestCase):
+    """geocode na lokalnym serwerze udającym Nominatim (DZIK_NOMINATIM_URL)"""
+
+    def test_concurrent_lookups_make_one_upstream_call(self):
+        NominatimStub.delay = 0.3
+        results = []
+
+        def lookup():
+            try:
+                results.append(geocode('Łódź'))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=lookup) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(NominatimStub.hits), 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result == results[0] for result in results))
+
+    def test_miss_is_cached(self):
+        self.assertIsNone(geocode('Nieznane Miasto'))
+        self.assertIsNone(geocode('nieznane  miasto'))
+        self.assertEqual(len(NominatimStub.hits), 1)
+        self.assertFalse(GeocodedPlace.objects.exists())
+
+    def test_empty_bucket_throttles(self):
+        geocoding._bucket = TokenBucket(rate=0.001)
+        geocoding._bucket.tokens = 0
+        with self.assertRaises(GeocodingThrottled):
+            geocode('Łódź')
+        self.assertEqual(NominatimStub.hits, [])
+
+    def test_place_is_stored_and_reused(self):
+        place = geocode('Łódź')
+        self.assertEqual(place['lat'], 51.7592)
+        stored = GeocodedPlace.objects.get()
+        self.assertEqual(stored.query, 'lodz')
+
+        self.forget()
+        self.assertEqual(geocode('ŁÓDŹ'), place)
+        self.assertEqual(len(NominatimStub.hits), 1)
+
+
+class ShopStoreTests(SimpleTestCase):
+
+    def test_patched_matches_fresh_build(self):
+        rows = {row[6]: row for row in shop_rows(300)}
+        store = ShopStore.build(rows.values(), TEMPLATES)
+        index = ShopGridIndex(store.lats, store.lons)
+
+        changed = [('Zmieniony', 'lidl', 'ul. Nowa', 52.3, 21.1, 2, pk) for pk in (5, 150)]
+        # Po usunięciu szablonu 1 baza nie zwraca już sklepów, które na niego wskazują
+        added = [row[:5] + (None if row[5] == 1 else row[5],) + row[6:]
+                 for row in shop_rows(20, seed=2, first_pk=1000)]
+        removed = [1, 300, 77, 1005]
+        templates = {2: {'products': [], 'logo_url': '/media/lidl.png'}}
+        patched, changes = store.patched(changed + added, removed, templates, removed_templates=[1])
+        patched_index = index.patched(patched.lats, patched.lons, changes)
+
+        for row in changed + added:
+            rows[row[6]] = row
+        for pk in removed:
+            del rows[pk]
+        fresh_templates = {2: templates[2]}
+        fresh = ShopStore.build([row if row[5] != 1 else row[:5] + (None,) + row[6:] for row in rows.values()],
+                                fresh_templates)
+
+        self.assertEqual(len(patched), len(fresh))
+        self.assertEqual(shops_by_id(patched), shops_by_id(fresh))
+        self.assertEqual(catalog_templates(patched), catalog_templates(fresh))
+        self.assertEqual(catalog_version(catalog_templates(patched)), catalog_version(catalog_templates(fresh)))
+        fresh_index = ShopGridIndex(fresh.lats, fresh.lons)
+        for lat, lon in [(52.2, 21.0), (52.05, 20.85)]:
+            found, _ = patched_index.query_radius(lat, lon, 5000)
+            expected, _ = fresh_index.query_radius(lat, lon, 5000)
+            self.assertEqual(set(patched.shop_ids[found].tolist()), set(fresh.shop_ids[expected].tolist()))
+
+    def test_template_without_shops_is_dropped(self):
+        rows = [('A', 'zabka', '', 52.0, 21.0, 1, 1), ('B', 'lidl', '', 52.1, 21.1, 2, 2)]
+        store = ShopStore.build(rows, TEMPLATES)
+        patched, _ = store.patched([('A', 'zabka', '', 52.0, 21.0, 2, 1)])
+        fresh = ShopStore.build([('A', 'zabka', '', 52.0, 21.0, 2, 1), rows[1]], {2: TEMPLATES[2]})
+        self.assertEqual([template['id'] for template in patched.templates], [2])
+        self.assertEqual(patched.template_ids.tolist(), [0, 0])
+        self.assertEqual(shops_by_id(patched), shops_by_id(fresh))
+        self.assertEqual(patched.product_mask(flavors=['mango']).tolist(), [False, False])
+
+    def test_remove_moves_last_shop_into_the_gap(self):
+        store = ShopStore.build(shop_rows(5), {})
+        patched, changes = store.patched(removed=[2])
+        self.assertEqual(patched.shop_ids.tolist(), [1, 5, 3, 4])
+        self.assertEqual([(position, old is not None, new is not None) for position, old, new in changes],
+                         [(1, True, False), (4, True, False), (1, False, True)])
+
+    def test_repeated_patches_compact_strings(self):
+        store = ShopStore.build(shop_rows(1500), {})
+        for round_number in range(4):
+            rows = [(f'Nazwa {round_number} {row[6]}',) + row[1:2] + (f'Adres {round_number} {row[6]}',) + row[3:]
+                    for row in shop_rows(1500)]
+            store, _ = store.patched(rows)
+        self.assertLessEqual(len(store.strings), 2 * 3000 + 1024)
+        self.assertEqual(shops_by_id(store), shops_by_id(ShopStore.build(rows, {})))
+
+
+class ShopChangeSignalTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(10)
+
+    def test_changes_in_one_transaction_are_applied_once(self):
+        with mock.patch('dzik.views.apply_shop_changes') as apply_shop_changes:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    shops = list(OSMShop.objects.order_by('pk')[:3])
+                    pks = {shop.pk for shop in shops}
+                    for shop in shops[:2]:
+                        shop.name = 'Zmieniony'
+                        shop.save()
+                    shops[2].delete()
+        apply_shop_changes.assert_called_once()
+        self.assertEqual(set(apply_shop_changes.call_args.args[0]), pks)
+
+
+class ShopGridIndexRadiusTests(SimpleTestCase):
+    """query_radius po komórkach siatki musi dawać to samo co liniowy skan calculate_distance"""
+
+    def setUp(self):
+        self.rows = shop_rows(2000)
+        self.store = ShopStore.build(self.rows, {})
+        self.index = ShopGridIndex(self.store.lats, self.store.lons)
+
+    def linear_scan(self, lat, lon, radius):
+        distances = [(calculate_distance(lat, lon, row[3], row[4]), position)
+                     for position, row in enumerate(self.rows)]
+        inside = [(round(distance), position) for distance, position in distances if distance <= radius]
+        return [position for _, position in sorted(inside)]
+
+    def test_matches_linear_scan(self):
+        for lat, lon, radius in [(52.2, 21.0, 3000), (52.0, 20.8, 10000), (52.4, 21.3, 500), (50.0, 19.0, 1000)]:
+            with self.subTest(lat=lat, lon=lon, radius=radius):
+                positions, _ = self.index.query_radius(lat, lon, radius)
+                self.assertEqual(positions.tolist(), self.linear_scan(lat, lon, radius))
+
+    def test_limit_keeps_nearest(self):
+        positions, _ = self.index.query_radius(52.2, 21.0, 5000, limit=25)
+        full, _ = self.index.query_radius(52.2, 21.0, 5000)
+        self.assertEqual(positions.tolist(), full[:25].tolist())
+
+
+class VectorDistanceTests(SimpleTestCase):
+
+    def test_haversine_many_matches_calculate_distance(self):
+        rows = shop_rows(500)
+        lats = np.array([row[3] for row in rows])
+        lons = np.array([row[4] for row in rows])
+        for lat, lon in [(52.2, 21.0), (-33.9, 151.2), (0.0, 179.9)]:
+            expected = [calculate_distance(lat, lon, row[3], row[4]) for row in rows]
+            np.testing.assert_allclose(haversine_many(lat, lon, lats, lons), expected, rtol=1e-9)
+
+    def test_order_by_distance_breaks_ties_by_position(self):
+        positions = np.array([4, 1, 3, 0, 2])
+        distances = np.array([10.2, 5.0, 9.8, 10.4, 5.3])
+        order = order_by_distance(positions, distances)
+        # 10.2, 9.8 i 10.4 zaokrąglają się do 10 - kolejność rozstrzyga pozycja
+        self.assertEqual(positions[order].tolist(), [1, 2, 0, 3, 4])
+        self.assertEqual(positions[order_by_distance(positions, distances, 3)].tolist(), [1, 2, 0])
+
+
+class PreloadQueryTests(TestCase):
+    """Preload czyta sklepy i szablony stałą liczbą zapytań, niezależnie od ich liczby"""
+
+    def test_query_count_does_not_grow_with_shops(self):
+        templates = create_templates(2)
+        create_shops(10, templates=templates)
+        with self.assertNumQueries(3):
+            load_shops_from_database()
+
+        create_shops(40, seed=2, templates=create_templates(3))
+        with self.assertNumQueries(3):
+            store = load_shops_from_database()
+
+        self.assertEqual(len(store), 50)
+        shop = OSMShop.objects.filter(shop_template=templates[1]).first()
+        position = store.shop_ids.tolist().index(shop.pk)
+        flavors = sorted(product['flavor'] for product in store.shop(position)['products'])
+        self.assertEqual(flavors, ['Cola', 'Mango'])
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class PreloadedShopsL1Tests(TestCase):
+    """Zbiór sklepów w pamięci procesu - duży wpis z cache czytany tylko po zmianie wersji"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(30)
+
+    def setUp(self):
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+
+    def test_l1_reused_until_version_changes(self):
+        preload_all_shops_to_cache()
+        first = get_preloaded_shops()
+        with mock.patch.object(cache, 'get', wraps=cache.get) as cache_get:
+            self.assertIs(get_preloaded_shops(), first)
+        self.assertNotIn(shops_key('ALL_SHOPS_PRELOADED'), [call.args[0] for call in cache_get.call_args_list])
+
+        # Inny proces publikuje nową wersję - ten bierze ją z cache
+        published, _ = first
+        views._preloaded['shops'] = None
+        preload_all_shops_to_cache()
+        views._preloaded['shops'] = first
+        store, _ = get_preloaded_shops()
+        self.assertNotEqual(store.version, published.version)
+        self.assertEqual(store.version, cache.get(shops_key('ALL_SHOPS_VERSION')))
+
+    def test_preload_skipped_while_update_lock_is_held(self):
+        @contextmanager
+        def held_lock(key):
+            yield False
+
+        with mock.patch('dzik.views.cache_lock', held_lock):
+            self.assertEqual(preload_all_shops_to_cache(), 0)
+        self.assertIsNone(cache.get(shops_key('ALL_SHOPS_VERSION')))
+        self.assertIsNone(views._preloaded['shops'])
+
+
+class EncodedBodyPickTests(SimpleTestCase):
+    """Wybór kodowania według wag q z nagłówka Accept-Encoding"""
+
+    def setUp(self):
+        self.encoded = EncodedBody(b'{"shops": []}' * 20)
+        self.encoded.br = b'brotli'
+
+    def test_highest_weight_wins_and_br_beats_gzip_on_ties(self):
+        self.assertEqual(self.encoded.pick('gzip, br')[0], 'br')
+        self.assertEqual(self.encoded.pick('gzip;q=1.0, br;q=0.5')[0], 'gzip')
+        self.assertEqual(self.encoded.pick('*')[0], 'br')
+
+    def test_zero_weight_excludes_encoding(self):
+        self.assertEqual(self.encoded.pick('gzip, br;q=0')[0], 'gzip')
+        self.assertEqual(self.encoded.pick('br;q=0, gzip;q=0'), (None, self.encoded.body))
+        self.assertEqual(self.encoded.pick('*;q=0, identity'), (None, self.encoded.body))
+        self.assertEqual(self.encoded.pick('gzip;q=abc'), (None, self.encoded.body))
+        self.assertEqual(self.encoded.pick(''), (None, self.encoded.body))
+
+    def test_br_skipped_without_brotli(self):
+        self.encoded.br = None
+        self.assertEqual(self.encoded.pick('br, gzip;q=0.1')[0], 'gzip')
+        self.assertEqual(self.encoded.pick('br')[0], None)
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class AllShopsConditionalTests(TestCase):
+    """all_shops bez lokalizacji - ETag, 304 i kompresja gotowych bajtów"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(20)
+
+    def setUp(self):
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        preload_all_shops_to_cache()
+
+    def test_etag_and_not_modified(self):
+        response = self.client.get('/api/all-shops/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(len(json.loads(response.content)['shops']), 20)
+
+        again = self.client.get('/api/all-shops/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again['ETag'], response['ETag'])
+        self.assertEqual(again.content, b'')
+
+    def test_gzip_negotiation(self):
+        plain = self.client.get('/api/all-shops/')
+        response = self.client.get('/api/all-shops/', HTTP_ACCEPT_ENCODING='gzip, br;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertEqual(response['ETag'], plain['ETag'])
+
+        refused = self.client.get('/api/all-shops/', HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', refused)
+        self.assertEqual(refused.content, plain.content)
+
+
+def tile_for(lat, lon, z):
+    """Kafelek slippy map z/x/y zawierający punkt"""
+    n = 2 ** z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class ShopTileTests(TestCase):
+    """Kafelki /api/tiles/z/x/y/ - zawartość zgodna z granicami kafelka i zapamiętany payload"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(60)
+
+    def setUp(self):
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        preload_all_shops_to_cache()
+
+    def test_tile_contains_shops_inside_its_bounds(self):
+        z = 11
+        x, y = tile_for(52.2, 21.0, z)
+        response = self.client.get(f'/api/tiles/{z}/{x}/{y}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=300', response['Cache-Control'])
+        data = json.loads(response.content)
+        self.assertEqual(data['tile'], {'z': z, 'x': x, 'y': y})
+
+        min_lat, max_lat, min_lon, max_lon = tile_bounds(z, x, y)
+        expected = {
+            shop.name for shop in OSMShop.objects.all()
+            if min_lat <= float(shop.latitude) <= max_lat and min_lon <= float(shop.longitude) <= max_lon
+        }
+        self.assertTrue(expected)
+        self.assertEqual({shop['name'] for shop in data['shops']}, expected)
+        self.assertEqual(data['total_found'], len(expected))
+
+        # Cały świat na zoomie 0 to jeden kafelek ze wszystkimi sklepami
+        world = json.loads(self.client.get('/api/tiles/0/0/0/').content)
+        self.assertEqual(world['total_found'], 60)
+
+    def test_tile_body_memoised_and_conditional(self):
+        store, index = get_preloaded_shops()
+        x, y = tile_for(52.2, 21.0, 12)
+        self.assertIs(views.get_tile_body(store, index, 12, x, y), views.get_tile_body(store, index, 12, x, y))
+
+        response = self.client.get(f'/api/tiles/12/{x}/{y}/')
+        again = self.client.get(f'/api/tiles/12/{x}/{y}/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+    def test_invalid_tile_rejected(self):
+        for path in ('/api/tiles/3/8/0/', '/api/tiles/3/0/8/', f'/api/tiles/{views.TILE_MAX_ZOOM + 1}/0/0/'):
+            self.assertEqual(self.client.get(path).status_code, 400)
+
+
+class GridClustersTests(SimpleTestCase):
+    """Klastry dla niskiego zoomu - każdy sklep w dokładnie jednym klastrze o poprawnym środku"""
+
+    def test_clusters_match_manual_grouping(self):
+        store = ShopStore.build(shop_rows(300), TEMPLATES)
+        zoom = 9
+        clusters = GridClusters(store.lats, store.lons, store.chain_ids, len(store.chains), zoom)
+
+        size = 360 / 2 ** zoom / 4
+        groups = {}
+        for shop in store.shops():
+            cell = (math.floor(shop['lat'] / size), math.floor(shop['lon'] / size))
+            groups.setdefault(cell, []).append(shop)
+
+        self.assertEqual(len(clusters), len(groups))
+        self.assertEqual(int(clusters.counts.sum()), len(store))
+        expected = sorted(
+            (len(shops), round(sum(s['lat'] for s in shops) / len(shops), 6),
+             round(sum(s['lon'] for s in shops) / len(shops), 6))
+            for shops in groups.values()
+        )
+        actual = sorted(
+            (int(count), round(float(lat), 6), round(float(lon), 6))
+            for count, lat, lon in zip(clusters.counts, clusters.lats, clusters.lons)
+        )
+        self.assertEqual(actual, expected)
+        self.assertEqual(clusters.chain_counts.sum(axis=1).tolist(), clusters.counts.tolist())
+
+    def test_query_radius_orders_by_size(self):
+        store = ShopStore.build(shop_rows(300), TEMPLATES)
+        clusters = GridClusters(store.lats, store.lons, store.chain_ids, len(store.chains), 10)
+        selected = clusters.query_radius(52.2, 21.0, 15000)
+        self.assertTrue(len(selected))
+        counts = clusters.counts[selected].tolist()
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        distances = haversine_many(52.2, 21.0, clusters.lats[selected], clusters.lons[selected])
+        self.assertTrue((distances <= 15000).all())
+
+    def test_empty_store(self):
+        clusters = GridClusters(np.empty(0), np.empty(0), np.empty(0, dtype=np.int64), 0, 5)
+        self.assertEqual(len(clusters), 0)
+        self.assertEqual(len(clusters.query_radius(52.2, 21.0, 1000)), 0)
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='', DZIK_CLUSTER_MAX_ZOOM=10)
+class SmartShopsClusteringTests(TestCase):
+    """smart_shops poniżej DZIK_CLUSTER_MAX_ZOOM zwraca klastry, wyżej i z cluster=0 - sklepy"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(80)
+        OSMShop.objects.filter(osm_id__endswith='5').update(chain='lidl')
+
+    def setUp(self):
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        preload_all_shops_to_cache()
+
+    def test_low_zoom_returns_clusters(self):
+        data = json.loads(self.client.get('/api/smart-shops/', {
+            'lat': 52.2, 'lon': 21.0, 'zoom': 7, 'radius': 100000
+        }).content)
+        self.assertTrue(data['clustered'])
+        self.assertEqual(data['shops'], [])
+        self.assertEqual(data['total_found'], 80)
+        self.assertEqual(sum(cluster['count'] for cluster in data['clusters']), 80)
+        chains = {}
+        for cluster in data['clusters']:
+            self.assertEqual(sum(cluster['chains'].values()), cluster['count'])
+            for chain, count in cluster['chains'].items():
+                chains[chain] = chains.get(chain, 0) + count
+        self.assertEqual(chains, {'zabka': 72, 'lidl': 8})
+
+        store, _ = get_preloaded_shops()
+        self.assertIs(views.get_clusters(store, 7), views.get_clusters(store, 7))
+
+    def test_high_zoom_and_cluster_off_return_shops(self):
+        for params in ({'zoom': 10}, {'zoom': 7, 'cluster': 'false'}):
+            data = json.loads(self.client.get('/api/smart-shops/', dict(
+                params, lat=52.2, lon=21.0, radius=100000
+            )).content)
+            self.assertNotIn('clustered', data)
+            self.assertEqual(len(data['shops']), 80)
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class KnnEndpointTests(TestCase):
+    """/api/knn/ - k najbliższych sklepów z opcjonalnym filtrem sieci"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(120)
+        OSMShop.objects.filter(osm_id__endswith='7').update(chain='lidl')
+
+    def setUp(self):
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        preload_all_shops_to_cache()
+
+    def expected_distances(self, lat, lon, k, chain=None):
+        shops = OSMShop.objects.all() if chain is None else OSMShop.objects.filter(chain=chain)
+        distances = sorted(
+            (round(calculate_distance(lat, lon, float(shop.latitude), float(shop.longitude))), shop.name)
+            for shop in shops
+        )
+        return [distance for distance, _ in distances[:k]]
+
+    def test_matches_linear_scan(self):
+        data = json.loads(self.client.get('/api/knn/', {'lat': 52.21, 'lon': 21.01, 'k': 15}).content)
+        self.assertEqual(data['total_found'], 15)
+        self.assertEqual([shop['distance'] for shop in data['shops']], self.expected_distances(52.21, 21.01, 15))
+
+    def test_chain_filter(self):
+        data = json.loads(self.client.get('/api/knn/', {'lat': 52.21, 'lon': 21.01, 'k': 100,
+                                                        'chain': 'lidl'}).content)
+        self.assertEqual({shop['chain'] for shop in data['shops']}, {'lidl'})
+        self.assertEqual([shop['distance'] for shop in data['shops']],
+                         self.expected_distances(52.21, 21.01, 100, chain='lidl'))
+        self.assertEqual(data['filters']['chain'], ['lidl'])
+
+    def test_invalid_parameters(self):
+        for params in ({'lon': 21.0}, {'lat': 'x', 'lon': 21.0}, {'lat': 95, 'lon': 21.0},
+                       {'lat': 52.2, 'lon': 21.0, 'k': 0}, {'lat': 52.2, 'lon': 21.0, 'k': views.KNN_MAX_K + 1}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get('/api/knn/', params).status_code, 400)
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class ProductFilterTests(TestCase):
+    """Filtr produktów nearest_shops - każdy warunek, match=any/all, także w zimnym procesie"""
+
+    @classmethod
+    def setUpTestData(cls):
+        # Szablon 0: Mango, 1: Mango i Cola, 2: Mango, Cola i Lemon (zero_caffeine_drink)
+        cls.templates = create_templates(3)
+        create_shops(60, templates=cls.templates)
+
+    def setUp(self):
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+
+    def test_product_mask(self):
+        store = ShopStore.build([('A', 'zabka', '', 52.0, 21.0, 1, 1), ('B', 'lidl', '', 52.0, 21.0, 2, 2),
+                                 ('C', 'lidl', '', 52.0, 21.0, None, 3)], TEMPLATES)
+        self.assertEqual(store.product_mask(flavors=['mango']).tolist(), [True, False, False])
+        self.assertEqual(store.product_mask(flavors=['cola']).tolist(), [True, True, False])
+        self.assertEqual(store.product_mask(categories=['energy'], flavors=['cola']).tolist(), [True, True, False])
+        self.assertEqual(store.product_mask(categories=['energy'], flavors=['cola'], match_all=True).tolist(),
+                         [True, False, False])
+        self.assertEqual(store.template_pks_matching(flavors=['cola']), [1, 2])
+
+    def nearest_names(self, **filters):
+        response = self.client.get('/api/nearest-shops/', dict(filters, lat=52.2, lon=21.0, radius=60000))
+        self.assertEqual(response.status_code, 200)
+        return sorted(shop['name'] for shop in json.loads(response.content)['shops'])
+
+    def expected_names(self, *templates):
+        return sorted(OSMShop.objects.filter(shop_template__in=templates).values_list('name', flat=True))
+
+    def assert_filters(self):
+        first, second, third = self.templates
+        self.assertEqual(self.nearest_names(products='cola'), self.expected_names(second, third))
+        self.assertEqual(self.nearest_names(products='lemon,cola'), self.expected_names(second, third))
+        self.assertEqual(self.nearest_names(products='lemon,cola', match='all'), self.expected_names(third))
+        self.assertEqual(self.nearest_names(categories='zero_caffeine_drink', products='mango', match='all'),
+                         self.expected_names(third))
+        self.assertEqual(self.nearest_names(products='kiwi'), [])
+
+    def test_filters_with_preloaded_shops(self):
+        preload_all_shops_to_cache()
+        get_preloaded_shops()
+        self.assert_filters()
+
+    def test_cold_worker_filters_from_database(self):
+        # Bez sklepów w pamięci procesu filtr nie może czekać na preload
+        with mock.patch('dzik.views.get_preloaded_shops', side_effect=AssertionError('preload')):
+            self.assert_filters()
+
+
+class NearestCacheKeyTests(SimpleTestCase):
+    """Klucz cache nearest_shops to komórka geohash - wspólna dla bliskich punktów"""
+
+    def params(self, **query):
+        return parse_nearest_shops_request(RequestFactory().get('/api/nearest-shops/', query))
+
+    def test_geohash_encode_and_bounds(self):
+        self.assertEqual(geohash_encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        min_lat, max_lat, min_lon, max_lon = geohash_bounds(geohash_encode(52.2297, 21.0122, 6))
+        self.assertTrue(min_lat <= 52.2297 <= max_lat and min_lon <= 21.0122 <= max_lon)
+
+    def test_key_shared_within_cell_and_filter_order(self):
+        first = self.params(lat=52.22970, lon=21.01220, radius=2000, products='mango,cola', zoom=12)
+        cell = geohash_bounds(first['cell'])
+        inside = self.params(lat=(cell[0] + cell[1]) / 2, lon=(cell[2] + cell[3]) / 2, radius=2000,
+                             products='cola,mango', zoom=16, user_lat=50.0, user_lon=19.0)
+        self.assertEqual(first['cache_key'], inside['cache_key'])
+        self.assertNotEqual(first['cache_key'], self.params(lat=52.2297, lon=21.0122, radius=5000)['cache_key'])
+        self.assertNotEqual(first['cache_key'],
+                            self.params(lat=52.2297, lon=21.0122, radius=2000, products='mango')['cache_key'])
+
+
+class CoalescingTests(SimpleTestCase):
+    """get_or_compute liczy wynik raz naraz, a blokady zdejmuje tylko ich właściciel"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_concurrent_misses_compute_once(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'shops': len(calls)}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_or_compute('coalesce_test', compute, 60)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([value for value, _ in results], [{'shops': 1}] * 8)
+        self.assertEqual(sorted(cached for _, cached in results), [False] + [True] * 7)
+        self.assertIsNone(cache.get('coalesce_test_lock'))
+
+    def test_waits_for_value_computed_by_other_process(self):
+        self.assertIsNotNone(try_lock('coalesce_test_lock'))
+        threading.Timer(0.2, lambda: cache.set('coalesce_test', 'z innego procesu', 60)).start()
+        compute = mock.Mock(return_value='lokalnie')
+        self.assertEqual(get_or_compute('coalesce_test', compute, 60), ('z innego procesu', True))
+        compute.assert_not_called()
+
+    def test_refresh_skips_cached_value(self):
+        cache.set('coalesce_test', 'stary', 60)
+        self.assertEqual(get_or_compute('coalesce_test', lambda: 'nowy', 60, refresh=True), ('nowy', False))
+        self.assertEqual(cache.get('coalesce_test'), 'nowy')
+
+    def test_lock_taken_over_after_expiry_is_not_released(self):
+        def compute():
+            # Blokada wygasła w trakcie liczenia i założył ją inny proces
+            cache.set('coalesce_test_lock', 'cudzy', 30)
+            return 1
+
+        get_or_compute('coalesce_test', compute, 60)
+        self.assertEqual(cache.get('coalesce_test_lock'), 'cudzy')
+
+        with cache_lock('shared_lock') as locked:
+            self.assertTrue(locked)
+            cache.set('shared_lock', 'cudzy', 30)
+        self.assertEqual(cache.get('shared_lock'), 'cudzy')
+
+    def test_release_skipped_after_timeout(self):
+        token, acquired_at = try_lock('shared_lock', 30)
+        release_lock('shared_lock', (token, acquired_at - 31), 30)
+        self.assertEqual(cache.get('shared_lock'), token)
+        release_lock('shared_lock', (token, acquired_at), 30)
+        self.assertIsNone(cache.get('shared_lock'))
+
+    def test_nearest_cell_candidates_fetched_once(self):
+        params = parse_nearest_shops_request(
+            RequestFactory().get('/api/nearest-shops/', {'lat': 52.2297, 'lon': 21.0122, 'radius': 2000})
+        )
+        candidates = {'shops': [], 'lats': np.empty(0), 'lons': np.empty(0)}
+
+        def fetch(*args):
+            time.sleep(0.2)
+            return candidates
+
+        with mock.patch('dzik.views.fetch_nearest_candidates', side_effect=fetch) as fetch_candidates:
+            threads = [threading.Thread(target=views.get_cell_candidates, args=(params,)) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        fetch_candidates.assert_called_once()
+
+
+def fake_redis_caches():
+    """CACHES jak w settings.py dla REDIS_URL=fakeredis://"""
+    return {'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/0',
+        'KEY_PREFIX': 'dzik',
+        'OPTIONS': {'connection_class': fakeredis.FakeConnection},
+    }}
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class ShopsNamespaceTests(SimpleTestCase):
+    """Unieważnienie kluczy sklepów to zmiana przestrzeni, a nie kasowanie po wzorcu"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_bump_hides_old_keys(self):
+        namespace = shops_namespace()
+        old_key = shops_key('ALL_SHOPS_VERSION')
+        cache.set(old_key, 'v1')
+        self.assertEqual(views.clear_shops_cache(), namespace + 1)
+        self.assertNotEqual(shops_key('ALL_SHOPS_VERSION'), old_key)
+        self.assertIsNone(cache.get(shops_key('ALL_SHOPS_VERSION')))
+        self.assertEqual(cache.get(old_key), 'v1')
+
+    def test_bump_recreates_missing_namespace(self):
+        cache.delete(SHOPS_NAMESPACE_KEY)
+        namespace = bump_shops_namespace()
+        self.assertEqual(shops_namespace(), namespace)
+
+
+@skipUnless(fakeredis, 'fakeredis nie jest zainstalowany (requirements-dev.txt)')
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class RedisProfileTests(TestCase):
+    """Ścieżki cache sklepów na RedisCache (fakeredis) - pickle ShopStore, blokady i przestrzeń kluczy"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(40, templates=create_templates(2))
+
+    def setUp(self):
+        settings_override = override_settings(CACHES=fake_redis_caches())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+
+    def test_preloaded_shops_shared_through_redis(self):
+        self.assertIsInstance(caches['default'], RedisCache)
+        self.assertEqual(preload_all_shops_to_cache(), 40)
+        published = cache.get(shops_key('ALL_SHOPS_PRELOADED'))
+        self.assertEqual(shops_by_id(published), shops_by_id(load_shops_from_database()))
+
+        # Proces bez sklepów w pamięci bierze je z Redisa
+        views._preloaded['shops'] = None
+        store, _ = get_preloaded_shops()
+        self.assertEqual(store.version, cache.get(shops_key('ALL_SHOPS_VERSION')))
+        self.assertEqual(len(json.loads(self.client.get('/api/all-shops/').content)['shops']), 40)
+
+    def test_locks_and_coalescing(self):
+        with cache_lock('redis_lock') as locked:
+            self.assertTrue(locked)
+            self.assertIsNone(try_lock('redis_lock'))
+        self.assertIsNotNone(try_lock('redis_lock'))
+        self.assertEqual(get_or_compute('redis_value', lambda: [1, 2], 60), ([1, 2], False))
+        self.assertEqual(get_or_compute('redis_value', lambda: [3], 60), ([1, 2], True))
+
+    def test_namespace_bump(self):
+        preload_all_shops_to_cache()
+        namespace = shops_namespace()
+        old_key = shops_key('ALL_SHOPS_VERSION')
+        self.assertEqual(views.clear_shops_cache(), namespace + 1)
+        self.assertIsNone(cache.get(shops_key('ALL_SHOPS_VERSION')))
+        self.assertIsNotNone(cache.get(old_key))
+        self.assertEqual(views.get_cache_stats()['shops_namespace'], namespace + 1)
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class StaleWhileRevalidateTests(TransactionTestCase):
+    """Przeterminowany snapshot jest serwowany od razu, a nowy buduje jeden wątek w tle"""
+
+    def setUp(self):
+        create_shops(20)
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        preload_all_shops_to_cache()
+        self.stale, _ = get_preloaded_shops()
+
+    def join_refresh(self):
+        thread = views._refresh['thread']
+        self.assertIsNotNone(thread)
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def test_stale_snapshot_served_while_refreshing(self):
+        create_shops(5, seed=2)
+        with override_settings(DZIK_SHOPS_REFRESH_AFTER=0):
+            self.stale.refreshed_at = time.time() - 1
+            store, _ = get_preloaded_shops()
+            self.assertIs(store, self.stale)
+            self.assertEqual(len(store), 20)
+            self.join_refresh()
+
+        store, _ = get_preloaded_shops()
+        self.assertEqual(len(store), 25)
+        self.assertIsNone(cache.get(shops_key('refresh_lock')))
+
+    def test_refresh_lock_held_by_other_process(self):
+        lock = try_lock(shops_key('refresh_lock'))
+        self.assertIsNone(views.refresh_shops_in_background(force=True))
+        self.assertIsNone(views._refresh['thread'])
+        release_lock(shops_key('refresh_lock'), lock)
+        self.assertIsNotNone(views.refresh_shops_in_background(force=True))
+        self.join_refresh()
+
+    def test_failed_refresh_not_retried_immediately(self):
+        with mock.patch('dzik.views.preload_all_shops_to_cache', side_effect=RuntimeError('baza')), \
+                mock.patch('threading.excepthook'):
+            thread = views.refresh_shops_in_background(force=True)
+            thread.join(10)
+        self.assertIsNone(cache.get(shops_key('refresh_lock')))
+        self.assertIsNone(views.refresh_shops_in_background())
+        self.assertIsNotNone(views.refresh_shops_in_background(force=True))
+        self.join_refresh()
+
+    def test_refresh_does_not_release_lock_taken_over_after_expiry(self):
+        lock_key = shops_key('refresh_lock')
+
+        def slow_preload():
+            cache.set(lock_key, 'cudzy', 60)
+
+        with mock.patch('dzik.views.preload_all_shops_to_cache', side_effect=slow_preload):
+            views.refresh_shops_in_background(force=True).join(10)
+        self.assertEqual(cache.get(lock_key), 'cudzy')
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class ShopPatchPreloadTests(TestCase):
+    """Poprawki z sygnałów i pełny preload dają ten sam snapshot, także po usunięciu szablonu"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.templates = create_templates(3)
+        create_shops(30, templates=cls.templates)
+
+    def setUp(self):
+        # Zmiany z setUpTestData czekają na commit, który w TestCase nie nastąpi
+        signals._pending.changes = None
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        preload_all_shops_to_cache()
+
+    def test_removed_template_matches_fresh_preload(self):
+        removed_pk = self.templates[1].pk
+        with self.captureOnCommitCallbacks(execute=True):
+            self.templates[1].delete()
+        store, _ = get_preloaded_shops()
+        fresh = load_shops_from_database()
+        self.assertEqual(shops_by_id(store), shops_by_id(fresh))
+        self.assertEqual(catalog_templates(store), catalog_templates(fresh))
+        self.assertNotIn(removed_pk, catalog_templates(store))
+        self.assertEqual(len(catalog_templates(store)), 2)
+
+    def test_preload_rereads_database_after_concurrent_patch(self):
+        reads = []
+
+        def load():
+            reads.append(1)
+            if len(reads) == 1:
+                # Poprawka z sygnału zapisana w trakcie czytania bazy
+                cache.set(shops_key(views.SHOPS_LAST_PATCH), time.time())
+            return load_shops_from_database()
+
+        with mock.patch('dzik.views.load_shops_from_database', side_effect=load):
+            self.assertEqual(preload_all_shops_to_cache(), 30)
+        self.assertEqual(len(reads), 2)
+
+    def test_preload_publishes_after_last_attempt(self):
+        def load():
+            cache.set(shops_key(views.SHOPS_LAST_PATCH), time.time() + 1)
+            return load_shops_from_database()
+
+        version = cache.get(shops_key('ALL_SHOPS_VERSION'))
+        with mock.patch('dzik.views.load_shops_from_database', side_effect=load) as load_shops:
+            self.assertEqual(preload_all_shops_to_cache(), 30)
+        self.assertEqual(load_shops.call_count, views.PRELOAD_ATTEMPTS)
+        self.assertNotEqual(cache.get(shops_key('ALL_SHOPS_VERSION')), version)
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class WarmupTests(TransactionTestCase):
+    """Rozgrzewanie workera przed przyjęciem ruchu i probe /api/ready/"""
+
+    def setUp(self):
+        create_shops(25)
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        state = dict(warmup.warmup_state)
+        self.addCleanup(warmup.warmup_state.update, state)
+        warmup.warmup_state.update(state='cold', source=None, shops=None, version=None, error=None)
+
+    def ready(self):
+        response = self.client.get('/api/ready/')
+        return response.status_code, json.loads(response.content)
+
+    def test_cold_worker_not_ready_until_warmed_up(self):
+        status, state = self.ready()
+        self.assertEqual((status, state['state']), (503, 'cold'))
+
+        self.assertTrue(warmup.warm_up())
+        status, state = self.ready()
+        self.assertEqual((status, state['state'], state['source'], state['shops']), (200, 'ready', 'database', 25))
+        self.assertEqual(state['version'], cache.get(shops_key('ALL_SHOPS_VERSION')))
+        # Odpowiedź all_shops jest już zakodowana
+        self.assertEqual(views._preloaded['all_shops_body'].version, state['version'])
+
+    def test_warm_up_from_shared_cache(self):
+        preload_all_shops_to_cache()
+        with mock.patch('dzik.views.load_shops_from_database') as load_shops:
+            self.assertTrue(warmup.warm_up())
+        load_shops.assert_not_called()
+        self.assertEqual(warmup.warmup_state['source'], 'cache')
+
+    def test_failed_warm_up_reported(self):
+        with mock.patch('dzik.views.get_preloaded_shops', side_effect=RuntimeError('brak bazy')):
+            self.assertFalse(warmup.warm_up())
+        status, state = self.ready()
+        self.assertEqual((status, state['state'], state['error']), (503, 'failed', 'brak bazy'))
+
+    def test_ready_after_first_request_without_hook(self):
+        get_preloaded_shops()
+        status, state = self.ready()
+        self.assertEqual((status, state['source'], state['shops']), (200, 'request', 25))
+
+    def test_lifespan_startup_waits_for_warm_up(self):
+        messages = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        application = mock.AsyncMock()
+        with mock.patch('dzik.warmup.warm_up', side_effect=lambda: sent.append('warm_up')) as warm_up:
+            asyncio.run(warmup.with_lifespan(application)({'type': 'lifespan'}, receive, send))
+        warm_up.assert_called_once()
+        application.assert_not_called()
+        self.assertEqual(sent, ['warm_up', 'lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+
+class ShopSnapshotTests(SimpleTestCase):
+    """Plik snapshotu - zapis, mapowanie przez mmap i odrzucanie obcych plików"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'shops.snap')
+        self.store = ShopStore.build(shop_rows(400), TEMPLATES)
+        self.store.version, self.store.last_update, self.store.refreshed_at = 123, 1_700_000_000, 1_700_000_000
+        self.index = ShopGridIndex(self.store.lats, self.store.lons)
+
+    def test_roundtrip(self):
+        write_snapshot(self.store, self.index, self.path)
+        store, index = load_snapshot(self.path)
+        self.assertIsInstance(store.strings.data, memoryview)
+        self.assertFalse(store.lats.flags.writeable)
+        self.assertEqual((store.version, store.last_update, store.refreshed_at),
+                         (123, 1_700_000_000, 1_700_000_000))
+        self.assertEqual(store.shops(catalog=True), self.store.shops(catalog=True))
+        self.assertEqual(store.shops(), self.store.shops())
+        for lat, lon in [(52.2, 21.0), (52.05, 20.85)]:
+            found, distances = index.query_radius(lat, lon, 3000)
+            expected, expected_distances = self.index.query_radius(lat, lon, 3000)
+            self.assertEqual(found.tolist(), expected.tolist())
+            np.testing.assert_allclose(distances, expected_distances)
+
+    def test_mapped_store_can_be_patched_and_pickled(self):
+        write_snapshot(self.store, self.index, self.path)
+        store, _ = load_snapshot(self.path)
+        patched, _ = store.patched([('Nowy', 'lidl', 'ul. Nowa', 52.2, 21.0, 2, 5000)], removed=[1])
+        self.assertEqual(len(patched), 400)
+        self.assertEqual(shops_by_id(pickle.loads(pickle.dumps(store))), shops_by_id(self.store))
+
+    def test_missing_or_foreign_file(self):
+        self.assertIsNone(load_snapshot(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'cos innego')
+        self.assertIsNone(load_snapshot(self.path))
+        open(self.path, 'wb').close()
+        self.assertIsNone(load_snapshot(self.path))
+
+        with mock.patch('dzik.snapshot.SNAPSHOT_FORMAT', SNAPSHOT_FORMAT + 1):
+            write_snapshot(self.store, self.index, self.path)
+        self.assertIsNone(load_snapshot(self.path))
+
+
+class SnapshotStartupTests(TransactionTestCase):
+    """Worker z pustym cache startuje z pliku snapshotu i odświeża go w tle"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(DZIK_SHOPS_SNAPSHOT=os.path.join(directory.name, 'shops.snap'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        create_shops(20)
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+
+    def test_stale_snapshot_served_then_refreshed(self):
+        preload_all_shops_to_cache()
+        create_shops(4, seed=2)
+        # Nowy proces i pusty cache (restart Redisa) - zostaje tylko plik
+        reset_preloaded_shops()
+
+        with mock.patch('dzik.views.load_shops_from_database', wraps=views.load_shops_from_database) as load:
+            store, _ = get_preloaded_shops()
+            self.assertIsInstance(store.strings.data, memoryview)
+            self.assertEqual(len(store), 20)
+            self.assertIsNone(store.refreshed_at)
+            views._refresh['thread'].join(10)
+        load.assert_called_once()
+
+        store, _ = get_preloaded_shops()
+        self.assertEqual(len(store), 24)
+        self.assertEqual(len(load_snapshot(settings.DZIK_SHOPS_SNAPSHOT)[0]), 24)
+
+    def test_warm_up_reports_snapshot_source(self):
+        preload_all_shops_to_cache()
+        reset_preloaded_shops()
+        state = dict(warmup.warmup_state)
+        self.addCleanup(warmup.warmup_state.update, state)
+        self.assertTrue(warmup.warm_up())
+        self.assertEqual(warmup.warmup_state['source'], 'snapshot')
+        views._refresh['thread'].join(10)
+
+
+@override_settings(DZIK_GEOCODE_RATE=1000)
+class AsyncGeocodingTests(NominatimStubMixin, TransactionTestCase):
+    """ageocode i /api/async/geocode/ - httpx i asyncio.sleep zamiast requests i time.sleep"""
+
+    def setUp(self):
+        super().setUp()
+        # Ścieżka async nie może wpaść w synchroniczny klient ani limiter
+        for name in ('fetch_from_nominatim', 'wait_for_rate_limit', 'get_session'):
+            patcher = mock.patch(f'dzik.geocoding.{name}', side_effect=AssertionError(name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_concurrent_lookups_make_one_upstream_call(self):
+        NominatimStub.delay = 0.3
+        results = await asyncio.gather(*(ageocode('Łódź') for _ in range(8)))
+        self.assertEqual(len(NominatimStub.hits), 1)
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(results[0]['lat'], 51.7592)
+        self.assertEqual(await GeocodedPlace.objects.filter(query='lodz').acount(), 1)
+
+    async def test_event_loop_keeps_running_while_waiting(self):
+        NominatimStub.delay = 0.3
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        with override_settings(DZIK_GEOCODE_RATE=5):
+            await ageocode('Łódź')
+        task.cancel()
+        self.assertGreater(ticks, 10)
+
+    async def test_async_view(self):
+        response = await self.async_client.get('/api/async/geocode/', {'city': 'Łódź'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['display_name'], 'Łódź, Polska')
+
+        self.forget()
+        response = await self.async_client.get('/api/async/geocode/', {'city': 'ŁÓDŹ'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(NominatimStub.hits), 1)
+
+        response = await self.async_client.get('/api/async/geocode/', {'city': 'Nieznane'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual((await self.async_client.get('/api/async/geocode/')).status_code, 400)
+
+    async def test_empty_bucket_throttles(self):
+        geocoding._bucket = TokenBucket(rate=0.001)
+        geocoding._bucket.tokens = 0
+        response = await self.async_client.get('/api/async/geocode/', {'city': 'Łódź'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(NominatimStub.hits, [])
+
+    async def test_upstream_error(self):
+        with override_settings(DZIK_NOMINATIM_URL='http://127.0.0.1:1/search'):
+            response = await self.async_client.get('/api/async/geocode/', {'city': 'Łódź'})
+        self.assertEqual(response.status_code, 500)
+
+
+def place(name, place_type='village', population=0, lat=52.0, lon=21.0):
+    return {'key': gazetteer.fold(name), 'name': name, 'lat': lat, 'lon': lon,
+            'type': place_type, 'population': population}
+
+
+class GazetteerTests(SimpleTestCase):
+    """Złożone nazwy, dokładne wyszukiwanie i podpowiedzi po prefiksie z rankingiem"""
+
+    def test_fold(self):
+        self.assertEqual(gazetteer.fold('Łódź'), 'lodz')
+        self.assertEqual(gazetteer.fold('  Bielsko-Biała '), 'bielsko biala')
+        self.assertEqual(gazetteer.fold('ŚWINOUJŚCIE'), 'swinoujscie')
+        self.assertEqual(gazetteer.fold('St. Gallen'), 'st gallen')
+
+    def test_migration_keeps_its_own_copy_of_fold(self):
+        migration = importlib.import_module('dzik.migrations.0027_geocodedplace_fold_queries')
+        self.assertIsNot(migration.fold, gazetteer.fold)
+        for name in ('Łódź', 'Bielsko-Biała', 'Zielona Góra', 'ŻARY', 'Straße'):
+            self.assertEqual(migration.fold(name), gazetteer.fold(name))
+
+    def test_find_and_complete(self):
+        index = gazetteer.Gazetteer([
+            place('Łódź', 'city', 670000), place('Łodygowice'), place('Łomianki', 'town', 17000),
+            place('Lodowa'), place('Kraków', 'city', 800000),
+        ])
+        self.assertEqual(index.find('LODZ')['name'], 'Łódź')
+        self.assertIsNone(index.find('Łód'))
+        self.assertEqual([p['name'] for p in index.complete('ło')],
+                         ['Łódź', 'Łomianki', 'Lodowa', 'Łodygowice'])
+        self.assertEqual([p['name'] for p in index.complete('lod', limit=2)], ['Łódź', 'Lodowa'])
+        self.assertEqual(index.complete('  '), [])
+
+
+class GazetteerImportTests(TestCase):
+    """import_places -> gazetteer w pamięci procesu -> autocomplete i geocode bez Nominatim"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        gazetteer._gazetteer = None
+        self.addCleanup(setattr, gazetteer, '_gazetteer', None)
+        geocoding._places.clear()
+
+    def import_places(self, *features):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'places.geojson')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+                 'properties': dict(tags)}
+                for lat, lon, tags in features
+            ]}, f)
+        call_command('import_places', file=path, stdout=mock.Mock())
+
+    def test_import_autocomplete_and_geocode(self):
+        self.import_places(
+            (51.76, 19.46, {'name': 'Łódź', 'place': 'city', 'population': '670 000'}),
+            (52.10, 21.30, {'name': 'Łódź', 'place': 'village'}),
+            (52.35, 20.86, {'name': 'Łomianki', 'place': 'town'}),
+        )
+        self.assertEqual(GeocodedPlace.objects.filter(source='osm').count(), 2)
+
+        data = json.loads(self.client.get('/api/places/autocomplete/', {'q': 'ło'}).content)
+        self.assertEqual([p['name'] for p in data['places']], ['Łódź', 'Łomianki'])
+        self.assertEqual(data['places'][0]['population'], 670000)
+        short = self.client.get('/api/places/autocomplete/', {'q': 'ł'})
+        self.assertEqual(json.loads(short.content)['places'], [])
+        self.assertEqual(self.client.get('/api/places/autocomplete/', {'q': 'ło', 'limit': 'x'}).status_code, 400)
+
+        with mock.patch('dzik.geocoding.fetch_from_nominatim', side_effect=AssertionError('Nominatim')):
+            self.assertEqual(geocode('LODZ')['lat'], 51.76)
+
+    def test_new_import_reloads_gazetteer(self):
+        self.import_places((51.76, 19.46, {'name': 'Łódź', 'place': 'city'}))
+        self.assertEqual(len(gazetteer.get_gazetteer()), 1)
+        self.import_places((50.06, 19.94, {'name': 'Kraków', 'place': 'city'}))
+        gazetteer._checked_at = 0.0
+        self.assertEqual(gazetteer.get_gazetteer().find('krakow')['name'], 'Kraków')
+
+
+class FoldQueriesMigrationTests(TestCase):
+    """Migracja 0027 przepisuje klucze z Nominatim na fold(), nie ruszając importu OSM"""
+
+    def test_fold_queries(self):
+        migration = importlib.import_module('dzik.migrations.0027_geocodedplace_fold_queries')
+        GeocodedPlace.objects.create(query='lodz', name='Łódź', latitude=51.76, longitude=19.46, source='osm')
+        GeocodedPlace.objects.create(query='łódź', name='Łódź', latitude=51.7, longitude=19.4)
+        GeocodedPlace.objects.create(query='kraków', name='Kraków', latitude=50.06, longitude=19.94)
+        GeocodedPlace.objects.create(query='gdansk', name='Gdańsk', latitude=54.35, longitude=18.65)
+
+        migration.fold_queries(apps, None)
+        self.assertEqual(sorted(GeocodedPlace.objects.values_list('query', 'source')),
+                         [('gdansk', 'nominatim'), ('krakow', 'nominatim'), ('lodz', 'osm')])
+
+
+class ProductSearchTests(TestCase):
+    """Indeks n-gramów produktów w pamięci procesu i oba endpointy /search-products/"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for name, flavor, category in [
+            ('Dzik Mango', 'Mango', 'energy_drink'),
+            ('Dzik Zielone Jabłko', 'Jabłko', 'vitamine_drink'),
+            ('Dzik Zero', 'Mango Limonka', 'zero_caffeine_drink'),
+            ('Dzik Tropic', 'Mango Marakuja', 'energy_drink'),
+        ]:
+            Product.objects.create(name=name, flavor=flavor, category=category)
+        Product.objects.create(name='Dzik Mango Retro', flavor='Mango', is_active=False)
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        signals._pending.changes = None
+        product_search._index = None
+        product_search._checked_at = 0.0
+        self.addCleanup(setattr, product_search, '_index', None)
+
+    def names(self, query, limit=10):
+        return [p['name'] for p in product_search.get_product_index().search(query, limit)]
+
+    def test_ranking(self):
+        # Całe słowo w nazwie przed smakiem, remisy w kolejności katalogu (kategoria, nazwa)
+        self.assertEqual(self.names('mango'), ['Dzik Mango', 'Dzik Tropic', 'Dzik Zero'])
+        self.assertEqual(self.names('man'), ['Dzik Mango', 'Dzik Tropic', 'Dzik Zero'])
+        self.assertEqual(self.names('dzik man'), ['Dzik Mango', 'Dzik Tropic', 'Dzik Zero'])
+        self.assertEqual(self.names('mango', limit=1), ['Dzik Mango'])
+        self.assertEqual(self.names('mango zero'), ['Dzik Zero'])
+
+    def test_folding_and_fields(self):
+        self.assertEqual(self.names('JABLKO'), ['Dzik Zielone Jabłko'])
+        self.assertEqual(self.names('jabłko'), ['Dzik Zielone Jabłko'])
+        self.assertEqual(self.names('vitamine'), ['Dzik Zielone Jabłko'])
+        self.assertEqual(self.names('caffeine'), ['Dzik Zero'])
+        self.assertEqual(self.names('araku'), ['Dzik Tropic'])
+        self.assertEqual(self.names('retro'), [])
+        self.assertEqual(self.names('kiwi'), [])
+        self.assertEqual(self.names('   '), [])
+
+    def test_index_follows_product_changes(self):
+        self.assertEqual(self.names('kiwi'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name='Dzik Kiwi', flavor='Kiwi', category='energy_drink')
+        self.assertEqual(self.names('kiwi'), ['Dzik Kiwi'])
+
+    def test_endpoints(self):
+        for url in ('/api/search-products/', '/api/async/search-products/'):
+            with self.subTest(url=url):
+                data = json.loads(self.client.get(url, {'q': 'zielone'}).content)
+                self.assertEqual([p['full_name'] for p in data['products']],
+                                 ['DZIK® Dzik Zielone Jabłko Jabłko'])
+                self.assertEqual(set(data['products'][0]), {'id', 'name', 'flavor', 'category', 'full_name',
+                                                            'photo_url'})
+                self.assertEqual(json.loads(self.client.get(url, {'q': 'z'}).content), {'products': []})
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class ExportShopsTests(TestCase):
+    """Strumieniowy eksport GeoJSON/NDJSON - treść, paczki, ETag i gzip"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(25, templates=create_templates(2))
+        create_shops(5, seed=2)
+
+    def setUp(self):
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        preload_all_shops_to_cache()
+
+    def export(self, **params):
+        response = self.client.get('/api/shops/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def test_geojson(self):
+        response, body = self.export()
+        self.assertEqual(response['Content-Type'], 'application/geo+json')
+        data = json.loads(body)
+        self.assertEqual(data['type'], 'FeatureCollection')
+        self.assertEqual(data['metadata']['total_found'], 30)
+        self.assertEqual(len(data['features']), 30)
+
+        shops = {shop.pk: shop for shop in OSMShop.objects.select_related('shop_template')}
+        for feature in data['features']:
+            shop = shops[feature['id']]
+            self.assertEqual(feature['geometry']['coordinates'], [float(shop.longitude), float(shop.latitude)])
+            self.assertEqual(feature['properties']['name'], shop.name)
+            expected = [] if shop.shop_template is None else sorted(
+                shop.shop_template.products.values_list('name', flat=True))
+            self.assertEqual(sorted(p['name'] for p in feature['properties']['products']), expected)
+
+    def test_ndjson_without_products(self):
+        response, body = self.export(format='ndjson', products='0', download='1')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="dzik-shops.ndjson"')
+        lines = body.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 30)
+        features = [json.loads(line) for line in lines]
+        self.assertTrue(all('products' not in feature['properties'] for feature in features))
+        self.assertEqual({feature['id'] for feature in features},
+                         set(OSMShop.objects.values_list('pk', flat=True)))
+
+    def test_chunks_match_database_export(self):
+        store, _ = get_preloaded_shops()
+        chunks = list(store_features(store, chunk_size=7))
+        self.assertEqual([len(chunk) for chunk in chunks], [7, 7, 7, 7, 2])
+        from_store = sorted(map(json.loads, sum(chunks, [])), key=lambda feature: feature['id'])
+        from_database = [json.loads(f) for chunk in database_features(chunk_size=7) for f in chunk]
+        self.assertEqual(from_store, from_database)
+
+    def test_etag_gzip_and_bad_format(self):
+        response, body = self.export()
+        self.assertNotIn('Content-Encoding', response)
+        again = self.client.get('/api/shops/export/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        other_format = self.client.get('/api/shops/export/', {'format': 'ndjson'},
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(other_format.status_code, 200)
+
+        compressed = self.client.get('/api/shops/export/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(compressed.streaming_content)), body)
+
+        self.assertEqual(self.client.get('/api/shops/export/', {'format': 'csv'}).status_code, 400)
+
+    async def test_async_export_matches_sync(self):
+        _, body = await sync_to_async(self.export)(format='ndjson')
+        response = await self.async_client.get('/api/async/shops/export/', {'format': 'ndjson'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), body)
+
+
+class WireFormatTests(SimpleTestCase):
+    """Binarny format listy sklepów - varinty, różnice i dekoder referencyjny"""
+
+    def setUp(self):
+        self.store = ShopStore.build(shop_rows(200), TEMPLATES)
+        self.store.last_update = 1_700_000_000
+
+    def test_varints_and_deltas_round_trip(self):
+        values = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 35, 2 ** 63 - 1]
+        self.assertEqual(encode_varints([0, 127, 128, 300]), bytes([0, 127, 0x80, 1, 0xAC, 2]))
+        self.assertEqual(decode_varints(encode_varints(values), len(values)).tolist(), values)
+        self.assertEqual(encode_varints([]), b'')
+
+        coords = [52_229_676, 52_229_670, 50_061_947, -1, 0, 180_000_000]
+        self.assertEqual(decode_deltas(encode_deltas(coords), len(coords)).tolist(), coords)
+
+    def test_decoded_binary_equals_json(self):
+        meta = all_shops_meta(self.store)
+        decoded = decode_shops(encode_shops(self.store, meta=meta))
+        self.assertEqual(decoded, dict(meta, shops=self.store.shops()))
+
+    def test_decoded_catalog_subset_with_extra_column(self):
+        positions = np.array([7, 3, 150])
+        decoded = decode_shops(encode_shops(self.store, positions, {'distance': [10, 0, 2500]}, catalog=True))
+        expected = self.store.shops(positions, catalog=True)
+        for shop, distance in zip(expected, [10, 0, 2500]):
+            shop['distance'] = distance
+        self.assertEqual(decoded['shops'], expected)
+
+    def test_empty_selection_and_bad_magic(self):
+        decoded = decode_shops(encode_shops(self.store, np.array([], dtype=np.int64), meta={'total_found': 0}))
+        self.assertEqual(decoded, {'total_found': 0, 'shops': []})
+        with self.assertRaises(ValueError):
+            decode_shops(b'{"shops": []}')
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='', DZIK_CLUSTER_MAX_ZOOM=10)
+class WireEndpointTests(TestCase):
+    """format=bin i Accept: application/x-dzik-shops w all_shops i smart_shops"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(40, templates=create_templates(2))
+
+    def setUp(self):
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        preload_all_shops_to_cache()
+
+    def assertBinaryEqualsJson(self, url, params):
+        data = json.loads(self.client.get(url, params).content)
+        self.assertTrue(data['shops'])
+        response = self.client.get(url, dict(params, format='bin'))
+        self.assertEqual(response['Content-Type'], WIRE_CONTENT_TYPE)
+        self.assertIn('Accept', response['Vary'])
+        self.assertEqual(decode_shops(response.content), data)
+
+        negotiated = self.client.get(url, params, HTTP_ACCEPT=WIRE_CONTENT_TYPE)
+        self.assertEqual(negotiated.content, response.content)
+
+    def test_all_shops(self):
+        self.assertBinaryEqualsJson('/api/all-shops/', {})
+        self.assertBinaryEqualsJson('/api/all-shops/', {'catalog': '1'})
+
+    def test_smart_shops(self):
+        for url in ('/api/smart-shops/', '/api/async/smart-shops/'):
+            with self.subTest(url=url):
+                self.assertBinaryEqualsJson(url, {'lat': 52.2, 'lon': 21.0, 'zoom': 12, 'radius': 15000})
+
+    def test_clusters_stay_json(self):
+        response = self.client.get('/api/smart-shops/', {
+            'lat': 52.2, 'lon': 21.0, 'zoom': 7, 'radius': 100000, 'format': 'bin'
+        })
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertTrue(json.loads(response.content)['clustered'])
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class ShopCatalogTests(TestCase):
+    """catalog=1 i /api/catalog/ - wersja katalogu to skrót treści szablonów"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.templates = create_templates(3)
+        create_shops(30, templates=cls.templates)
+        create_shops(5, seed=2)
+
+    def setUp(self):
+        signals._pending.changes = None
+        self.reload()
+        self.addCleanup(reset_preloaded_shops)
+
+    def reload(self):
+        reset_preloaded_shops()
+        preload_all_shops_to_cache()
+        return json.loads(self.client.get('/api/all-shops/', {'catalog': '1'}).content)
+
+    def test_catalog_resolves_to_full_output(self):
+        compact = json.loads(self.client.get('/api/all-shops/', {'catalog': '1'}).content)
+        full = json.loads(self.client.get('/api/all-shops/').content)
+        catalog = json.loads(self.client.get('/api/catalog/', {'v': compact['catalog_version']}).content)
+        self.assertEqual(catalog['version'], compact['catalog_version'])
+        self.assertEqual(catalog['total_templates'], 3)
+
+        resolved = []
+        for shop in compact['shops']:
+            self.assertNotIn('products', shop)
+            template = catalog['templates'].get(str(shop.pop('template_id')))
+            shop.pop('id')
+            shop['products'] = template['products'] if template else []
+            shop['logo_url'] = template['logo_url'] if template else None
+            resolved.append(shop)
+        self.assertEqual(sorted(map(json.dumps, resolved)), sorted(map(json.dumps, full['shops'])))
+
+    def test_cache_control_and_not_modified(self):
+        version = json.loads(self.client.get('/api/catalog/').content)['version']
+        versioned = self.client.get('/api/catalog/', {'v': version})
+        self.assertIn('immutable', versioned['Cache-Control'])
+        self.assertIn('must-revalidate', self.client.get('/api/catalog/', {'v': 'stara'})['Cache-Control'])
+        again = self.client.get('/api/catalog/', {'v': version}, HTTP_IF_NONE_MATCH=versioned['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+    def test_version_follows_template_content_only(self):
+        version = self.reload()['catalog_version']
+        OSMShop.objects.filter(osm_id='node/1/0').update(latitude=52.3, name='Nowa nazwa')
+        self.assertEqual(self.reload()['catalog_version'], version)
+
+        ProductShopRelation.objects.create(
+            product=Product.objects.create(name='Dzik Kiwi', flavor='Kiwi'), shop=self.templates[0]
+        )
+        changed = self.reload()['catalog_version']
+        self.assertNotEqual(changed, version)
+        self.assertEqual(changed, json.loads(self.client.get('/api/catalog/').content)['version'])
+
+    def test_nearest_shops_reports_catalog_version(self):
+        version = json.loads(self.client.get('/api/catalog/').content)['version']
+        for url in ('/api/nearest-shops/', '/api/async/nearest-shops/'):
+            with self.subTest(url=url):
+                data = json.loads(self.client.get(url, {'lat': 52.2, 'lon': 21.0, 'catalog': '1'}).content)
+                self.assertEqual(data['catalog_version'], version)
+                self.assertTrue(data['shops'])
+                self.assertTrue(all('template_id' in shop and 'products' not in shop for shop in data['shops']))
+
+
+@override_settings(DZIK_SHOPS_SNAPSHOT='')
+class ShopChangesTests(TestCase):
+    """Synchronizacja przyrostowa - last_updated z czasem commitu, nagrobki i /api/shops/changes/"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_shops(10)
+        # Sklepy sprzed okna SYNC_OVERLAP_MS - w zmianach pojawia się tylko to, co zmienia test
+        OSMShop.objects.update(last_updated=timezone.now() - datetime.timedelta(hours=1))
+
+    def setUp(self):
+        signals._pending.changes = None
+        reset_preloaded_shops()
+        self.addCleanup(reset_preloaded_shops)
+        preload_all_shops_to_cache()
+
+    def test_changes_since_replay_matches_fresh_shops(self):
+        client_shops = {shop['id']: shop for shop in load_shops_from_database().shops(catalog=True)}
+        since = sync_version(timezone.now())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                shops = list(OSMShop.objects.order_by('pk')[:4])
+                shops[0].name = 'Zmieniony'
+                shops[0].save()
+                shops[1].delete()
+                shops[2].is_active = False
+                shops[2].save()
+                OSMShop.objects.create(osm_id='node/new', name='Nowy', chain='lidl', address='ul. Nowa',
+                                       latitude=52.1, longitude=21.1)
+
+        changes = changes_since(since)
+        for shop in changes['upserts']:
+            client_shops[shop['id']] = shop
+        for pk in changes['deletes']:
+            client_shops.pop(pk, None)
+
+        expected = shops_by_id(load_shops_from_database())
+        self.assertEqual(sorted(client_shops.values(), key=lambda shop: shop['id']), expected)
+
+    def test_commit_time_and_tombstones(self):
+        since = sync_version(timezone.now())
+        changed, deleted = OSMShop.objects.order_by('pk')[:2]
+        deleted_pk = deleted.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            changed.name = 'Zmieniony'
+            changed.save()
+            deleted.delete()
+        committed = OSMShop.objects.get(pk=changed.pk).last_updated
+        tombstone = ShopTombstone.objects.get()
+        self.assertEqual((tombstone.shop_id, tombstone.deleted_at), (deleted_pk, committed))
+
+        changes = changes_since(since)
+        self.assertEqual([shop['id'] for shop in changes['upserts']], [changed.pk])
+        self.assertEqual(changes['deletes'], [deleted_pk])
+
+        ShopTombstone.objects.update(deleted_at=timezone.now() - datetime.timedelta(days=31))
+        self.assertEqual(prune_tombstones(), 1)
+
+    def test_endpoint(self):
+        since = sync_version(timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            OSMShop.objects.order_by('pk').first().delete()
+        response = self.client.get('/api/shops/changes/', {'since': since})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual((data['total_upserts'], data['total_deletes']), (0, 1))
+        self.assertGreaterEqual(data['version'], since)
+        self.assertIn('catalog_version', data)
+
+        # Wersja z przyszłości liczy się jak bieżąca
+        future = json.loads(self.client.get('/api/shops/changes/', {'since': since + 3_600_000}).content)
+        self.assertEqual(future['since'], future['version'])
+
+    def test_bad_and_stale_versions(self):
+        for params in ({}, {'since': 'wczoraj'}):
+            self.assertEqual(self.client.get('/api/shops/changes/', params).status_code, 400)
+
+        stale = self.client.get('/api/shops/changes/', {'since': 0})
+        self.assertEqual(stale.status_code, 410)
+        self.assertTrue(json.loads(stale.content)['reset'])
+
+        with mock.patch('dzik.changes.SYNC_MAX_CHANGES', 3):
+            since = sync_version(timezone.now() - datetime.timedelta(hours=2))
+            self.assertEqual(self.client.get('/api/shops/changes/', {'since': since}).status_code, 410)
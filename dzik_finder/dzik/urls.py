@@ -1,13 +1,20 @@
 # dzik/urls.py
 from django.urls import path
-from . import views
+from . import async_views, views
 
 urlpatterns = [
     path('nearest-shops/', views.nearest_shops, name='nearest_shops'),
     path('all-shops/', views.all_shops, name='all_shops'),
     path('smart-shops/', views.smart_shops, name='smart_shops'),
+    path('shops/export/', views.export_shops, name='export_shops'),
+    path('shops/changes/', views.shop_changes, name='shop_changes'),
+    path('catalog/', views.shop_catalog, name='shop_catalog'),
+    path('tiles/<int:z>/<int:x>/<int:y>/', views.shop_tile, name='shop_tile'),
+    path('knn/', views.knn_shops, name='knn_shops'),
+    path('ready/', views.readiness, name='readiness'),
     path('force-preload/', views.force_preload_cache, name='force_preload'),
     path('geocode/', views.geocode_city, name='geocode_city'),
+    path('places/autocomplete/', views.autocomplete_places, name='autocomplete_places'),
     path('multi-select-products/', views.multi_product_selector, name='multi_product_selector'),
     path('multi-select-shops/', views.multi_shop_selector, name='multi_shop_selector'),
     path('toggle-product/', views.toggle_product, name='toggle_product'),
@@ -15,6 +22,13 @@ urlpatterns = [
     path('stats/', views.get_platform_stats, name='platform_stats'),
     path('search-products/', views.search_products, name='search_products'),
 
+    # Asynchroniczne wersje gorących endpointów dla wdrożenia ASGI
+    path('async/smart-shops/', async_views.smart_shops, name='async_smart_shops'),
+    path('async/nearest-shops/', async_views.nearest_shops, name='async_nearest_shops'),
+    path('async/geocode/', async_views.geocode_city, name='async_geocode_city'),
+    path('async/search-products/', async_views.search_products, name='async_search_products'),
+    path('async/shops/export/', async_views.export_shops, name='async_export_shops'),
+
     # USUŃ "api/" z początku - już jest w głównym urls.py
     path('csrf-token/', views.csrf_token_view, name='csrf_token'),
     path('submit-report/', views.submit_report, name='submit_report'),
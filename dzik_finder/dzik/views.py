@@ -1,20 +1,47 @@
 # dzik/views.py
 
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.core.cache import cache
 from django.shortcuts import render, redirect
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
-from django.db.models import Q
+from django.db import connection
 from django.views.decorators.http import require_http_methods
 from django.template.loader import render_to_string
 from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.text import compress_sequence
+import httpx
 import requests
+import hashlib
 import json
 import math
+import os
+import threading
 import time
+from collections import OrderedDict
+import numpy as np
+from .cache_keys import bump_shops_namespace, shops_key, shops_namespace
+from .catalog import CATALOG_MAX_AGE, build_catalog
+from .changes import SyncReset, changes_since, prune_tombstones
+from .coalescing import cache_lock, get_or_compute, release_lock, try_lock
+from .export import EXPORT_FORMATS, encode_stream, store_features
+from .gazetteer import AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT, get_gazetteer
+from .geocoding import GeocodingThrottled, geocode
 from .models import Shop, Product, ProductShopRelation, OSMShop, UserReport
+from .product_search import get_product_index
+from .responses import EncodedBody, encoded_response
+from .shop_store import ProductBitmaps, ShopStore
+from .snapshot import load_snapshot, write_snapshot
+from .spatial import (
+    GridClusters, ShopGridIndex, bounding_box, calculate_distance, geohash_bounds, geohash_encode,
+    geohash_precision_for, haversine_many, order_by_distance, tile_bounds
+)
+from .warmup import warmup_state
+from .wire import WIRE_CONTENT_TYPE, encode_shops
 from django.views.decorators.csrf import ensure_csrf_cookie
 
 
@@ -61,125 +88,601 @@ def calculateDynamicRadius(zoom):
     return 10_000_000
 
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Oblicza odległość w metrach między dwoma punktami używając wzoru Haversine"""
-    R = 6371000
-    lat1_rad = math.radians(lat1)
-    lat2_rad = math.radians(lat2)
-    delta_lat = math.radians(lat2 - lat1)
-    delta_lon = math.radians(lon2 - lon1)
-    a = (math.sin(delta_lat / 2) * math.sin(delta_lat / 2) +
-         math.cos(lat1_rad) * math.cos(lat2_rad) *
-         math.sin(delta_lon / 2) * math.sin(delta_lon / 2))
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    distance = R * c
-    return distance
+# L1 - zdeserializowany zbiór sklepów i jego indeks przestrzenny trzymane w pamięci procesu.
+# Przy każdym requeście sprawdzany jest tylko mały klucz ALL_SHOPS_VERSION. Gdy wersja się
+# zmieni, proces nanosi na swój zbiór rekordy poprawek (ALL_SHOPS_PATCH_<wersja>), a duży
+# ALL_SHOPS_PRELOADED pobiera z cache dopiero, gdy łańcuch poprawek się urwie.
+# Oba leżą w przestrzeni kluczy sklepów (cache_keys), więc jej unieważnienie
+# wymusza u wszystkich workerów ponowny preload.
+_preloaded = {'shops': None, 'all_shops_body': None, 'all_shops_binary': None, 'all_shops_catalog': None,
+              'all_shops_catalog_binary': None, 'catalog': None, 'tiles': OrderedDict(), 'clusters': {},
+              'missed_version': None}
 
 
-def preload_all_shops_to_cache():
-    """Ładuje wszystkie sklepy do cache w tle"""
+def set_preloaded_shops(store, index=None):
+    """Podmienia zbiór sklepów w pamięci procesu - para (store, index) zmienia się atomowo"""
+    if index is None:
+        index = ShopGridIndex(store.lats, store.lons)
+    _preloaded['shops'] = (store, index)
+    _preloaded['tiles'] = OrderedDict()
+    _preloaded['clusters'] = {}
+
+
+# Snapshot sklepów jest świeży przez DZIK_SHOPS_REFRESH_AFTER sekund, ale leży w cache
+# dłużej (SHOPS_CACHE_TIMEOUT) - po tym czasie nadal jest serwowany, a nowy buduje
+# w tle jeden wątek jednego procesu (stale-while-revalidate)
+SHOPS_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+REFRESH_LOCK_TIMEOUT = 10 * 60
+REFRESH_RETRY_SECONDS = 30
+COLD_START_WAIT = 60
+
+_refresh = {'thread': None, 'last_attempt': 0.0}
+_refresh_lock = threading.Lock()
+
+
+def shops_are_stale(store):
+    return store.refreshed_at is None or time.time() - store.refreshed_at > settings.DZIK_SHOPS_REFRESH_AFTER
+
+
+def _refresh_worker(lock_key, lock):
+    try:
+        preload_all_shops_to_cache()
+    finally:
+        release_lock(lock_key, lock, REFRESH_LOCK_TIMEOUT)
+        # Wątek ma własne połączenie z bazą - zamykamy je, żeby nie wisiało
+        connection.close()
+
+
+def refresh_shops_in_background(force=False):
+    """Uruchamia preload w wątku tła i zwraca ten wątek albo None, gdy odświeżanie
+    już trwa w innym procesie lub ostatnia próba była przed chwilą (chyba że force).
+
+    W procesie pilnuje tego _refresh_lock, między procesami blokada w cache
+    zakładana przez try_lock - snapshot buduje naraz tylko jeden worker.
+    """
+    with _refresh_lock:
+        thread = _refresh['thread']
+        if thread is not None and thread.is_alive():
+            return thread
+
+        now = time.monotonic()
+        if not force and now - _refresh['last_attempt'] < REFRESH_RETRY_SECONDS:
+            return None
+        _refresh['last_attempt'] = now
+
+        lock_key = shops_key('refresh_lock')
+        lock = try_lock(lock_key, REFRESH_LOCK_TIMEOUT)
+        if lock is None:
+            return None
+
+        thread = threading.Thread(target=_refresh_worker, args=(lock_key, lock),
+                                  name='dzik-shops-refresh', daemon=True)
+        _refresh['thread'] = thread
+        thread.start()
+        return thread
+
+
+def wait_for_shops(timeout):
+    """Przy zimnym starcie (brak snapshotu w procesie i w cache) czeka na preload
+    robiony w tle - przez ten proces albo inny worker - zamiast uruchamiać własny"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if _preloaded['shops'] is not None:
+            return True
+        store = cache.get(shops_key('ALL_SHOPS_PRELOADED'))
+        if store:
+            set_preloaded_shops(store)
+            return True
+        thread = refresh_shops_in_background()
+        if thread is not None:
+            thread.join(min(0.5, max(0.0, deadline - time.monotonic())))
+        else:
+            time.sleep(0.1)
+    return False
+
+
+def load_shops_snapshot():
+    """Zwraca (store, index) z pliku snapshotu DZIK_SHOPS_SNAPSHOT albo None, gdy go nie ma"""
+    if not settings.DZIK_SHOPS_SNAPSHOT:
+        return None
+    return load_snapshot(settings.DZIK_SHOPS_SNAPSHOT)
+
+
+def load_cached_shops(namespace):
+    """Zwraca (store, index) z pełnego zapisu ALL_SHOPS_PRELOADED albo None"""
+    store = cache.get(shops_key('ALL_SHOPS_PRELOADED', namespace))
+    return (store, ShopGridIndex(store.lats, store.lons)) if store else None
+
+
+def apply_shop_patch(shops, patch):
+    """Nanosi rekord poprawki z apply_shop_changes na (store, index) - wynik jest taki
+    sam w każdym procesie, który zaczyna od tej samej wersji"""
+    store, index = shops
+    new_store, changes = store.patched(patch['rows'], patch['removed'], patch['templates'],
+                                       patch['removed_templates'])
+    new_store.version = patch['version']
+    new_store.last_update = patch['last_update']
+    new_store.refreshed_at = store.refreshed_at
+    return new_store, index.patched(new_store.lats, new_store.lons, changes)
+
+
+def replay_shop_patches(shops, version, namespace):
+    """Doprowadza (store, index) do wersji ``version`` rekordami poprawek z cache albo
+    zwraca None, gdy łańcuch się urywa lub jest dłuższy niż SHOPS_PATCH_CHAIN_LIMIT"""
+    for _ in range(SHOPS_PATCH_CHAIN_LIMIT + 1):
+        if shops[0].version == version:
+            return shops
+        patch = cache.get(shops_key(f'ALL_SHOPS_PATCH_{shops[0].version}', namespace))
+        if patch is None:
+            return None
+        shops = apply_shop_patch(shops, patch)
+    return None
+
+
+def catch_up_shops(current, version, namespace):
+    """Zwraca (store, index) w wersji ``version`` albo None. Punktem wyjścia jest po kolei
+    zbiór z pamięci procesu, plik snapshotu (procesy hosta dzielą go przez mmap zamiast
+    kopii z cache) i pełny zapis z cache - pierwszy, z którego łańcuch poprawek
+    prowadzi do tej wersji. Plik, z którego nie da się dojść do wersji z cache, mógł
+    nie widzieć poprawek z sygnałów, więc nie jest używany."""
+    for load in (lambda: current, load_shops_snapshot, lambda: load_cached_shops(namespace)):
+        shops = load()
+        if shops is not None:
+            shops = replay_shop_patches(shops, version, namespace)
+            if shops is not None:
+                return shops
+    return None
+
+
+def get_preloaded_shops():
+    """Zwraca (store, index) preloadowanych sklepów z pamięci procesu albo z cache.
+    Przeterminowany snapshot jest dalej zwracany, a odświeżenie rusza w tle."""
+    current = _preloaded['shops']
+    namespace = shops_namespace()
+    version = cache.get(shops_key('ALL_SHOPS_VERSION', namespace))
+    if current is None or version is None or current[0].version != version:
+        shops = None
+        missed = _preloaded['missed_version']
+        # Po nieudanej próbie dojścia do wersji nie powtarzamy jej przy każdym requeście
+        if version is not None and (missed is None or missed[0] != version
+                                    or time.monotonic() - missed[1] > REFRESH_RETRY_SECONDS):
+            shops = catch_up_shops(current, version, namespace)
+            _preloaded['missed_version'] = None if shops else (version, time.monotonic())
+
+        if shops:
+            set_preloaded_shops(*shops)
+        elif current is None:
+            snapshot = load_shops_snapshot()
+            if snapshot:
+                # Bez wersji w cache nie wiadomo, czy plik zawiera poprawki z sygnałów -
+                # serwujemy go jako przeterminowany tylko z tego procesu, a odświeżenie
+                # w tle opublikuje stan z bazy
+                print("Cache pusty - wczytuję snapshot sklepów z pliku")
+                snapshot[0].refreshed_at = None
+                set_preloaded_shops(*snapshot)
+            else:
+                print("Cache pusty - czekam na preload sklepów...")
+                if not wait_for_shops(COLD_START_WAIT):
+                    set_preloaded_shops(ShopStore.build([], {}))
+        else:
+            # Snapshot zniknął z cache (wyczyszczenie, eviction) - serwujemy ten z pamięci
+            refresh_shops_in_background()
+
+    current = _preloaded['shops']
+    if shops_are_stale(current[0]):
+        refresh_shops_in_background()
+    return current
+
+
+def build_all_shops_body(store, catalog=False):
+    """Koduje odpowiedź all_shops bez lokalizacji użytkownika - jest taka sama dla wszystkich"""
+    return EncodedBody.from_data(
+        dict({'shops': store.shops(catalog=catalog)}, **all_shops_meta(store, catalog=catalog)),
+        last_modified=store.last_update, version=store.version
+    )
+
+
+def all_shops_meta(store, user_location=None, catalog=False):
+    meta = {
+        'user_location': user_location,
+        'total_found': len(store),
+        'cached': True,
+        'source': 'preloaded_cache',
+        'last_update': store.last_update
+    }
+    if catalog:
+        meta['catalog_version'] = get_catalog(store)[0]
+        # Wersja, od której klient pyta potem /api/shops/changes/?since=
+        meta['sync_version'] = store.last_update * 1000 if store.last_update else None
+    return meta
+
+
+def get_all_shops_binary(store, catalog=False):
+    """Odpowiedź all_shops w formacie bin dla danej wersji sklepów, kodowana raz na proces"""
+    key = 'all_shops_catalog_binary' if catalog else 'all_shops_binary'
+    encoded = _preloaded[key]
+    if encoded is None or encoded.version != store.version:
+        encoded = EncodedBody(
+            encode_shops(store, meta=all_shops_meta(store, catalog=catalog), catalog=catalog),
+            last_modified=store.last_update, version=store.version, content_type=WIRE_CONTENT_TYPE
+        )
+        _preloaded[key] = encoded
+    return encoded
+
+
+def get_all_shops_catalog_body(store):
+    """Odpowiedź all_shops z catalog=1 dla danej wersji sklepów, kodowana raz na proces"""
+    encoded = _preloaded['all_shops_catalog']
+    if encoded is None or encoded.version != store.version:
+        encoded = build_all_shops_body(store, catalog=True)
+        _preloaded['all_shops_catalog'] = encoded
+    return encoded
+
+
+def get_catalog(store):
+    """Zwraca (wersja, zakodowany katalog szablonów) dla danej wersji sklepów, liczony raz na proces"""
+    catalog = _preloaded['catalog']
+    if catalog is None or catalog[1].version != store.version:
+        catalog = build_catalog(store)
+        _preloaded['catalog'] = catalog
+    return catalog
+
+
+def wants_catalog(request):
+    """catalog=1 - sklepy z template_id zamiast list produktów (patrz dzik/catalog.py)"""
+    return request.GET.get('catalog', '').lower() in ('1', 'true')
+
+
+def get_all_shops_body(store):
+    """Zwraca zakodowaną odpowiedź all_shops dla danej wersji sklepów z L1, cache albo budując ją"""
+    encoded = _preloaded['all_shops_body']
+    if encoded is None or encoded.version != store.version:
+        encoded = cache.get(shops_key('ALL_SHOPS_JSON'))
+        if encoded is None or encoded.version != store.version:
+            encoded = build_all_shops_body(store)
+            cache.set(shops_key('ALL_SHOPS_JSON'), encoded, SHOPS_CACHE_TIMEOUT)
+        _preloaded['all_shops_body'] = encoded
+    return encoded
+
+
+def get_template_payloads(template_ids):
+    """Buduje raz na szablon sieci listę produktów i logo, współdzielone przez wszystkie jego sklepy"""
+    templates = Shop.objects.filter(id__in=set(template_ids)).prefetch_related('featured_products')
+    payloads = {}
+    for template in templates:
+        payloads[template.id] = {
+            'products': [{
+                'id': p.id,
+                'name': p.name,
+                'flavor': p.flavor,
+                'photo_url': p.get_photo_url(),
+                'category': p.category
+            } for p in template.featured_products.all()],
+            'logo_url': template.logo.url if template.logo else None
+        }
+    return payloads
+
+
+def load_shops_from_database():
+    """Buduje ShopStore ze wszystkich aktywnych sklepów - dwa zapytania SQL"""
+    shops = list(OSMShop.objects.filter(is_active=True).only(
+        'name', 'chain', 'address', 'latitude', 'longitude', 'shop_template_id'
+    ))
+    templates = get_template_payloads(
+        shop.shop_template_id for shop in shops if shop.shop_template_id
+    )
+    return ShopStore.build(
+        ((shop.name, shop.chain, shop.address, float(shop.latitude), float(shop.longitude),
+          shop.shop_template_id, shop.pk) for shop in shops),
+        templates
+    )
+
+
+def publish_shops(store, index=None, encoded=None):
+    """Zapisuje nową wersję sklepów w cache i w pamięci procesu. Wywoływane pod
+    blokadą SHOPS_UPDATE_LOCK, żeby preload i poprawki z sygnałów się nie nadpisywały."""
+    namespace = shops_namespace()
+    entries = {
+        shops_key('ALL_SHOPS_PRELOADED', namespace): store,
+        shops_key('ALL_SHOPS_VERSION', namespace): store.version,
+        shops_key('ALL_SHOPS_LAST_UPDATE', namespace): store.last_update,
+        shops_key('ALL_SHOPS_PATCH_DEPTH', namespace): 0,
+    }
+    if encoded is not None:
+        entries[shops_key('ALL_SHOPS_JSON', namespace)] = encoded
+    cache.set_many(entries, SHOPS_CACHE_TIMEOUT)
+    set_preloaded_shops(store, index)
+    if encoded is not None:
+        _preloaded['all_shops_body'] = encoded
+
+
+def publish_shop_patch(shops, patch, depth):
+    """Publikuje poprawkę jako mały rekord zmian i nową wersję zamiast całego zbioru.
+    Rekord trafia do cache przed wersją, więc proces, który zobaczy nową wersję,
+    znajdzie też poprawkę prowadzącą do niej."""
+    namespace = shops_namespace()
+    store, index = shops
+    cache.set(shops_key(f'ALL_SHOPS_PATCH_{store.version}', namespace), patch, SHOPS_CACHE_TIMEOUT)
+    new_shops = apply_shop_patch(shops, patch)
+    cache.set_many({
+        shops_key('ALL_SHOPS_VERSION', namespace): patch['version'],
+        shops_key('ALL_SHOPS_LAST_UPDATE', namespace): patch['last_update'],
+        shops_key('ALL_SHOPS_PATCH_DEPTH', namespace): depth,
+    }, SHOPS_CACHE_TIMEOUT)
+    set_preloaded_shops(*new_shops)
+    return new_shops
+
+
+SHOPS_UPDATE_LOCK = 'update_lock'
+SHOPS_LAST_PATCH = 'last_patch'
+PRELOAD_ATTEMPTS = 3
+PATCH_MAX_SHOPS = 2000
+# Poprawki z sygnałów nie wysyłają do cache całego zbioru sklepów, tylko rekord zmian
+# (wiersze sklepów i payloady szablonów) i nową wersję - każdy proces nanosi go sam.
+# ALL_SHOPS_PRELOADED zostaje w wersji ostatniego pełnego zapisu, a po tylu poprawkach
+# z rzędu zapisywany jest od nowa, żeby łańcuch do odtworzenia nie rósł bez końca.
+# Z LocMemCache (bez REDIS_URL) każdy proces ma własny cache: poprawki widzi tylko
+# proces, w którym zapisano zmianę, a pozostałe dopiero po pełnym odświeżeniu
+# (DZIK_SHOPS_REFRESH_AFTER) - wdrożenie z kilkoma workerami potrzebuje Redisa.
+SHOPS_PATCH_CHAIN_LIMIT = 50
+
+
+def preload_all_shops_to_cache(snapshot_path=None):
+    """Ładuje wszystkie sklepy do cache w tle i zapisuje plik snapshotu
+    (domyślnie DZIK_SHOPS_SNAPSHOT), z którego startują kolejne workery"""
     try:
         print("Preloadowanie wszystkich sklepów do cache...")
-        shops_qs = OSMShop.objects.filter(is_active=True).select_related('shop_template')
-        shops = list(shops_qs)
-
-        all_shops_data = []
-        for shop in shops:
-            products = []
-            logo_url = None
-            if shop.shop_template:
-                products = [{
-                    'id': p.id,
-                    'name': p.name,
-                    'flavor': p.flavor,
-                    'photo_url': p.get_photo_url(),
-                    'category': p.category
-                } for p in shop.shop_template.featured_products.all()]
-                logo_url = shop.shop_template.logo.url if shop.shop_template.logo else None
-
-            shop_data = {
-                'name': shop.name,
-                'chain': shop.chain,
-                'address': shop.address,
-                'lat': float(shop.latitude),
-                'lon': float(shop.longitude),
-                'products': products,
-                'logo_url': logo_url
-            }
-            all_shops_data.append(shop_data)
-
-        cache.set('ALL_SHOPS_PRELOADED', all_shops_data, 6 * 60 * 60)
-        cache.set('ALL_SHOPS_LAST_UPDATE', int(time.time()), 6 * 60 * 60)
-        print(f"Preloadowano {len(all_shops_data)} sklepów do cache")
-        return len(all_shops_data)
+        for attempt in range(PRELOAD_ATTEMPTS):
+            started = time.time()
+            store = load_shops_from_database()
+            store.version = time.time_ns()
+            store.last_update = int(time.time())
+            store.refreshed_at = store.last_update
+            encoded = build_all_shops_body(store)
+            index = ShopGridIndex(store.lats, store.lons)
+
+            with cache_lock(shops_key(SHOPS_UPDATE_LOCK)) as locked:
+                if not locked:
+                    # Blokadę dłużej niż WAIT_TIMEOUT trzyma inny worker (preload albo
+                    # poprawka) - nie nadpisujemy jego wyniku własnym odczytem bazy
+                    print("Sklepy publikuje inny proces - pomijam ten preload")
+                    return 0
+                # Poprawka z sygnału zapisana w trakcie zapytania mogła dotyczyć wiersza
+                # przeczytanego jeszcze przed zmianą - wtedy czytamy bazę jeszcze raz
+                patched_at = cache.get(shops_key(SHOPS_LAST_PATCH))
+                if patched_at is None or patched_at < started or attempt == PRELOAD_ATTEMPTS - 1:
+                    publish_shops(store, index, encoded)
+                    break
+
+        prune_tombstones()
+
+        if snapshot_path is None:
+            snapshot_path = settings.DZIK_SHOPS_SNAPSHOT
+        if snapshot_path:
+            try:
+                write_snapshot(store, index, snapshot_path)
+            except OSError as e:
+                print(f"Nie udało się zapisać snapshotu sklepów: {e}")
+
+        print(f"Preloadowano {len(store)} sklepów do cache")
+        return len(store)
     except Exception as e:
         print(f"Błąd preloadowania: {e}")
         return 0
 
 
-@csrf_exempt
-def smart_shops(request):
-    """Inteligentny endpoint - zwraca sklepy dla konkretnego obszaru z preloadowanego cache"""
-    try:
-        lat = float(request.GET.get('lat', 52.0))
-        lon = float(request.GET.get('lon', 19.5))
-        zoom = int(request.GET.get('zoom', 10))
-        radius = int(request.GET.get('radius', calculateDynamicRadius(zoom)))
+def apply_shop_changes(shop_pks=(), template_pks=(), product_pks=(), removed_template_pks=()):
+    """Nanosi na snapshot sklepów zmiany pojedynczych rekordów zamiast pełnego preloadu.
+
+    ``shop_pks`` - zmienione, dodane lub usunięte OSMShop, ``template_pks`` - szablony
+    (Shop), których lista produktów lub logo mogły się zmienić, ``product_pks`` - zmienione
+    produkty, ``removed_template_pks`` - usunięte szablony. Koszt zależy od liczby zmian:
+    pobierane są tylko zmienione sklepy i szablony, a indeks przestrzenny poprawiany
+    jest w dotkniętych komórkach.
+    """
+    if len(shop_pks) > PATCH_MAX_SHOPS:
+        # Import całego regionu - pełny preload jest wtedy tańszy niż poprawki.
+        # Znacznik poprawki każe trwającemu preloadowi przeczytać bazę jeszcze raz.
+        cache.set(shops_key(SHOPS_LAST_PATCH), time.time(), SHOPS_CACHE_TIMEOUT)
+        refresh_shops_in_background(force=True)
+        return False
+
+    with cache_lock(shops_key(SHOPS_UPDATE_LOCK)) as locked:
+        if not locked:
+            # Ktoś długo trzyma blokadę - pełne odświeżenie i tak uwzględni te zmiany
+            refresh_shops_in_background()
+            return False
+
+        namespace = shops_namespace()
+        version = cache.get(shops_key('ALL_SHOPS_VERSION', namespace))
+        preloaded = catch_up_shops(_preloaded['shops'], version, namespace) if version is not None else None
+        if preloaded is None:
+            # Bez snapshotu nie ma czego poprawiać - następny preload przeczyta bazę
+            return False
+        store = preloaded[0]
+
+        shop_pks = set(shop_pks)
+        shops = list(OSMShop.objects.filter(pk__in=shop_pks, is_active=True).only(
+            'name', 'chain', 'address', 'latitude', 'longitude', 'shop_template_id'
+        ))
+        rows = [(shop.name, shop.chain, shop.address, float(shop.latitude), float(shop.longitude),
+                 shop.shop_template_id, shop.pk) for shop in shops]
+        removed = shop_pks - {shop.pk for shop in shops}
+
+        known = {template['id'] for template in store.templates}
+        wanted = (set(template_pks) | set(store.template_pks_with_products(product_pks))) & known
+        wanted |= {shop.shop_template_id for shop in shops if shop.shop_template_id} - known
+        templates = get_template_payloads(wanted)
+        removed_templates = (set(removed_template_pks) | (wanted - set(templates))) & known
+
+        if not (rows or removed or templates or removed_templates):
+            return False
+
+        patch = {
+            'version': time.time_ns(),
+            'last_update': int(time.time()),
+            'rows': rows,
+            'removed': sorted(removed),
+            'templates': templates,
+            'removed_templates': sorted(removed_templates),
+        }
+        depth = cache.get(shops_key('ALL_SHOPS_PATCH_DEPTH', namespace), 0) + 1
+        if depth > SHOPS_PATCH_CHAIN_LIMIT:
+            publish_shops(*apply_shop_patch(preloaded, patch))
+        else:
+            publish_shop_patch(preloaded, patch, depth)
+        cache.set(shops_key(SHOPS_LAST_PATCH), time.time(), SHOPS_CACHE_TIMEOUT)
+        print(f"Poprawiono snapshot sklepów: {len(rows)} zmienionych, {len(removed)} usuniętych, "
+              f"{len(templates) + len(removed_templates)} szablonów")
+        return True
+
+
+def get_clusters(store, zoom):
+    """Zwraca klastry sklepów dla poziomu zoom, liczone raz na wersję sklepów"""
+    clusters = _preloaded['clusters'].get((store.version, zoom))
+    if clusters is None:
+        clusters = GridClusters(store.lats, store.lons, store.chain_ids, len(store.chains), zoom)
+        _preloaded['clusters'][(store.version, zoom)] = clusters
+    return clusters
+
+
+def clustered_shops_result(store, lat, lon, zoom, radius, user_location):
+    """Odpowiedź smart_shops dla niskiego zoomu - środki klastrów zamiast pojedynczych sklepów"""
+    clusters = get_clusters(store, max(zoom, 0))
+    selected = clusters.query_radius(lat, lon, radius)
+
+    result_clusters = []
+    for i in selected.tolist():
+        chain_counts = clusters.chain_counts[i]
+        result_clusters.append({
+            'lat': round(float(clusters.lats[i]), 6),
+            'lon': round(float(clusters.lons[i]), 6),
+            'count': int(clusters.counts[i]),
+            'chains': {store.chains[chain_id]: int(chain_counts[chain_id])
+                       for chain_id in np.flatnonzero(chain_counts).tolist()}
+        })
 
-        user_lat = request.GET.get('user_lat')
-        user_lon = request.GET.get('user_lon')
+    return {
+        'shops': [],
+        'clusters': result_clusters,
+        'clustered': True,
+        'user_location': user_location,
+        'center_location': {'lat': lat, 'lon': lon},
+        'total_found': sum(cluster['count'] for cluster in result_clusters),
+        'total_clusters': len(result_clusters),
+        'total_cached': len(store),
+        'zoom_level': zoom,
+        'radius_used': radius,
+        'cached': True,
+        'source': 'smart_cache'
+    }
 
-        all_shops = cache.get('ALL_SHOPS_PRELOADED')
-        if not all_shops:
-            print("Cache pusty - preloaduję sklepy...")
-            preload_all_shops_to_cache()
-            all_shops = cache.get('ALL_SHOPS_PRELOADED', [])
 
-        user_location = None
-        if user_lat and user_lon:
-            user_location = {'lat': float(user_lat), 'lon': float(user_lon)}
+def parse_smart_shops_request(request):
+    """Czyta parametry smart_shops - błędne liczby rzucają ValueError"""
+    zoom = int(request.GET.get('zoom', 10))
+    user_lat = request.GET.get('user_lat')
+    user_lon = request.GET.get('user_lon')
+    return {
+        'lat': float(request.GET.get('lat', 52.0)),
+        'lon': float(request.GET.get('lon', 19.5)),
+        'zoom': zoom,
+        'radius': int(request.GET.get('radius', calculateDynamicRadius(zoom))),
+        'cluster': request.GET.get('cluster', 'true').lower() not in ('0', 'false'),
+        'user_location': {'lat': float(user_lat), 'lon': float(user_lon)} if user_lat and user_lon else None,
+        'catalog': wants_catalog(request),
+    }
 
-        filtered_shops = []
-        for shop in all_shops:
-            distance = calculate_distance(lat, lon, shop['lat'], shop['lon'])
-            if distance <= radius:
-                shop_copy = shop.copy()
-                shop_copy['distance'] = round(distance)
-                if user_location:
-                    user_distance = calculate_distance(
-                        user_location['lat'], user_location['lon'],
-                        shop['lat'], shop['lon']
-                    )
-                    shop_copy['distance_from_user'] = round(user_distance)
-                filtered_shops.append(shop_copy)
 
-        if user_location:
-            filtered_shops.sort(key=lambda x: x.get('distance_from_user', float('inf')))
-        else:
-            filtered_shops.sort(key=lambda x: x['distance'])
+def smart_shops_selection(index, lat, lon, zoom, radius, user_location):
+    """Pozycje sklepów dla smart_shops i ich odległości (kolumny całkowite w metrach)"""
+    if zoom >= 15:
+        limit = 500
+    elif zoom >= 12:
+        limit = 1000
+    else:
+        limit = 2000
 
-        if zoom >= 15:
-            limit = 500
-        elif zoom >= 12:
-            limit = 1000
-        else:
-            limit = 2000
+    if user_location:
+        positions, distances = index.query_radius(lat, lon, radius)
+        user_distances = index.distances_from(user_location['lat'], user_location['lon'], positions)
+        order = order_by_distance(positions, user_distances, limit)
+        positions, distances, user_distances = positions[order], distances[order], user_distances[order]
+        return positions, {'distance': np.rint(distances), 'distance_from_user': np.rint(user_distances)}
+
+    positions, distances = index.query_radius(lat, lon, radius, limit)
+    return positions, {'distance': np.rint(distances)}
+
+
+def smart_shops_meta(all_shops, lat, lon, zoom, radius, user_location, total_found, catalog=False):
+    meta = {
+        'user_location': user_location,
+        'center_location': {'lat': lat, 'lon': lon},
+        'total_found': total_found,
+        'total_cached': len(all_shops),
+        'zoom_level': zoom,
+        'radius_used': radius,
+        'cached': True,
+        'source': 'smart_cache'
+    }
+    if catalog:
+        meta['catalog_version'] = get_catalog(all_shops)[0]
+    return meta
 
-        filtered_shops = filtered_shops[:limit]
 
-        result = {
-            'shops': filtered_shops,
-            'user_location': user_location,
-            'center_location': {'lat': lat, 'lon': lon},
-            'total_found': len(filtered_shops),
-            'total_cached': len(all_shops),
-            'zoom_level': zoom,
-            'radius_used': radius,
-            'cached': True,
-            'source': 'smart_cache'
-        }
+def smart_shops_data(all_shops, index, lat, lon, zoom, radius, cluster, user_location, catalog=False):
+    """Odpowiedź smart_shops z preloadowanych sklepów - same obliczenia, bez I/O"""
+    if cluster and zoom < getattr(settings, 'DZIK_CLUSTER_MAX_ZOOM', 10):
+        return clustered_shops_result(all_shops, lat, lon, zoom, radius, user_location)
 
-        return JsonResponse(result)
+    positions, columns = smart_shops_selection(index, lat, lon, zoom, radius, user_location)
+    filtered_shops = all_shops.shops(positions, catalog=catalog)
+    for name, values in columns.items():
+        for shop, value in zip(filtered_shops, values.astype(np.int64).tolist()):
+            shop[name] = value
+
+    return dict(
+        {'shops': filtered_shops},
+        **smart_shops_meta(all_shops, lat, lon, zoom, radius, user_location, len(filtered_shops), catalog)
+    )
+
+
+def smart_shops_binary(all_shops, index, lat, lon, zoom, radius, cluster, user_location, catalog=False):
+    """Odpowiedź smart_shops w formacie bin albo None, gdy wynik to klastry (zawsze JSON)"""
+    if cluster and zoom < getattr(settings, 'DZIK_CLUSTER_MAX_ZOOM', 10):
+        return None
+
+    positions, columns = smart_shops_selection(index, lat, lon, zoom, radius, user_location)
+    meta = smart_shops_meta(all_shops, lat, lon, zoom, radius, user_location, len(positions), catalog)
+    return encode_shops(all_shops, positions, columns, meta, catalog)
+
+
+def wants_binary(request):
+    """Negocjacja formatu listy sklepów: format=bin albo nagłówek Accept"""
+    requested = request.GET.get('format', '').lower()
+    if requested:
+        return requested == 'bin'
+    return WIRE_CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+def negotiated(response):
+    """Odpowiedź zależy od nagłówka Accept - cache po drodze nie może pomylić formatów"""
+    patch_vary_headers(response, ('Accept',))
+    return response
+
+
+@csrf_exempt
+def smart_shops(request):
+    """Inteligentny endpoint - zwraca sklepy dla konkretnego obszaru z preloadowanego cache.
+    Poniżej DZIK_CLUSTER_MAX_ZOOM zwraca klastry zamiast sklepów (cluster=0 wyłącza)."""
+    try:
+        params = parse_smart_shops_request(request)
+        all_shops, index = get_preloaded_shops()
+        if wants_binary(request):
+            body = smart_shops_binary(all_shops, index, **params)
+            if body is not None:
+                return negotiated(HttpResponse(body, content_type=WIRE_CONTENT_TYPE))
+        return negotiated(JsonResponse(smart_shops_data(all_shops, index, **params)))
 
     except (ValueError, TypeError) as e:
         return JsonResponse({'error': f'Błędne parametry: {str(e)}'}, status=400)
@@ -189,48 +692,260 @@ def smart_shops(request):
 
 @csrf_exempt
 def all_shops(request):
-    """Zwraca WSZYSTKIE sklepy OSM od razu - teraz z cache"""
+    """Zwraca WSZYSTKIE sklepy OSM od razu - teraz z cache.
+    Bez lokalizacji użytkownika serwuje gotowe bajty z ETagiem i obsługą 304."""
     try:
         user_lat = request.GET.get('user_lat')
         user_lon = request.GET.get('user_lon')
 
-        all_shops = cache.get('ALL_SHOPS_PRELOADED')
-        if not all_shops:
-            print("Cache pusty - preloaduję sklepy...")
-            preload_all_shops_to_cache()
-            all_shops = cache.get('ALL_SHOPS_PRELOADED', [])
+        all_shops, index = get_preloaded_shops()
+        binary = wants_binary(request)
+        catalog = wants_catalog(request)
+
+        if not (user_lat and user_lon):
+            if binary:
+                encoded = get_all_shops_binary(all_shops, catalog)
+            elif catalog:
+                encoded = get_all_shops_catalog_body(all_shops)
+            else:
+                encoded = get_all_shops_body(all_shops)
+            return negotiated(encoded_response(request, encoded))
+
+        user_location = {'lat': float(user_lat), 'lon': float(user_lon)}
+        distances = index.distances_from(user_location['lat'], user_location['lon'])
+        order = order_by_distance(np.arange(len(all_shops)), distances)
+
+        if binary:
+            return negotiated(HttpResponse(encode_shops(
+                all_shops, order, {'distance_from_user': np.rint(distances[order])},
+                all_shops_meta(all_shops, user_location, catalog), catalog
+            ), content_type=WIRE_CONTENT_TYPE))
+
+        shops = all_shops.shops(order, catalog=catalog)
+        for shop, distance in zip(shops, distances[order].tolist()):
+            shop['distance_from_user'] = round(distance)
+
+        return negotiated(JsonResponse(dict({'shops': shops}, **all_shops_meta(all_shops, user_location, catalog))))
+    except Exception as e:
+        return JsonResponse({'error': f'Błąd: {str(e)}'}, status=500)
 
-        user_location = None
-        if user_lat and user_lon:
-            user_location = {'lat': float(user_lat), 'lon': float(user_lon)}
 
-            shops_with_distance = []
-            for shop in all_shops:
-                shop_copy = shop.copy()
-                distance = calculate_distance(
-                    user_location['lat'], user_location['lon'],
-                    shop['lat'], shop['lon']
-                )
-                shop_copy['distance_from_user'] = round(distance)
-                shops_with_distance.append(shop_copy)
+@csrf_exempt
+def shop_catalog(request):
+    """Katalog szablonów sieci (produkty i logo) dla odpowiedzi z catalog=1. Pod adresem
+    z aktualną wersją (?v=catalog_version) treść jest niezmienna i cache'owana na rok."""
+    try:
+        store, _ = get_preloaded_shops()
+        version, encoded = get_catalog(store)
+        if request.GET.get('v') == version:
+            cache_control = f'public, max-age={CATALOG_MAX_AGE}, immutable'
+        else:
+            cache_control = 'public, max-age=0, must-revalidate'
+        return encoded_response(request, encoded, cache_control=cache_control)
+    except Exception as e:
+        return JsonResponse({'error': f'Błąd: {str(e)}'}, status=500)
 
-            shops_with_distance.sort(key=lambda x: x['distance_from_user'])
-            all_shops = shops_with_distance
 
-        result = {
-            'shops': all_shops,
-            'user_location': user_location,
-            'total_found': len(all_shops),
-            'cached': True,
-            'source': 'preloaded_cache',
-            'last_update': cache.get('ALL_SHOPS_LAST_UPDATE')
-        }
+@csrf_exempt
+def shop_changes(request):
+    """Sklepy wstawione, zmienione i usunięte od wersji since (sync_version z all_shops
+    z catalog=1 albo version z poprzedniej odpowiedzi). 410 z reset=true oznacza, że
+    trzeba pobrać wszystkie sklepy od nowa."""
+    try:
+        since = int(request.GET['since'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Podaj since jako wersję (liczbę całkowitą)'}, status=400)
 
-        return JsonResponse(result)
+    try:
+        data = changes_since(since)
+        store, _ = get_preloaded_shops()
+        data['catalog_version'] = get_catalog(store)[0]
+        return JsonResponse(data)
+    except SyncReset as e:
+        return JsonResponse({'error': str(e), 'reset': True}, status=410)
     except Exception as e:
         return JsonResponse({'error': f'Błąd: {str(e)}'}, status=500)
 
 
+def export_response(request, store, export_format, include_products, asynchronous=False):
+    """Strumieniowa odpowiedź eksportu sklepów z ETagiem wersji snapshotu (304 bez
+    generowania treści) i kompresją gzip liczoną paczka po paczce"""
+    etag = f'"{store.version}-{export_format}-{int(include_products)}"'
+    not_modified = get_conditional_response(request, etag=etag, last_modified=store.last_update)
+    if not_modified is not None:
+        response = not_modified
+    else:
+        metadata = {'total_found': len(store), 'last_update': store.last_update, 'source': 'preloaded_cache'}
+        body = encode_stream(store_features(store, include_products), export_format, metadata)
+        gzipped = 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+        if gzipped:
+            body = compress_sequence(body)
+        if asynchronous:
+            body = iterate_async(body)
+        response = StreamingHttpResponse(body, content_type=EXPORT_FORMATS[export_format])
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        if request.GET.get('download', '').lower() in ('1', 'true'):
+            response['Content-Disposition'] = f'attachment; filename="dzik-shops.{export_format}"'
+
+    response['ETag'] = etag
+    if store.last_update:
+        response['Last-Modified'] = http_date(store.last_update)
+    response['Cache-Control'] = 'public, max-age=0, must-revalidate'
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+async def iterate_async(chunks):
+    """Pod ASGI Django buforuje całe synchroniczne iteratory - asynchroniczny
+    wysyła paczki od razu, a między nimi pętla obsługuje inne zapytania"""
+    for chunk in chunks:
+        yield chunk
+
+
+def parse_export_request(request):
+    """Zwraca (format, czy_z_produktami) albo rzuca ValueError"""
+    export_format = request.GET.get('format', 'geojson').lower()
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Nieznany format eksportu - dostępne: {', '.join(EXPORT_FORMATS)}")
+    include_products = request.GET.get('products', 'true').lower() not in ('0', 'false')
+    return export_format, include_products
+
+
+@csrf_exempt
+def export_shops(request):
+    """Eksport wszystkich sklepów jako strumień GeoJSON (format=geojson) albo NDJSON
+    (format=ndjson) z preloadowanego snapshotu. products=0 pomija listy produktów."""
+    try:
+        export_format, include_products = parse_export_request(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    try:
+        store, _ = get_preloaded_shops()
+        return export_response(request, store, export_format, include_products)
+    except Exception as e:
+        return JsonResponse({'error': f'Błąd: {str(e)}'}, status=500)
+
+
+TILE_MAX_ZOOM = 22
+TILE_MEMO_SIZE = 4096
+_tiles_lock = threading.Lock()
+
+
+def get_tile_body(store, index, z, x, y):
+    """Zwraca zakodowany payload kafelka, zapamiętany w L1 dla bieżącej wersji sklepów"""
+    tiles = _preloaded['tiles']
+    key = (store.version, z, x, y)
+    with _tiles_lock:
+        encoded = tiles.get(key)
+        if encoded is not None:
+            tiles.move_to_end(key)
+            return encoded
+
+    positions = index.query_box(*tile_bounds(z, x, y))
+    shops = store.shops(positions)
+    encoded = EncodedBody.from_data({
+        'tile': {'z': z, 'x': x, 'y': y},
+        'shops': shops,
+        'total_found': len(shops),
+        'last_update': store.last_update
+    }, last_modified=store.last_update, version=store.version)
+
+    with _tiles_lock:
+        tiles[key] = encoded
+        while len(tiles) > TILE_MEMO_SIZE:
+            tiles.popitem(last=False)
+    return encoded
+
+
+@csrf_exempt
+def shop_tile(request, z, x, y):
+    """Zwraca sklepy z jednego kafelka mapy z/x/y - odpowiedź nadaje się do cache przeglądarki i CDN"""
+    if not (0 <= z <= TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return JsonResponse({'error': 'Nieprawidłowy kafelek'}, status=400)
+
+    try:
+        store, index = get_preloaded_shops()
+        return encoded_response(
+            request, get_tile_body(store, index, z, x, y),
+            cache_control='public, max-age=300, stale-while-revalidate=3600'
+        )
+    except Exception as e:
+        return JsonResponse({'error': f'Błąd: {str(e)}'}, status=500)
+
+
+def parse_product_filter(request):
+    """Czyta filtr produktów: products=mango,kiwi (frazy smaku), categories=energy_drink,...
+    oraz match=all (wszystkie warunki - AND) lub domyślnie match=any (dowolny - OR)"""
+    flavors = [f.strip().lower() for f in request.GET.get('products', '').split(',') if f.strip()]
+    categories = [c.strip().lower() for c in request.GET.get('categories', '').split(',') if c.strip()]
+    match_all = request.GET.get('match', 'any').strip().lower() == 'all'
+    return flavors, categories, match_all
+
+
+KNN_MAX_K = 100
+
+
+@csrf_exempt
+def knn_shops(request):
+    """Zwraca k najbliższych sklepów z preloadowanego cache, opcjonalnie tylko wybranych sieci
+    (chain=zabka,lidl) lub spełniających filtr produktów (patrz parse_product_filter)"""
+    try:
+        lat = float(request.GET['lat'])
+        lon = float(request.GET['lon'])
+        k = int(request.GET.get('k', 10))
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Podaj prawidłowe lat, lon i k jako liczby'}, status=400)
+
+    if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+        return JsonResponse({'error': 'Nieprawidłowe współrzędne'}, status=400)
+    if not (1 <= k <= KNN_MAX_K):
+        return JsonResponse({'error': f'k musi być między 1 a {KNN_MAX_K}'}, status=400)
+
+    chains = [c.strip().lower() for c in request.GET.get('chain', '').split(',') if c.strip()]
+    flavors, categories, match_all = parse_product_filter(request)
+
+    try:
+        store, index = get_preloaded_shops()
+
+        mask = None
+        if chains:
+            mask = store.chain_mask(chains)
+        if flavors or categories:
+            product_mask = store.product_mask(flavors, categories, match_all)
+            mask = product_mask if mask is None else mask & product_mask
+
+        positions, distances = index.nearest(lat, lon, k, mask)
+        shops = store.shops(positions)
+        for shop, distance in zip(shops, distances.tolist()):
+            shop['distance'] = round(distance)
+
+        return JsonResponse({
+            'shops': shops,
+            'center_location': {'lat': lat, 'lon': lon},
+            'k': k,
+            'filters': {'chain': chains, 'products': flavors, 'categories': categories,
+                        'match': 'all' if match_all else 'any'},
+            'total_found': len(shops),
+            'cached': True,
+            'source': 'knn_index'
+        })
+    except Exception as e:
+        return JsonResponse({'error': f'Błąd serwera: {str(e)}'}, status=500)
+
+
+def readiness(request):
+    """Probe gotowości workera - 200 po rozgrzaniu snapshotu sklepów, 503 wcześniej"""
+    state = dict(warmup_state)
+    if state['state'] == 'cold' and _preloaded['shops'] is not None:
+        # Proces bez hooka rozgrzewania (np. runserver) - snapshot załadował pierwszy request
+        store = _preloaded['shops'][0]
+        state.update(state='ready', source='request', shops=len(store), version=store.version)
+    state['pid'] = os.getpid()
+    return JsonResponse(state, status=200 if state['state'] == 'ready' else 503)
+
+
 @staff_member_required
 def force_preload_cache(request):
     """Endpoint do ręcznego przeładowania cache"""
@@ -238,13 +953,124 @@ def force_preload_cache(request):
     return JsonResponse({
         'success': True,
         'message': f'Przeładowano {count} sklepów do cache',
-        'timestamp': cache.get('ALL_SHOPS_LAST_UPDATE')
+        'timestamp': cache.get(shops_key('ALL_SHOPS_LAST_UPDATE'))
     })
 
 
-@csrf_exempt
-def nearest_shops(request):
-    """Zwraca najbliższe sklepy z lokalnej bazy danych OSMShop"""
+NEAREST_SHOPS_LIMIT = 2500
+
+
+def canonical_product_filter(flavors, categories, match_all):
+    """Kanoniczny zapis filtra produktów - kolejność i powtórzenia fraz nie mają
+    znaczenia, a match=all przy jednym warunku to to samo co match=any"""
+    flavors = sorted(set(flavors))
+    categories = sorted(set(categories))
+    mode = 'all' if match_all and len(flavors) + len(categories) > 1 else 'any'
+    return f"{','.join(flavors)}|{','.join(categories)}|{mode}"
+
+
+def geohash_search_area(cell, radius):
+    """Środek komórki geohash i promień, który z niego obejmuje okrąg radius
+    wokół dowolnego punktu komórki (radius + połowa przekątnej)"""
+    min_lat, max_lat, min_lon, max_lon = geohash_bounds(cell)
+    center_lat, center_lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+    half_diagonal = max(calculate_distance(center_lat, center_lon, corner_lat, corner_lon)
+                        for corner_lat in (min_lat, max_lat) for corner_lon in (min_lon, max_lon))
+    return center_lat, center_lon, radius + half_diagonal
+
+
+def template_pks_matching(flavors, categories, match_all):
+    """Szablony sieci spełniające filtr produktów - z bitmap preloadu zamiast JOIN-a
+    z LIKE i DISTINCT. Proces bez załadowanych sklepów nie czeka na preload
+    (do COLD_START_WAIT), tylko buduje bitmapy z szablonów w bazie."""
+    if _preloaded['shops'] is not None:
+        store, _ = get_preloaded_shops()
+        return store.template_pks_matching(flavors, categories, match_all)
+
+    payloads = get_template_payloads(Shop.objects.values_list('id', flat=True))
+    templates = [dict(payload, id=pk) for pk, payload in payloads.items()]
+    matching = ProductBitmaps(templates).matching_templates(flavors, categories, match_all)
+    return [template['id'] for template, ok in zip(templates, matching.tolist()) if ok]
+
+
+def fetch_nearest_candidates(lat, lon, search_radius, limit, flavors, categories, match_all):
+    """Aktywne sklepy z bazy w promieniu search_radius od punktu, bez odległości -
+    te liczy dopiero widok dla faktycznego punktu zapytania i użytkownika.
+
+    ``complete_radius`` mówi, do jakiej odległości od punktu lista jest pełna:
+    to search_radius, chyba że zapytanie uciął limit.
+    """
+    box = bounding_box(lat, lon, search_radius)
+    shops_qs = OSMShop.objects.filter(is_active=True)
+    if box is not None:
+        shops_qs = shops_qs.within_box(*box)
+
+    if flavors or categories:
+        shops_qs = shops_qs.filter(
+            shop_template_id__in=template_pks_matching(flavors, categories, match_all)
+        )
+
+    shops = list(shops_qs.nearest_to(lat, lon)[:limit])
+    templates = get_template_payloads(
+        shop.shop_template_id for shop in shops if shop.shop_template_id
+    )
+
+    lats = np.array([float(shop.latitude) for shop in shops], dtype=np.float64)
+    lons = np.array([float(shop.longitude) for shop in shops], dtype=np.float64)
+    distances = haversine_many(lat, lon, lats, lons)
+    inside = np.flatnonzero(distances <= search_radius)
+
+    complete_radius = search_radius
+    if len(shops) == limit:
+        # Baza sortuje po odległości w stopniach, która dla przesunięć wschód-zachód
+        # zawyża metry najwyżej 1/cos(lat) razy - pominięte sklepy są więc co najmniej
+        # tak daleko jak ostatni pobrany, pomnożony przez cos(lat)
+        complete_radius = min(search_radius, float(distances[-1]) * math.cos(math.radians(lat)))
+
+    result = []
+    catalog_refs = []
+    for i in inside.tolist():
+        shop = shops[i]
+        template = templates.get(shop.shop_template_id)
+        catalog_refs.append((shop.pk, shop.shop_template_id if template else None))
+        result.append({
+            'name': shop.name,
+            'chain': shop.chain,
+            'address': shop.address,
+            'lat': float(shop.latitude),
+            'lon': float(shop.longitude),
+            'products': template['products'] if template else [],
+            'logo_url': template['logo_url'] if template else None
+        })
+
+    return {
+        'shops': result,
+        'catalog_refs': catalog_refs,
+        'lats': lats[inside],
+        'lons': lons[inside],
+        'center': (lat, lon),
+        'complete_radius': complete_radius
+    }
+
+
+def nearest_from_candidates(candidates, lat, lon, radius, require_complete=True):
+    """Zwraca (indeksy, odległości) najbliższych kandydatów w promieniu, do limitu,
+    albo None, gdy lista kandydatów nie jest pewna dla tego punktu"""
+    distances = haversine_many(lat, lon, candidates['lats'], candidates['lons'])
+    inside = np.flatnonzero(distances <= radius)
+    inside = inside[order_by_distance(inside, distances[inside], NEAREST_SHOPS_LIMIT)]
+
+    if require_complete:
+        needed = radius if len(inside) < NEAREST_SHOPS_LIMIT else distances[inside[-1]]
+        offset = calculate_distance(lat, lon, *candidates['center'])
+        if offset + needed > candidates['complete_radius']:
+            return None
+    return inside, distances[inside]
+
+
+def parse_nearest_shops_request(request):
+    """Czyta i sprawdza parametry nearest_shops. Zwraca słownik parametrów razem
+    z kluczem cache albo rzuca ValueError z komunikatem dla użytkownika."""
     try:
         lat = float(request.GET['lat'])
         lon = float(request.GET['lon'])
@@ -255,7 +1081,7 @@ def nearest_shops(request):
         user_lat = request.GET.get('user_lat')
         user_lon = request.GET.get('user_lon')
     except (KeyError, ValueError):
-        return JsonResponse({'error': 'Podaj prawidłowe lat i lon jako liczby'}, status=400)
+        raise ValueError('Podaj prawidłowe lat i lon jako liczby')
 
     user_location = None
     if user_lat and user_lon:
@@ -265,24 +1091,21 @@ def nearest_shops(request):
             pass
 
     if not (-90 <= lat <= 90):
-        return JsonResponse({'error': 'Szerokość geograficzna musi być między -90 a 90'}, status=400)
+        raise ValueError('Szerokość geograficzna musi być między -90 a 90')
     if not (-180 <= lon <= 180):
-        return JsonResponse({'error': 'Długość geograficzna musi być między -180 a 180'}, status=400)
+        raise ValueError('Długość geograficzna musi być między -180 a 180')
     if not (100 <= radius <= 10000000):
-        return JsonResponse({'error': 'Promień musi być między 100m a 60km'}, status=400)
-
-    filter_products = request.GET.get('products', '').strip()
-    wanted_flavors = []
-    if filter_products:
-        wanted_flavors = [f.strip().lower() for f in filter_products.split(',')]
+        raise ValueError('Promień musi być między 100m a 60km')
 
-    cache_lat = round(lat, 3)
-    cache_lon = round(lon, 3)
-    user_cache_key = ""
-    if user_location:
-        user_cache_key = f"_user_{round(user_location['lat'], 3)}_{round(user_location['lon'], 3)}"
+    wanted_flavors, wanted_categories, match_all = parse_product_filter(request)
+    filter_key = canonical_product_filter(wanted_flavors, wanted_categories, match_all)
 
-    cache_key = f"local_shops_{cache_lat}_{cache_lon}_{zoom}_{radius}_{hash(filter_products)}{user_cache_key}"
+    # Klucz zależy tylko od komórki geohash, promienia i filtra - nie od zoomu
+    # ani położenia użytkownika, więc wpis jest wspólny dla wszystkich procesów
+    precision = geohash_precision_for(radius)
+    cell = geohash_encode(lat, lon, precision)
+    filter_digest = hashlib.sha1(filter_key.encode('utf-8')).hexdigest()[:16]
+    cache_key = shops_key(f"local_shops_{cell}_{radius}_{filter_digest}")
 
     if zoom >= 15:
         cache_time = 5 * 60
@@ -291,89 +1114,102 @@ def nearest_shops(request):
     else:
         cache_time = 30 * 60
 
-    if not no_cache:
-        cached_result = cache.get(cache_key)
-        if cached_result:
-            cached_result['cached'] = True
-            cached_result['zoom_level'] = zoom
-            cached_result['radius_used'] = radius
-            return JsonResponse(cached_result)
-
-    lat_range = radius / 111000
-    lon_range = radius / (111000 * math.cos(math.radians(lat)))
-
-    shops_qs = OSMShop.objects.filter(
-        latitude__range=(lat - lat_range, lat + lat_range),
-        longitude__range=(lon - lon_range, lon + lon_range),
-        is_active=True
-    ).select_related('shop_template')
-
-    if wanted_flavors:
-        shops_qs = shops_qs.filter(
-            shop_template__productshoprelation__product__flavor__icontains=wanted_flavors[0]
-        ).distinct()
-
-    limit = 2500
-    shops = list(shops_qs[:limit])
+    return {
+        'lat': lat, 'lon': lon, 'zoom': zoom, 'radius': radius, 'no_cache': no_cache,
+        'user_location': user_location,
+        'flavors': wanted_flavors, 'categories': wanted_categories, 'match_all': match_all,
+        'cell': cell, 'cache_key': cache_key, 'cache_time': cache_time,
+        'catalog': wants_catalog(request),
+    }
 
-    result = []
-    for shop in shops:
-        distance_from_center = calculate_distance(lat, lon, float(shop.latitude), float(shop.longitude))
 
-        if distance_from_center > radius:
-            continue
+def get_cell_candidates(params):
+    """Kandydaci komórki geohash z cache albo z bazy - (kandydaci, czy_z_cache)"""
+    center_lat, center_lon, search_radius = geohash_search_area(params['cell'], params['radius'])
+    limit = math.ceil(NEAREST_SHOPS_LIMIT * (search_radius / params['radius']) ** 2)
+    return get_or_compute(
+        params['cache_key'],
+        lambda: fetch_nearest_candidates(
+            center_lat, center_lon, search_radius, limit,
+            params['flavors'], params['categories'], params['match_all']
+        ),
+        params['cache_time'],
+        refresh=params['no_cache']
+    )
 
-        distance_from_user = None
-        if user_location:
-            distance_from_user = calculate_distance(
-                user_location['lat'], user_location['lon'],
-                float(shop.latitude), float(shop.longitude)
-            )
 
-        products = []
-        logo_url = None
-        if shop.shop_template:
-            products = [{
-                'id': p.id,
-                'name': p.name,
-                'flavor': p.flavor,
-                'photo_url': p.get_photo_url(),
-                'category': p.category
-            } for p in shop.shop_template.featured_products.all()]
-            logo_url = shop.shop_template.logo.url if shop.shop_template.logo else None
+def fetch_point_candidates(params):
+    """Kandydaci pobrani wprost dla punktu zapytania, z pominięciem cache komórki"""
+    return fetch_nearest_candidates(
+        params['lat'], params['lon'], params['radius'], NEAREST_SHOPS_LIMIT,
+        params['flavors'], params['categories'], params['match_all']
+    )
 
-        shop_data = {
-            'name': shop.name,
-            'chain': shop.chain,
-            'address': shop.address,
-            'lat': float(shop.latitude),
-            'lon': float(shop.longitude),
-            'distance': round(distance_from_center),
-            'distance_from_user': round(distance_from_user) if distance_from_user else None,
-            'products': products,
-            'logo_url': logo_url
-        }
-        result.append(shop_data)
 
+def nearest_shops_data(params, candidates, cached, require_complete=True):
+    """Odpowiedź nearest_shops z listy kandydatów albo None, gdy lista nie jest
+    pewna dla tego punktu (gęsty obszar, w którym limit uciął kandydatów komórki)
+    albo pochodzi z cache sprzed catalog_refs (id, template_id), a zapytanie ma catalog=1"""
+    lat, lon, radius = params['lat'], params['lon'], params['radius']
+    catalog_refs = candidates.get('catalog_refs')
+    if params['catalog'] and catalog_refs is None:
+        return None
+    nearest = nearest_from_candidates(candidates, lat, lon, radius, require_complete)
+    if nearest is None:
+        return None
+    inside, distances = nearest
+
+    user_location = params['user_location']
+    user_distances = None
     if user_location:
-        result.sort(key=lambda x: x['distance_from_user'] or float('inf'))
+        user_distances = haversine_many(
+            user_location['lat'], user_location['lon'], candidates['lats'][inside], candidates['lons'][inside]
+        )
+        order = order_by_distance(inside, user_distances)
     else:
-        result.sort(key=lambda x: x['distance'])
+        order = np.arange(len(inside))
+
+    result = []
+    for i in order.tolist():
+        shop_data = dict(candidates['shops'][inside[i]])
+        if params['catalog']:
+            del shop_data['products'], shop_data['logo_url']
+            shop_data['id'], shop_data['template_id'] = catalog_refs[inside[i]]
+        shop_data['distance'] = round(distances[i])
+        shop_data['distance_from_user'] = round(user_distances[i]) if user_distances is not None else None
+        result.append(shop_data)
 
-    final_result = {
+    return {
         'shops': result,
         'user_location': {'lat': lat, 'lon': lon},
-        'filter_applied': bool(wanted_flavors),
-        'cached': False,
-        'zoom_level': zoom,
+        'filter_applied': bool(params['flavors'] or params['categories']),
+        'cached': cached,
+        'zoom_level': params['zoom'],
         'radius_used': radius,
         'total_found': len(result),
-        'cache_time': cache_time,
+        'cache_time': params['cache_time'],
         'source': 'local_database'
     }
 
-    cache.set(cache_key, final_result, cache_time)
-    return JsonResponse(final_result)
+
+@csrf_exempt
+def nearest_shops(request):
+    """Zwraca najbliższe sklepy z lokalnej bazy danych OSMShop"""
+    try:
+        params = parse_nearest_shops_request(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    try:
+        candidates, cached = get_cell_candidates(params)
+        data = nearest_shops_data(params, candidates, cached)
+        if data is None:
+            data = nearest_shops_data(params, fetch_point_candidates(params), False, require_complete=False)
+        if params['catalog']:
+            data['catalog_version'] = get_catalog(get_preloaded_shops()[0])[0]
+        return JsonResponse(data)
+    except Exception as e:
+        return JsonResponse({'error': f'Błąd: {str(e)}'}, status=500)
 
 
 @csrf_exempt
@@ -382,50 +1218,53 @@ def geocode_city(request):
     city = request.GET.get('city', '').strip()
     if not city:
         return JsonResponse({'error': 'Podaj nazwę miasta'}, status=400)
+    return geocode_response(city)
 
-    cache_key = f"geocode_{city.lower().replace(' ', '_')}"
-    cached_coords = cache.get(cache_key)
-    if cached_coords:
-        return JsonResponse(cached_coords)
 
-    try:
-        response = requests.get(
-            "https://nominatim.openstreetmap.org/search",
-            params={
-                'q': f"{city}, Poland",
-                'format': 'json',
-                'limit': 1,
-                'countrycodes': 'pl',
-                'featuretype': 'city',
-                'addressdetails': 1,
-            },
-            timeout=10,
-            headers={'User-Agent': 'DzikFinder/1.0'}
-        )
+# Błędy geocodingu zamieniane na odpowiedź przez geocode_error_response
+GEOCODING_ERRORS = (
+    GeocodingThrottled, requests.RequestException, httpx.HTTPError, IndexError, KeyError, ValueError
+)
 
-        response.raise_for_status()
-        data = response.json()
 
-        if not data:
-            return JsonResponse({'error': 'Nie znaleziono miasta dla podanej nazwy'}, status=404)
+def geocode_response(city):
+    """Odpowiedź geocode_city dla niepustej nazwy"""
+    try:
+        return geocode_result_response(geocode(city))
+    except GEOCODING_ERRORS as e:
+        return geocode_error_response(e)
 
-        first_result = data[0]
-        result = {
-            'city': city,
-            'lat': float(first_result['lat']),
-            'lon': float(first_result['lon']),
-            'display_name': first_result.get('display_name', city)
-        }
 
-        cache.set(cache_key, result, 86400 * 7)
-        return JsonResponse(result)
+def geocode_result_response(result):
+    """Odpowiedź dla wyniku geocode/ageocode - wspólna dla wersji sync i async"""
+    if result is None:
+        return JsonResponse({'error': 'Nie znaleziono miasta dla podanej nazwy'}, status=404)
+    return JsonResponse(result)
+
 
-    except requests.RequestException as e:
+def geocode_error_response(e):
+    """Odpowiedź dla błędu z GEOCODING_ERRORS - requests w wersji sync, httpx w async"""
+    if isinstance(e, GeocodingThrottled):
+        return JsonResponse({'error': 'Zbyt wiele zapytań do serwisu geocoding - spróbuj za chwilę'}, status=503)
+    if isinstance(e, (requests.RequestException, httpx.HTTPError)):
         print(f"Błąd zapytania do Nominatim: {e}")
         return JsonResponse({'error': f'Błąd serwisu geocoding: {str(e)}'}, status=500)
-    except (IndexError, KeyError, ValueError) as e:
-        print(f"Błąd przetwarzania odpowiedzi z Nominatim: {e}")
-        return JsonResponse({'error': 'Nieprawidłowy format odpowiedzi z serwisu geocoding'}, status=500)
+    print(f"Błąd przetwarzania odpowiedzi z Nominatim: {e}")
+    return JsonResponse({'error': 'Nieprawidłowy format odpowiedzi z serwisu geocoding'}, status=500)
+
+
+@csrf_exempt
+def autocomplete_places(request):
+    """Podpowiedzi miejscowości po prefiksie nazwy z gazetteera w pamięci procesu"""
+    query = request.GET.get('q', '').strip()
+    try:
+        limit = min(max(int(request.GET.get('limit', AUTOCOMPLETE_LIMIT)), 1), AUTOCOMPLETE_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse({'error': 'Parametr limit musi być liczbą'}, status=400)
+
+    if len(query) < 2:
+        return JsonResponse({'query': query, 'places': []})
+    return JsonResponse({'query': query, 'places': get_gazetteer().complete(query, limit)})
 
 
 @staff_member_required
@@ -566,32 +1405,28 @@ def detect_chain_from_tags(tags):
 
 
 def clear_shops_cache():
-    """Czyści cache sklepów"""
-    cache_keys = []
-    try:
-        if hasattr(cache, '_cache') and hasattr(cache._cache, 'keys'):
-            cache_keys = [key.decode() for key in cache._cache.keys('ALL_SHOPS_*')]
-            cache_keys.extend([key.decode() for key in cache._cache.keys('all_shops_*')])
-            cache_keys.extend([key.decode() for key in cache._cache.keys('local_shops_*')])
-            cache_keys.extend([key.decode() for key in cache._cache.keys('shops_*')])
-    except:
-        pass
-
-    for key in cache_keys:
-        cache.delete(key)
-    return len(cache_keys)
+    """Czyści cache sklepów - przełącza przestrzeń kluczy, zamiast wyszukiwać i kasować klucze.
+    Zwraca numer nowej przestrzeni."""
+    return bump_shops_namespace()
 
 
 def get_cache_stats():
     """Zwraca statystyki cache'a"""
     try:
         cache_info = {
-            'cache_backend': str(cache.__class__),
+            'cache_backend': settings.CACHES['default']['BACKEND'],
             'default_timeout': getattr(cache, 'default_timeout', 'Unknown'),
+            'shops_namespace': shops_namespace(),
         }
 
-        if hasattr(cache, '_cache') and hasattr(cache._cache, 'info'):
-            redis_info = cache._cache.info()
+        # RedisCache Django trzyma klienta za cache._cache.get_client()
+        if hasattr(cache, '_cache') and hasattr(cache._cache, 'get_client'):
+            try:
+                redis_info = cache._cache.get_client().info()
+            except Exception as e:
+                # np. fakeredis nie obsługuje INFO
+                cache_info['redis_error'] = str(e)
+                return cache_info
             cache_info.update({
                 'redis_version': redis_info.get('redis_version'),
                 'used_memory_human': redis_info.get('used_memory_human'),
@@ -616,8 +1451,8 @@ def cache_management(request):
         action = request.POST.get('action')
 
         if action == 'clear_shops':
-            cleared = clear_shops_cache()
-            messages.success(request, f'Wyczyszczono {cleared} kluczy cache sklepów')
+            namespace = clear_shops_cache()
+            messages.success(request, f'Wyczyszczono cache sklepów (nowa przestrzeń kluczy: {namespace})')
         elif action == 'clear_all':
             cache.clear()
             messages.success(request, 'Wyczyszczono cały cache')
@@ -628,8 +1463,8 @@ def cache_management(request):
     context = {
         'cache_stats': get_cache_stats(),
         'title': 'Zarządzanie Cache',
-        'preloaded_count': len(cache.get('ALL_SHOPS_PRELOADED', [])),
-        'last_preload': cache.get('ALL_SHOPS_LAST_UPDATE')
+        'preloaded_count': len(cache.get(shops_key('ALL_SHOPS_PRELOADED'), [])),
+        'last_preload': cache.get(shops_key('ALL_SHOPS_LAST_UPDATE'))
     }
 
     return render(request, 'admin/cache_management.html', context)
@@ -665,35 +1500,17 @@ def get_platform_stats(request):
         return JsonResponse({'error': f'Błąd: {str(e)}'}, status=500)
 
 
+SEARCH_PRODUCTS_LIMIT = 10
+
+
 @csrf_exempt
 def search_products(request):
-    """Zwraca listę produktów pasujących do frazy wyszukiwania"""
+    """Zwraca listę produktów pasujących do frazy wyszukiwania - z indeksu w pamięci procesu"""
     query = request.GET.get('q', '').strip()
     if len(query) < 2:
         return JsonResponse({'products': []})
 
-    products_qs = Product.objects.filter(
-        Q(is_active=True) &
-        (Q(name__icontains=query) | Q(flavor__icontains=query))
-    )
-
-    results = []
-    for p in products_qs:
-        full_name = f"DZIK® {p.name}"
-        if p.flavor:
-            full_name += f" {p.flavor}"
-
-        photo_url = p.get_photo_url()
-        results.append({
-            'id': p.id,
-            'name': p.name,
-            'flavor': p.flavor,
-            'category': p.category,
-            'full_name': full_name.strip(),
-            'photo_url': photo_url,
-        })
-
-    return JsonResponse({'products': results[:10]})
+    return JsonResponse({'products': get_product_index().search(query, SEARCH_PRODUCTS_LIMIT)})
 
 
 # POPRAWIONE ENDPOINTY ZGŁOSZEŃ
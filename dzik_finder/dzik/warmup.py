@@ -0,0 +1,73 @@
+# dzik/warmup.py
+
+import os
+import time
+
+from asgiref.sync import sync_to_async
+from django.db import connection
+
+from .cache_keys import shops_key
+
+# Stan rozgrzewania tego procesu - raportowany przez /api/ready/
+warmup_state = {
+    'state': 'cold',
+    'source': None,
+    'shops': None,
+    'version': None,
+    'started_at': None,
+    'finished_at': None,
+    'error': None,
+}
+
+
+def warm_up():
+    """Ładuje snapshot sklepów do pamięci procesu, zanim worker przyjmie ruch.
+
+    Gotowy snapshot bierze z pliku (mmap) albo z cache, a gdy go brak - czeka
+    na jeden wspólny preload (get_preloaded_shops), więc startujące naraz
+    workery nie odpytują bazy każdy osobno. Od razu koduje też odpowiedź all_shops.
+    """
+    from django.core.cache import cache
+    from .views import get_all_shops_body, get_preloaded_shops
+
+    warmup_state.update(state='warming', started_at=time.time(), finished_at=None, error=None)
+    try:
+        source = 'cache' if cache.get(shops_key('ALL_SHOPS_VERSION')) is not None else 'database'
+        store, _ = get_preloaded_shops()
+        if store.version is None:
+            raise RuntimeError('nie udało się załadować sklepów')
+        if isinstance(store.strings.data, memoryview):
+            # Napisy są widokiem na zmapowany plik - sklepy przyszły ze snapshotu
+            source = 'snapshot'
+        get_all_shops_body(store)
+
+        warmup_state.update(state='ready', source=source, shops=len(store), version=store.version)
+        print(f"Worker {os.getpid()} rozgrzany: {len(store)} sklepów ({source}) "
+              f"w {time.time() - warmup_state['started_at']:.2f} s")
+    except Exception as e:
+        warmup_state.update(state='failed', error=str(e))
+        print(f"⚠️ Błąd rozgrzewania workera {os.getpid()}: {e}")
+    finally:
+        warmup_state['finished_at'] = time.time()
+        # Połączenie otwarte w hooku serwera nie należy do żadnego requestu
+        connection.close()
+    return warmup_state['state'] == 'ready'
+
+
+def with_lifespan(application):
+    """Opakowuje aplikację ASGI Django obsługą protokołu lifespan - serwer (uvicorn)
+    czeka z przyjmowaniem połączeń, aż warm_up skończy się przy startup"""
+    async def lifespan_application(scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await application(scope, receive, send)
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await sync_to_async(warm_up, thread_sensitive=False)()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    return lifespan_application
@@ -0,0 +1,180 @@
+# dzik/wire.py
+
+import json
+
+import numpy as np
+
+# Zwarty binarny format listy sklepów (format=bin) - ta sama treść co JSON, ale:
+# - współrzędne jako liczby całkowite w milionowych stopnia (dokładnie tyle, ile
+#   ma OSMShop.latitude/longitude), zapisane jako różnice kolejnych wartości,
+# - sieci i zestawy produktów (szablony) jako numery w słownikach w nagłówku,
+#   zamiast powtarzania nazw, list produktów i logo przy każdym sklepie,
+# - nazwy i adresy jako numery w lokalnej tablicy napisów (powtarzają się),
+# - liczby całkowite jako varinty (LEB128, ujemne w kodowaniu zigzag).
+# Z catalog=True słownik szablonów w nagłówku to same klucze szablonów, a sklep
+# po dekodowaniu ma id i template_id zamiast produktów (jak JSON z catalog=1).
+#
+# Układ: MAGIC, długość nagłówka (uint32 LE), nagłówek JSON, a dalej sekcje
+# w kolejności i o długościach (w bajtach) podanych w nagłówku.
+WIRE_MAGIC = b'DZIKWIRE'
+WIRE_FORMAT = 1
+WIRE_CONTENT_TYPE = 'application/x-dzik-shops'
+COORD_SCALE = 1_000_000
+
+
+def encode_varints(values):
+    """Koduje nieujemne liczby całkowite jako varinty LEB128 - wektorowo, bez pętli po elementach"""
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+
+    width = int(lengths.max())
+    shifts = np.arange(width, dtype=np.uint64) * np.uint64(7)
+    groups = ((values[:, None] >> shifts) & np.uint64(0x7F)).astype(np.uint8)
+    # Bit kontynuacji na wszystkich bajtach poza ostatnim danej liczby
+    groups[np.arange(width) < (lengths[:, None] - 1)] |= 0x80
+    return groups[np.arange(width) < lengths[:, None]].tobytes()
+
+
+def decode_varints(data, count):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(raw < 0x80)[:count]
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    used = raw[:ends[-1] + 1].astype(np.uint64)
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = (np.arange(len(used)) - starts[group]).astype(np.uint64) * np.uint64(7)
+    return np.add.reduceat((used & np.uint64(0x7F)) << shifts, starts).astype(np.int64)
+
+
+def zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def unzigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return (values >> 1) ^ -(values & 1)
+
+
+def encode_deltas(values):
+    values = np.asarray(values, dtype=np.int64)
+    return encode_varints(zigzag(np.diff(values, prepend=0)))
+
+
+def decode_deltas(data, count):
+    return np.cumsum(unzigzag(decode_varints(data, count)))
+
+
+def encode_shops(store, positions=None, extra=None, meta=None, catalog=False):
+    """Koduje sklepy z pozycji ``positions`` magazynu (domyślnie wszystkie) razem
+    z nieujemnymi kolumnami całkowitymi ``extra`` (np. distance w metrach)
+    i pozostałymi polami odpowiedzi JSON ``meta``"""
+    if positions is None:
+        positions = np.arange(len(store))
+    positions = np.asarray(positions, dtype=np.int64)
+    extra = extra or {}
+
+    # Lokalne słowniki: tylko szablony i napisy użyte przez wybrane sklepy
+    used_templates, template_refs = np.unique(store.template_ids[positions], return_inverse=True)
+    # Numer 0 to "bez szablonu" (template_id == -1, pierwszy po posortowaniu)
+    if not (len(used_templates) and used_templates[0] < 0):
+        template_refs = template_refs + 1
+    templates = [
+        store.templates[template_id]['id'] if catalog else
+        {key: value for key, value in store.templates[template_id].items() if key != 'id'}
+        for template_id in used_templates[used_templates >= 0].tolist()
+    ]
+
+    string_ids = np.concatenate((store.name_ids[positions], store.address_ids[positions]))
+    used_strings, string_refs = np.unique(string_ids, return_inverse=True)
+    strings = [value.encode('utf-8') for value in store.strings.get_many(used_strings)]
+
+    sections = [
+        ('lat', encode_deltas(np.rint(store.lats[positions] * COORD_SCALE))),
+        ('lon', encode_deltas(np.rint(store.lons[positions] * COORD_SCALE))),
+        ('chain', store.chain_ids[positions].astype(np.uint8).tobytes()),
+        ('template', encode_varints(template_refs)),
+        ('name', encode_varints(string_refs[:len(positions)])),
+        ('address', encode_varints(string_refs[len(positions):])),
+        ('string_lengths', encode_varints([len(value) for value in strings])),
+        ('string_data', b''.join(strings)),
+    ]
+    if catalog:
+        sections.append(('id', encode_deltas(store.shop_ids[positions])))
+    for name, values in extra.items():
+        sections.append((name, encode_varints(values)))
+
+    header = json.dumps({
+        'format': WIRE_FORMAT,
+        'count': len(positions),
+        'coord_scale': COORD_SCALE,
+        'chains': store.chains,
+        'templates': templates,
+        'catalog': catalog,
+        'strings': len(strings),
+        'extra': list(extra),
+        'sections': [[name, len(data)] for name, data in sections],
+        'meta': meta or {},
+    }).encode('utf-8')
+    return b''.join([WIRE_MAGIC, np.uint32(len(header)).tobytes(), header] + [data for _, data in sections])
+
+
+def decode_shops(data):
+    """Dekoder referencyjny (dla testów i benchmarków) - zwraca słownik odpowiedzi
+    taki sam jak wersja JSON"""
+    if data[:len(WIRE_MAGIC)] != WIRE_MAGIC:
+        raise ValueError('To nie jest odpowiedź w formacie bin')
+    header_length = int(np.frombuffer(data, dtype=np.uint32, count=1, offset=len(WIRE_MAGIC))[0])
+    start = len(WIRE_MAGIC) + 4
+    header = json.loads(data[start:start + header_length])
+    count = header['count']
+
+    sections = {}
+    offset = start + header_length
+    for name, length in header['sections']:
+        sections[name] = data[offset:offset + length]
+        offset += length
+
+    lats = (decode_deltas(sections['lat'], count) / header['coord_scale']).tolist()
+    lons = (decode_deltas(sections['lon'], count) / header['coord_scale']).tolist()
+    lengths = decode_varints(sections['string_lengths'], header['strings'])
+    bounds = np.concatenate(([0], np.cumsum(lengths))).tolist()
+    blob = sections['string_data']
+    strings = [str(blob[bounds[i]:bounds[i + 1]], 'utf-8') for i in range(header['strings'])]
+    templates = [None] + header['templates']
+    extra = {name: decode_varints(sections[name], count).tolist() for name in header['extra']}
+    shop_ids = decode_deltas(sections['id'], count).tolist() if header.get('catalog') else None
+
+    shops = []
+    for i, (chain_id, template_ref, name_ref, address_ref) in enumerate(zip(
+        np.frombuffer(sections['chain'], dtype=np.uint8).tolist(),
+        decode_varints(sections['template'], count).tolist(),
+        decode_varints(sections['name'], count).tolist(),
+        decode_varints(sections['address'], count).tolist(),
+    )):
+        template = templates[template_ref]
+        shop = {'id': shop_ids[i]} if shop_ids else {}
+        shop.update({
+            'name': strings[name_ref],
+            'chain': header['chains'][chain_id],
+            'address': strings[address_ref],
+            'lat': lats[i],
+            'lon': lons[i],
+        })
+        if header.get('catalog'):
+            shop['template_id'] = template
+        else:
+            shop['products'] = template['products'] if template else []
+            shop['logo_url'] = template['logo_url'] if template else None
+        for name, values in extra.items():
+            shop[name] = values[i]
+        shops.append(shop)
+
+    return dict(header['meta'], shops=shops)
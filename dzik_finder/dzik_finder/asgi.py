@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dzik_finder.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from dzik.warmup import with_lifespan  # noqa: E402 - wymaga załadowanych aplikacji
+
+# Serwery ASGI z lifespan (uvicorn) rozgrzewają snapshot sklepów przed przyjęciem ruchu
+application = with_lifespan(django_application)
@@ -31,7 +31,7 @@ INSTALLED_APPS = [
 # POPRAWIONA KOLEJNOŚĆ MIDDLEWARE
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'dzik.middleware.AsyncWhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -127,6 +127,47 @@ CACHES = {
     }
 }
 
+# Wspólny cache w Redisie - jeden preload dla wszystkich workerów gunicorna.
+# REDIS_URL=redis://localhost:6379/1 dla lokalnego redis-server; w testach
+# REDIS_URL=fakeredis:// podpina fakeredis (z requirements-dev.txt).
+# Bez REDIS_URL zostaje LocMemCache, osobny w każdym procesie.
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    redis_options = {
+        'pool_class': 'redis.BlockingConnectionPool',
+        'max_connections': int(os.environ.get('REDIS_MAX_CONNECTIONS', 50)),
+        'timeout': 5,
+        'socket_connect_timeout': 2,
+        'socket_timeout': 2,
+        'health_check_interval': 30,
+    }
+    if REDIS_URL.startswith('fakeredis://'):
+        import fakeredis
+        REDIS_URL = 'redis://localhost:6379/0'
+        redis_options['connection_class'] = fakeredis.FakeConnection
+
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'TIMEOUT': 21600,
+        'KEY_PREFIX': 'dzik',
+        'OPTIONS': redis_options,
+    }
+
+# Poniżej tego zoomu smart_shops zwraca klastry zamiast pojedynczych sklepów
+DZIK_CLUSTER_MAX_ZOOM = 10
+
+# Po tylu sekundach snapshot sklepów jest odświeżany w tle (do tego czasu serwowany bez zmian)
+DZIK_SHOPS_REFRESH_AFTER = 6 * 60 * 60
+
+# Plik snapshotu sklepów mapowany przez workery przy starcie (pusty - wyłączony)
+DZIK_SHOPS_SNAPSHOT = os.environ.get('DZIK_SHOPS_SNAPSHOT', os.path.join(BASE_DIR, 'snapshots', 'shops.snapshot'))
+
+# Geocoding: adres wyszukiwania Nominatim (np. lokalny serwer) i limit zapytań na sekundę
+# wspólny dla wszystkich workerów - publiczny Nominatim pozwala na 1/s
+DZIK_NOMINATIM_URL = os.environ.get('DZIK_NOMINATIM_URL', 'https://nominatim.openstreetmap.org/search')
+DZIK_GEOCODE_RATE = float(os.environ.get('DZIK_GEOCODE_RATE', 1))
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.2/topics/i18n/
 LANGUAGE_CODE = 'en-us'
@@ -0,0 +1,16 @@
+# gunicorn.conf.py
+# Wczytywany automatycznie przez gunicorna uruchomionego z tego katalogu
+
+import os
+
+# Worker rozgrzewa się przed pierwszym requestem, a gunicorn zabija workery,
+# które nie zgłoszą się w ciągu timeout sekund - stąd zapas na zimny preload
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+
+def post_worker_init(worker):
+    """Po załadowaniu aplikacji, a przed przyjęciem pierwszego połączenia"""
+    from dzik.warmup import warm_up
+
+    worker.log.info('Rozgrzewanie workera %s...', worker.pid)
+    warm_up()
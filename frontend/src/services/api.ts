@@ -22,6 +22,7 @@ export interface Product {
 }
 
 export interface Shop {
+    id?: number;
     name: string;
     chain: string;
     address: string;
@@ -33,6 +34,24 @@ export interface Shop {
     logo_url?: string;
 }
 
+/* sklep z odpowiedzi z catalog=1 - zamiast produktów i logo klucz szablonu w katalogu */
+type CatalogShop = Omit<Shop, 'products' | 'logo_url'> & { template_id: number | null };
+
+interface CatalogTemplate {
+    products: Product[];
+    logo_url: string | null;
+}
+
+interface Catalog {
+    version: string;
+    templates: Record<string, CatalogTemplate>;
+}
+
+interface ShopsResponse {
+    shops: CatalogShop[];
+    catalog_version?: string;
+}
+
 /* ---------- wspólne utilsy ---------- */
 export const calculateDynamicRadius = (zoom: number): number => {
     if (zoom >= 17) return 5_000;
@@ -45,6 +64,38 @@ export const calculateDynamicRadius = (zoom: number): number => {
     return 10_000_000;
 };
 
+/* ---------- katalog szablonów: pobierany raz na wersję, sklepy niosą tylko template_id ---------- */
+let catalogCache: Promise<Catalog> | null = null;
+let catalogVersion: string | null = null;
+
+const getCatalog = (version: string): Promise<Catalog> => {
+    if (!catalogCache || catalogVersion !== version) {
+        catalogVersion = version;
+        catalogCache = api
+            .get(`/catalog/?v=${encodeURIComponent(version)}`)
+            .then(res => res.data as Catalog)
+            .catch(err => {
+                catalogCache = null;
+                throw err;
+            });
+    }
+    return catalogCache;
+};
+
+const withCatalog = async (data: ShopsResponse): Promise<Shop[]> => {
+    // Odpowiedź z klastrami (niski zoom) nie ma sklepów ani wersji katalogu
+    if (!data.catalog_version) return data.shops as unknown as Shop[];
+    const catalog = await getCatalog(data.catalog_version);
+    return data.shops.map(({ template_id, ...shop }) => {
+        const template = template_id !== null ? catalog.templates[String(template_id)] : undefined;
+        return {
+            ...shop,
+            products: template ? template.products : [],
+            logo_url: template?.logo_url ?? undefined
+        };
+    });
+};
+
 /* ---------- NOWE: pobierz sklepy z inteligentnego cache ---------- */
 export const getSmartShops = async (
     lat: number,
@@ -57,6 +108,7 @@ export const getSmartShops = async (
     params.append('lat', lat.toString());
     params.append('lon', lon.toString());
     params.append('zoom', zoom.toString());
+    params.append('catalog', '1');
 
     if (userLocation) {
         params.append('user_lat', userLocation.lat.toString());
@@ -70,7 +122,7 @@ export const getSmartShops = async (
     const url = `/smart-shops/?${params.toString()}`;
 
     const res = await api.get(url);
-    return res.data.shops as Shop[];
+    return withCatalog(res.data as ShopsResponse);
 };
 
 /* ---------- STARE: wszystkie sklepy naraz (zachowane dla kompatybilności) ---------- */
@@ -79,6 +131,7 @@ export const getAllShops = async (
     products?: string
 ): Promise<Shop[]> => {
     const params = new URLSearchParams();
+    params.append('catalog', '1');
 
     if (userLocation) {
         params.append('user_lat', userLocation.lat.toString());
@@ -89,10 +142,10 @@ export const getAllShops = async (
         params.append('products', products);
     }
 
-    const url = `/all-shops/${params.toString() ? '?' + params.toString() : ''}`;
+    const url = `/all-shops/?${params.toString()}`;
 
     const res = await api.get(url);
-    return res.data.shops as Shop[];
+    return withCatalog(res.data as ShopsResponse);
 };
 
 /* ---------- pozostałe funkcje bez zmian ---------- */
@@ -110,9 +163,9 @@ export const getNearestShops = async (
         : '';
 
     const res = await api.get(
-        `/nearest-shops/?lat=${lat}&lon=${lon}&zoom=${zoom}&radius=${radius}${cacheParam}${userParam}`
+        `/nearest-shops/?lat=${lat}&lon=${lon}&zoom=${zoom}&radius=${radius}&catalog=1${cacheParam}${userParam}`
     );
-    return res.data.shops as Shop[];
+    return withCatalog(res.data as ShopsResponse);
 };
 
 export const fetchByRadius = async (
@@ -126,7 +179,7 @@ export const fetchByRadius = async (
         : '';
 
     const res = await api.get(
-        `/nearest-shops/?lat=${lat}&lon=${lon}&zoom=13&radius=${radius}&no_cache=true${userParam}`
+        `/nearest-shops/?lat=${lat}&lon=${lon}&zoom=13&radius=${radius}&no_cache=true&catalog=1${userParam}`
     );
-    return res.data.shops as Shop[];
+    return withCatalog(res.data as ShopsResponse);
 };